@@ -1,16 +1,20 @@
 from flask import Flask, render_template, request
 from .config import config
-from .extensions import db, jwt, migrate, cache
+from .extensions import db, jwt, migrate, cache, sync_jobs, market_data
+from .utils.serialization import FastJSONProvider
 
 def create_app(config_name='development'):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
+    app.json = FastJSONProvider(app)
 
     #Init extensions
     db.init_app(app)
     jwt.init_app(app)
     migrate.init_app(app, db)
     cache.init_app(app)
+    sync_jobs.init_app(app)
+    market_data.init_app(app)
 
     #Register API blueprints
     from .api import auth, portfolio, assets
@@ -18,6 +22,10 @@ def create_app(config_name='development'):
     app.register_blueprint(portfolio.portfolio_bp, url_prefix='/api/portfolios')
     app.register_blueprint(assets.asset_bp, url_prefix='/api/assets')
 
+    #CLI commands
+    from .services.positions import positions_cli
+    app.cli.add_command(positions_cli)
+
     @app.route('/')
     def dashboard():
         return render_template('dashboard.html')
@@ -47,6 +55,11 @@ def create_app(config_name='development'):
     def health_check():
         return {'status': 'healthy', 'message': 'API is running!'}, 200
 
+    @app.route('/api/health/cache')
+    def cache_stats():
+        stats = getattr(cache.cache, 'stats', None)
+        return {'cache': stats() if stats else None}, 200
+
     # Error handler
     @app.errorhandler(404)
     def not_found(error):
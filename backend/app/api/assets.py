@@ -1,20 +1,116 @@
 """
 Assets API
 """
-from flask import Blueprint, request, jsonify
+from datetime import date
+from decimal import Decimal
+from flask import Blueprint, current_app, request, jsonify
 from flask_jwt_extended import jwt_required
-from ..models.asset import Asset
-from ..services.yahoo_finance import YahooFinanceService
-from ..extensions import db
+from ..models.asset import Asset, AssetMetric
+from ..services.price_history import PriceHistoryService
+from ..services.charts import ChartService
+from ..services.yahoo_finance import TICKER_PATTERN
+from ..extensions import sync_jobs
+from ..utils.pagination import encode_cursor, decode_cursor
 
 asset_bp = Blueprint('asset', __name__)
 
+CATALOGUE_PAGE_SIZE = 50
+CATALOGUE_MAX_PAGE_SIZE = 500
+CATALOGUE_SORTS = ('ticker', 'name', 'asset_type', 'sector', 'industry', 'exchange', 'currency')
+CATALOGUE_FILTERS = {'type': 'asset_type', 'sector': 'sector', 'exchange': 'exchange', 'currency': 'currency'}
+CHART_POINTS = 500
+CHART_MAX_POINTS = 5000
+#Screener parameter -> AssetMetric column
+SCREENER_METRICS = {'pe': 'pe_ratio', 'pb': 'pb_ratio', 'yield': 'dividend_yield', 'market_cap': 'market_cap'}
+
 @asset_bp.route('/assets', methods=['GET'])
 @jwt_required()
 def get_assets():
-    """List of all assets"""
-    assets = Asset.query.all()
-    return jsonify({'assets': [asset.to_dict() for asset in assets]}), 200
+    """
+    Asset catalogue page, filtered by type, sector, exchange and currency,
+    sorted by sort (- prefix for descending). Prices are read from stored
+    bars and the quote cache only, upstream is never called from here.
+    """
+    sort = request.args.get('sort', 'ticker')
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+    if sort not in CATALOGUE_SORTS:
+        return jsonify({'error': f"sort must be one of {', '.join(CATALOGUE_SORTS)}"}), 400
+
+    try:
+        after = tuple(decode_cursor(request.args['cursor'])) if 'cursor' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    if after is not None and not (len(after) == 2 and isinstance(after[0], str) and isinstance(after[1], int)):
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    filters = {
+        column: request.args.getlist(param)
+        for param, column in CATALOGUE_FILTERS.items() if request.args.getlist(param)
+    }
+
+    limit = min(max(request.args.get('limit', CATALOGUE_PAGE_SIZE, type=int), 1), CATALOGUE_MAX_PAGE_SIZE)
+    assets = Asset.catalogue_page(limit + 1, sort, descending, after, filters)
+    next_cursor = None
+    if len(assets) > limit:
+        assets = assets[:limit]
+        next_cursor = encode_cursor(getattr(assets[-1], sort) or '', assets[-1].id)
+
+    prices = Asset.get_current_prices(assets, fetch=False)
+    return jsonify({
+        'assets': [asset.to_dict(prices=prices) for asset in assets],
+        'next_cursor': next_cursor
+    }), 200
+
+@asset_bp.route('/screener', methods=['GET'])
+@jwt_required()
+def screen_assets():
+    """
+    Assets ranked by pe, pb, yield or market_cap of their latest metrics
+    (sort, - prefix for descending), within <metric>_min / <metric>_max
+    ranges and the catalogue filters
+    """
+    sort = request.args.get('sort', '-market_cap')
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+    if sort not in SCREENER_METRICS:
+        return jsonify({'error': f"sort must be one of {', '.join(SCREENER_METRICS)}"}), 400
+
+    try:
+        after = tuple(decode_cursor(request.args['cursor'])) if 'cursor' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    if after is not None and not (
+            len(after) == 2 and isinstance(after[0], Decimal) and after[0].is_finite() and isinstance(after[1], int)):
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    ranges = {}
+    try:
+        for param, column in SCREENER_METRICS.items():
+            low, high = request.args.get(f'{param}_min'), request.args.get(f'{param}_max')
+            if low is not None or high is not None:
+                ranges[column] = (float(low) if low is not None else None, float(high) if high is not None else None)
+    except ValueError:
+        return jsonify({'error': 'Metric ranges must be numbers'}), 400
+
+    filters = {
+        column: request.args.getlist(param)
+        for param, column in CATALOGUE_FILTERS.items() if request.args.getlist(param)
+    }
+
+    limit = min(max(request.args.get('limit', CATALOGUE_PAGE_SIZE, type=int), 1), CATALOGUE_MAX_PAGE_SIZE)
+    rows = AssetMetric.screen(limit + 1, SCREENER_METRICS[sort], descending, after, ranges, filters)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        asset, metrics = rows[-1]
+        next_cursor = encode_cursor(getattr(metrics, SCREENER_METRICS[sort]), asset.id)
+
+    prices = Asset.get_current_prices([asset for asset, _ in rows], fetch=False)
+    return jsonify({
+        'assets': [dict(asset.to_dict(prices=prices), metrics=metrics.to_dict()) for asset, metrics in rows],
+        'next_cursor': next_cursor
+    }), 200
 
 @asset_bp.route('/<string:ticker>', methods=['GET'])
 @jwt_required()
@@ -23,27 +119,102 @@ def get_asset(ticker):
     asset = Asset.query.filter_by(ticker=ticker.upper()).first()
     if not asset:
         return jsonify({'error': 'Asset not found'}), 404
-    return jsonify(asset.to_dict(include_history=True)), 200
+    return jsonify(asset.to_dict(include_details=True, prices=Asset.get_current_prices([asset]))), 200
+
+
+@asset_bp.route('/<string:ticker>/history', methods=['GET'])
+@jwt_required()
+def get_asset_history(ticker):
+    """
+    OHLCV history of a period (or start/end dates), daily or resampled to
+    1wk/1mo bars, as parallel arrays unless format=records
+    """
+    asset = Asset.query.filter_by(ticker=ticker.upper()).first()
+    if not asset:
+        return jsonify({'error': 'Asset not found'}), 404
+
+    try:
+        start = date.fromisoformat(request.args['start']) if 'start' in request.args else None
+        end = date.fromisoformat(request.args['end']) if 'end' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'Dates must be in YYYY-MM-DD format'}), 400
+
+    interval = request.args.get('interval', '1d')
+    try:
+        frame = PriceHistoryService.get_history(asset.id, request.args.get('period', '1m'), start, end, interval)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if request.args.get('format') == 'records':
+        history = PriceHistoryService.to_records(frame)
+    else:
+        history = PriceHistoryService.to_columns(frame)
+
+    return jsonify({'ticker': asset.ticker, 'interval': interval, 'history': history}), 200
+
+
+@asset_bp.route('/<string:ticker>/chart', methods=['GET'])
+@jwt_required()
+def get_asset_chart(ticker):
+    """Close series downsampled to at most points points (lttb or minmax)"""
+    asset = Asset.query.filter_by(ticker=ticker.upper()).first()
+    if not asset:
+        return jsonify({'error': 'Asset not found'}), 404
+
+    try:
+        start = date.fromisoformat(request.args['start']) if 'start' in request.args else None
+        end = date.fromisoformat(request.args['end']) if 'end' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'Dates must be in YYYY-MM-DD format'}), 400
+
+    points = min(max(request.args.get('points', CHART_POINTS, type=int), 3), CHART_MAX_POINTS)
+    try:
+        series = ChartService.asset_series(asset.id, request.args.get('period', '1y'), start, end, points,
+                                           request.args.get('method', 'lttb'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({'ticker': asset.ticker, 'points': points, 'series': series}), 200
 
 
 @asset_bp.route('/sync/<string:ticker>', methods=['POST'])
 @jwt_required()
 def sync_asset(ticker):
-    """Refresh or add asset from YahooFinance"""
+    """Queue a refresh or add of an asset from YahooFinance"""
     ticker = ticker.upper()
-    asset_info = YahooFinanceService.get_stock_info(ticker)
-    if not asset_info:
-        return jsonify({'error': 'Invalid ticker symbol'}), 400
+    if not TICKER_PATTERN.match(ticker):
+        return jsonify({'error': 'Invalid ticker'}), 400
+
+    job = sync_jobs.enqueue(ticker)
+    return jsonify({'message': 'Asset sync queued', 'job': job}), 202
 
-    asset = Asset.query.filter_by(ticker=ticker).first()
-    if not asset:
-        asset = Asset(**asset_info)
-        db.session.add(asset)
-    else:
-        for key, value in asset_info.items():
-            setattr(asset, key, value)
 
-    db.session.commit()
-    YahooFinanceService.update_asset_historical_data(ticker)
+@asset_bp.route('/sync', methods=['POST'])
+@jwt_required()
+def sync_assets():
+    """Queue a sync of several assets"""
+    data = request.get_json() or {}
+    tickers = data.get('tickers')
+    if not isinstance(tickers, list) or not tickers:
+        return jsonify({'error': 'List of tickers is required'}), 400
+    max_tickers = current_app.config['SYNC_BATCH_MAX']
+    if len(tickers) > max_tickers:
+        return jsonify({'error': f'At most {max_tickers} tickers can be synced at once'}), 400
+
+    tickers = [str(ticker).upper() for ticker in tickers]
+    invalid = [ticker for ticker in tickers if not TICKER_PATTERN.match(ticker)]
+    if invalid:
+        return jsonify({'error': 'Invalid tickers', 'tickers': invalid}), 400
+
+    jobs = sync_jobs.enqueue_many(tickers)
+    return jsonify({'message': 'Asset sync queued', 'jobs': jobs}), 202
 
-    return jsonify({'message': 'Asset synced successfully', 'asset': asset.to_dict()}), 200
+
+@asset_bp.route('/sync/jobs/<string:job_id>', methods=['GET'])
+@jwt_required()
+def get_sync_job(job_id):
+    """Status of a sync job"""
+    job = sync_jobs.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job), 200
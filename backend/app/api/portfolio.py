@@ -1,40 +1,64 @@
 """
 Portfolio API
 """
-from flask import Blueprint, request, jsonify
+import csv
+from datetime import date, datetime
+from flask import Blueprint, Response, current_app, request, jsonify, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from ..models.portfolio import Portfolio
 from ..models.transaction import Transaction
-from ..models.asset import Asset
-from ..services.yahoo_finance import YahooFinanceService
-from ..extensions import db
+from ..services.portfolio_service import PortfolioService
+from ..services.snapshots import SnapshotService
+from ..services.ai_analysis import PortfolioAnalyticsService
+from ..services.charts import ChartService
+from ..services.cost_basis import CostBasisService, METHODS as COST_BASIS_METHODS
+from ..services.dividends import DividendService
+from ..services.fx import FxService
+from ..services.transaction_import import TransactionImportService
+from ..extensions import db, sync_jobs
+from ..utils.pagination import encode_cursor, decode_cursor
 
 portfolio_bp = Blueprint('portfolio', __name__, url_prefix='/portfolio')
 
+TRANSACTIONS_PAGE_SIZE = 100
+TRANSACTIONS_MAX_PAGE_SIZE = 1000
+TRANSACTIONS_STREAM_BATCH = 500
+CHART_POINTS = 500
+CHART_MAX_POINTS = 5000
+
 
 @portfolio_bp.route('/', methods=['GET'])
 @jwt_required()
 def get_portfolios():
-    """Current user's portfolios"""
+    """Current user's portfolios, valued in the currency asked for"""
     current_user_id = get_jwt_identity()
+    currency = FxService.base_currency(request.args.get('currency', '').upper())
+    if not FxService.is_valid(currency):
+        return jsonify({'error': 'currency must be a 3-letter currency code'}), 400
+
     portfolios = Portfolio.query.filter_by(user_id=current_user_id).all()
+    valuations = PortfolioService.value_portfolios(portfolios, currency)
 
     return jsonify({
-        'portfolios': [portfolio.to_dict() for portfolio in portfolios]
+        'portfolios': [portfolio.to_dict(valuation=valuations[portfolio.id]) for portfolio in portfolios]
     }), 200
 
 
 @portfolio_bp.route('/<int:portfolio_id>', methods=['GET'])
 @jwt_required()
 def get_portfolio(portfolio_id):
-    """Actual portfolio"""
+    """Actual portfolio, valued in the currency asked for"""
     current_user_id = get_jwt_identity()
     portfolio = Portfolio.query.filter_by(id=portfolio_id, user_id=current_user_id).first()
 
     if not portfolio:
         return jsonify({'error': 'Portfolio not found'}), 404
 
-    return jsonify(portfolio.to_dict(include_assets=True)), 200
+    currency = FxService.base_currency(request.args.get('currency', '').upper())
+    if not FxService.is_valid(currency):
+        return jsonify({'error': 'currency must be a 3-letter currency code'}), 400
+
+    return jsonify(portfolio.to_dict(include_assets=True, valuation=portfolio.get_valuation(currency))), 200
 
 
 @portfolio_bp.route('/', methods=['POST'])
@@ -108,6 +132,120 @@ def delete_portfolio(portfolio_id):
     }), 200
 
 
+@portfolio_bp.route('/<int:portfolio_id>/history', methods=['GET'])
+@jwt_required()
+def get_portfolio_history(portfolio_id):
+    """Daily portfolio value history"""
+    current_user_id = get_jwt_identity()
+    portfolio = Portfolio.query.filter_by(id=portfolio_id, user_id=current_user_id).first()
+
+    if not portfolio:
+        return jsonify({'error': 'Portfolio not found'}), 404
+
+    try:
+        start = date.fromisoformat(request.args['start']) if 'start' in request.args else None
+        end = date.fromisoformat(request.args['end']) if 'end' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'Dates must be in YYYY-MM-DD format'}), 400
+
+    currency = FxService.base_currency(request.args.get('currency', '').upper())
+    if not FxService.is_valid(currency):
+        return jsonify({'error': 'currency must be a 3-letter currency code'}), 400
+
+    snapshots = SnapshotService.get_history(portfolio_id, start, end, currency)
+
+    return jsonify({
+        'currency': currency,
+        'history': [snapshot.to_dict() for snapshot in snapshots]
+    }), 200
+
+
+@portfolio_bp.route('/<int:portfolio_id>/chart', methods=['GET'])
+@jwt_required()
+def get_portfolio_chart(portfolio_id):
+    """Portfolio value series downsampled to at most points points (lttb or minmax)"""
+    current_user_id = get_jwt_identity()
+    portfolio = Portfolio.query.filter_by(id=portfolio_id, user_id=current_user_id).first()
+
+    if not portfolio:
+        return jsonify({'error': 'Portfolio not found'}), 404
+
+    try:
+        start = date.fromisoformat(request.args['start']) if 'start' in request.args else None
+        end = date.fromisoformat(request.args['end']) if 'end' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'Dates must be in YYYY-MM-DD format'}), 400
+
+    currency = FxService.base_currency(request.args.get('currency', '').upper())
+    if not FxService.is_valid(currency):
+        return jsonify({'error': 'currency must be a 3-letter currency code'}), 400
+
+    points = min(max(request.args.get('points', CHART_POINTS, type=int), 3), CHART_MAX_POINTS)
+    try:
+        series = ChartService.portfolio_series(
+            portfolio_id, start, end, points, request.args.get('method', 'lttb'), currency)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({'points': points, 'currency': currency, 'series': series}), 200
+
+
+@portfolio_bp.route('/<int:portfolio_id>/analysis', methods=['GET'])
+@jwt_required()
+def get_portfolio_analysis(portfolio_id):
+    """Risk and return analysis of current holdings"""
+    current_user_id = get_jwt_identity()
+    portfolio = Portfolio.query.filter_by(id=portfolio_id, user_id=current_user_id).first()
+
+    if not portfolio:
+        return jsonify({'error': 'Portfolio not found'}), 404
+
+    days = request.args.get('days', 365, type=int)
+    if days < 2:
+        return jsonify({'error': 'days must be at least 2'}), 400
+
+    analysis = PortfolioAnalyticsService.analyze(portfolio, request.args.get('benchmark'), days)
+    return jsonify(analysis.to_dict()), 200
+
+
+@portfolio_bp.route('/<int:portfolio_id>/cost-basis', methods=['GET'])
+@jwt_required()
+def get_portfolio_cost_basis(portfolio_id):
+    """Lot-level cost basis, realized and unrealized P&L per asset"""
+    current_user_id = get_jwt_identity()
+    portfolio = Portfolio.query.filter_by(id=portfolio_id, user_id=current_user_id).first()
+
+    if not portfolio:
+        return jsonify({'error': 'Portfolio not found'}), 404
+
+    method = request.args.get('method', 'fifo').lower()
+    if method not in COST_BASIS_METHODS:
+        return jsonify({'error': f"method must be one of {', '.join(COST_BASIS_METHODS)}"}), 400
+
+    include_lots = request.args.get('lots', '').lower() in ('1', 'true', 'yes')
+    return jsonify({
+        'method': method,
+        'assets': CostBasisService.summary(portfolio.id, method, include_lots)
+    }), 200
+
+
+@portfolio_bp.route('/<int:portfolio_id>/dividends', methods=['GET'])
+@jwt_required()
+def get_portfolio_dividends(portfolio_id):
+    """Trailing 12-month dividend income received and projected income of current holdings"""
+    current_user_id = get_jwt_identity()
+    portfolio = Portfolio.query.filter_by(id=portfolio_id, user_id=current_user_id).first()
+
+    if not portfolio:
+        return jsonify({'error': 'Portfolio not found'}), 404
+
+    currency = FxService.base_currency(request.args.get('currency', '').upper())
+    if not FxService.is_valid(currency):
+        return jsonify({'error': 'currency must be a 3-letter currency code'}), 400
+
+    return jsonify(DividendService.summary(portfolio.id, currency)), 200
+
+
 @portfolio_bp.route('/<int:portfolio_id>/transactions', methods=['GET'])
 @jwt_required()
 def get_portfolio_transactions(portfolio_id):
@@ -118,11 +256,37 @@ def get_portfolio_transactions(portfolio_id):
     if not portfolio:
         return jsonify({'error': 'Portfolio not found'}), 404
 
-    transactions = Transaction.query.filter_by(portfolio_id=portfolio_id).order_by(
-        Transaction.transaction_date.desc()).all()
+    try:
+        after = tuple(decode_cursor(request.args['cursor'])) if 'cursor' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    if after is not None and not (len(after) == 2 and isinstance(after[0], datetime) and isinstance(after[1], int)):
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    # NDJSON: stream the whole history page by page, memory stays flat
+    if request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson':
+        def generate(after):
+            while True:
+                page = Transaction.keyset_page(portfolio_id, TRANSACTIONS_STREAM_BATCH, after)
+                for transaction in page:
+                    yield current_app.json.dumps(transaction.to_dict(include_asset=True)) + '\n'
+                if len(page) < TRANSACTIONS_STREAM_BATCH:
+                    return
+                after = (page[-1].transaction_date, page[-1].id)
+                db.session.expunge_all()
+
+        return Response(stream_with_context(generate(after)), mimetype='application/x-ndjson')
+
+    limit = min(max(request.args.get('limit', TRANSACTIONS_PAGE_SIZE, type=int), 1), TRANSACTIONS_MAX_PAGE_SIZE)
+    transactions = Transaction.keyset_page(portfolio_id, limit + 1, after)
+    next_cursor = None
+    if len(transactions) > limit:
+        transactions = transactions[:limit]
+        next_cursor = encode_cursor(transactions[-1].transaction_date, transactions[-1].id)
 
     return jsonify({
-        'transactions': [transaction.to_dict(include_asset=True) for transaction in transactions]
+        'transactions': [transaction.to_dict(include_asset=True) for transaction in transactions],
+        'next_cursor': next_cursor
     }), 200
 
 
@@ -136,33 +300,57 @@ def add_transaction(portfolio_id):
     if not portfolio:
         return jsonify({'error': 'Portfolio not found'}), 404
 
-    data = request.get_json()
+    data = request.get_json() or {}
 
     # Check necessary fields
-    required_fields = ['ticker', 'transaction_type', 'quantity', 'price', 'transaction_date']
-    if not all(key in data for key in required_fields):
-        return jsonify({'error': 'Missing required fields'}), 400
-
-    # Get or create an asset
-    asset = Asset.query.filter_by(ticker=data['ticker']).first()
+    try:
+        fields = TransactionImportService.parse_row(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Get or create an asset, its history is synced in the background
+    assets, created, _ = TransactionImportService.resolve_assets([fields['ticker']])
+    asset = assets.get(fields.pop('ticker'))
     if not asset:
-        # Get asset info
-        asset_info = YahooFinanceService.get_stock_info(data['ticker'])
-        if not asset_info:
-            return jsonify({'error': 'Invalid ticker symbol'}), 400
-
-        # Create new asset
-        asset = Asset(
-            ticker=asset_info['ticker'],
-            name=asset_info['name'],
-            asset_type=asset_info['asset_type'],
-            currency=asset_info['currency'],
-            exchange=asset_info['exchange'],
-            sector=asset_info['sector'],
-            industry=asset_info['industry']
-        )
-        db.session.add(asset)
-        db.session.flush()  # Для получения ID актива
-
-        # Update asset historical data
-        YahooFinanceService.update_asset_historical_data(data['ticker'])
\ No newline at end of file
+        return jsonify({'error': 'Invalid ticker symbol'}), 400
+
+    transaction = Transaction(portfolio_id=portfolio.id, asset_id=asset.id, **fields)
+    db.session.add(transaction)
+    db.session.commit()
+    sync_jobs.enqueue_many(created)
+
+    return jsonify({
+        'message': 'Transaction added successfully',
+        'transaction': transaction.to_dict(include_asset=True)
+    }), 201
+
+
+@portfolio_bp.route('/<int:portfolio_id>/transactions/import', methods=['POST'])
+@jwt_required()
+def import_transactions(portfolio_id):
+    """Bulk import of a broker statement (CSV, NDJSON or a JSON list)"""
+    current_user_id = get_jwt_identity()
+    portfolio = Portfolio.query.filter_by(id=portfolio_id, user_id=current_user_id).first()
+
+    if not portfolio:
+        return jsonify({'error': 'Portfolio not found'}), 404
+
+    upload = request.files.get('file')
+    if upload:
+        stream = upload.stream
+        content_type = upload.mimetype or ''
+        if upload.filename and upload.filename.lower().endswith('.csv'):
+            content_type = 'text/csv'
+        elif upload.filename and upload.filename.lower().endswith('.ndjson'):
+            content_type = 'application/x-ndjson'
+    else:
+        stream = request.stream
+        content_type = request.mimetype or ''
+
+    try:
+        report = TransactionImportService.import_rows(
+            portfolio.id, TransactionImportService.read_rows(stream, content_type))
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'error': f'Could not parse file: {e}'}), 400
+
+    return jsonify(report), 201 if report['imported'] else 400
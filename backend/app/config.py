@@ -18,6 +18,58 @@ class Config:
     #REDIS
     REDIS_URL = os.environ['REDIS_URL']
 
+    #Cache: per-worker LRU tier in front of Redis
+    CACHE_TYPE = 'app.services.cache.TwoTierRedisCache'
+    CACHE_REDIS_URL = REDIS_URL
+    CACHE_DEFAULT_TIMEOUT = 300
+    CACHE_LOCAL_SIZE = int(os.environ.get('CACHE_LOCAL_SIZE', 1024))
+    CACHE_LOCAL_TTL = int(os.environ.get('CACHE_LOCAL_TTL', 5))
+
+    #Background market data refresh (seconds)
+    REFRESH_QUOTES_INTERVAL = int(os.environ.get('REFRESH_QUOTES_INTERVAL', 60))
+    REFRESH_HISTORY_INTERVAL = int(os.environ.get('REFRESH_HISTORY_INTERVAL', 6 * 3600))
+    REFRESH_METRICS_INTERVAL = int(os.environ.get('REFRESH_METRICS_INTERVAL', 24 * 3600))
+    REFRESH_DIVIDENDS_INTERVAL = int(os.environ.get('REFRESH_DIVIDENDS_INTERVAL', 24 * 3600))
+    REFRESH_MAX_WORKERS = int(os.environ.get('REFRESH_MAX_WORKERS', 4))
+    #Quote batches run on their own workers, never behind per-asset refreshes
+    REFRESH_QUOTE_WORKERS = int(os.environ.get('REFRESH_QUOTE_WORKERS', 2))
+    REFRESH_QUOTE_BATCH_SIZE = int(os.environ.get('REFRESH_QUOTE_BATCH_SIZE', 100))
+    #Market data provider: 'yahoo', or 'local' serving fixtures from MARKET_DATA_PATH and
+    #synthetic random walks offline, each call delayed MARKET_DATA_LATENCY seconds
+    MARKET_DATA_PROVIDER = os.environ.get('MARKET_DATA_PROVIDER', 'yahoo')
+    MARKET_DATA_PATH = os.environ.get('MARKET_DATA_PATH')
+    MARKET_DATA_LATENCY = float(os.environ.get('MARKET_DATA_LATENCY', 0))
+    MARKET_DATA_SEED = int(os.environ.get('MARKET_DATA_SEED', 0))
+    #Upstream HTTP session: timeouts (seconds), retries of 429/5xx with jittered backoff
+    UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+    UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 20))
+    UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', 3))
+    UPSTREAM_BACKOFF = float(os.environ.get('UPSTREAM_BACKOFF', 0.5))
+    UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 20))
+    #Upstream requests per second shared by every worker through Redis, and the burst allowed
+    UPSTREAM_RATE_LIMIT = float(os.environ.get('UPSTREAM_RATE_LIMIT', 5))
+    UPSTREAM_RATE_BURST = int(os.environ.get('UPSTREAM_RATE_BURST', 10))
+    #Age after which a stored quote is stale while the market is open (seconds)
+    QUOTE_MAX_AGE = int(os.environ.get('QUOTE_MAX_AGE', 900))
+
+    #Currency portfolios are valued in unless a request asks for another one
+    BASE_CURRENCY = os.environ.get('BASE_CURRENCY', 'USD')
+
+    #Portfolio analytics
+    ANALYTICS_BENCHMARK = os.environ.get('ANALYTICS_BENCHMARK', 'SPY')
+    ANALYTICS_RISK_FREE_RATE = float(os.environ.get('ANALYTICS_RISK_FREE_RATE', 0.0))
+    #Stored analyses kept per portfolio, older ones are deleted
+    ANALYTICS_HISTORY = int(os.environ.get('ANALYTICS_HISTORY', 20))
+
+    #Asset sync jobs: 'redis' queue consumed by the worker, or 'memory' in-process
+    SYNC_JOBS_BACKEND = os.environ.get('SYNC_JOBS_BACKEND', 'redis')
+    SYNC_JOBS_WORKERS = int(os.environ.get('SYNC_JOBS_WORKERS', 2))
+    SYNC_JOB_TTL = int(os.environ.get('SYNC_JOB_TTL', 24 * 3600))
+    #Tickers one POST /api/assets/sync request may queue
+    SYNC_BATCH_MAX = int(os.environ.get('SYNC_BATCH_MAX', 100))
+    #Seconds a taken job holds its ticker without its worker renewing it
+    SYNC_JOB_LEASE = int(os.environ.get('SYNC_JOB_LEASE', 120))
+
     @staticmethod
     def init_app(app):
         """app initialization."""
@@ -32,6 +84,8 @@ class TestingConfig(Config):
     """Testing configuration."""
     TESTING = True
     SQLALCHEMY_DATABASE_URI = os.environ['TEST_DATABASE_URL']
+    SYNC_JOBS_BACKEND = 'memory'
+    CACHE_TYPE = 'SimpleCache'
 
 class ProductionConfig(Config):
     """Production configuration."""
@@ -4,13 +4,13 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_jwt_extended import JWTManager
 from flask_migrate import Migrate
 from flask_caching import Cache
+from .services.jobs import SyncJobQueue
+from .services.market_data import MarketData
 
 #Extensions initialization
 db = SQLAlchemy()
 jwt = JWTManager()
 migrate = Migrate()
-cache = Cache(config={
-    "CACHE_TYPE": "redis",
-    "CACHE_REDIS_URL": "redis://redis:6379/0",
-    "CACHE_DEFAULT_TIMEOUT": 300
-})
+cache = Cache()  # configured from CACHE_* settings
+sync_jobs = SyncJobQueue()
+market_data = MarketData()  # configured from MARKET_DATA_* settings
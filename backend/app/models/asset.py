@@ -1,12 +1,16 @@
 """
 Asset model
 """
-from datetime import datetime
+from datetime import datetime, timedelta
+from flask import current_app
 from sqlalchemy import func
 from ..extensions import db, cache
 
+# Years of dividends listed in the asset details
+DIVIDEND_DETAIL_YEARS = 5
+
 class Asset(db.Model):
-    __tablename__ = "asset"
+    __tablename__ = "assets"
 
     id = db.Column(db.Integer, primary_key=True)
     ticker = db.Column(db.String(20), unique=True, nullable=False)
@@ -24,60 +28,120 @@ class Asset(db.Model):
     metrics = db.relationship('AssetMetric', backref='asset', lazy='dynamic', cascade='all, delete-orphan')
     dividends = db.relationship('Dividend', backref='asset', lazy='dynamic', cascade='all, delete-orphan')
     transactions = db.relationship('Transaction', backref='asset', lazy='dynamic')
+    quote = db.relationship('AssetQuote', backref='asset', uselist=False, cascade='all, delete-orphan')
 
     def get_current_price(self):
+        """Current price, see get_current_prices"""
+        return Asset.get_current_prices([self]).get(self.id)
+
+    @staticmethod
+    def get_current_prices(assets, fetch=True):
+        """
+        Current prices for many assets at once: {asset_id: float or None}.
+        Stored quotes are read in one indexed query (the latest bar for assets
+        without a quote yet). Only quotes that are not current by the market
+        calendar go to Yahoo Finance, in one batch. With fetch=False those
+        are read from the quote cache only.
+        """
+        from ..services.market_calendar import MarketCalendar
         from ..services.yahoo_finance import YahooFinanceService
-        #check cache or db
-        latest_price = AssetPrice.query.filer_by(asset_id=self.id).order_by(AssetPrice.date.desc()).first()
 
-        if latest_price and latest_price.date == datetime.now().date():
-            return latest_price.close
+        assets = list(assets)
+        if not assets:
+            return {}
 
-        current_price = YahooFinanceService.get_current_price(self.ticker)
-        if current_price:
-            return current_price
+        asset_ids = [asset.id for asset in assets]
+        stored = {
+            asset_id: (price, session_date, quoted_at)
+            for asset_id, price, session_date, quoted_at in db.session.query(
+                AssetQuote.asset_id, AssetQuote.price, AssetQuote.session_date, AssetQuote.quoted_at
+            ).filter(AssetQuote.asset_id.in_(asset_ids))
+        }
+        missing = [asset_id for asset_id in asset_ids if asset_id not in stored]
+        if missing:
+            stored.update(Asset.get_latest_closes(missing))
 
-        if latest_price:
-            return latest_price.close
+        now = datetime.utcnow()
+        max_age = current_app.config.get('QUOTE_MAX_AGE', 900)
+        prices = {}
+        stale = []
+        for asset in assets:
+            price, session_date, quoted_at = stored.get(asset.id, (None, None, None))
+            if price is not None and MarketCalendar.is_current(session_date, quoted_at, now, max_age):
+                prices[asset.id] = float(price)
+            else:
+                stale.append(asset)
 
-        return None
+        if fetch:
+            current_prices = YahooFinanceService.get_current_prices(asset.ticker for asset in stale)
+        else:
+            current_prices = YahooFinanceService.get_cached_prices(asset.ticker for asset in stale)
+        for asset in stale:
+            current_price = current_prices.get(asset.ticker)
+            if current_price:
+                prices[asset.id] = float(current_price)
+            else:
+                price = stored.get(asset.id, (None,))[0]
+                prices[asset.id] = float(price) if price is not None else None
 
-    def get_price_history(self, period='1m'):
-        """Get price history"""
-        # From db
-        prices = AssetPrice.query.filter_by(asset_id=self.id).order_by(AssetPrice.date).all()
-        return [
-            {
-                'date': price.date.isoformat(),
-                'open': price.open,
-                'high': price.high,
-                'low': price.low,
-                'close': price.close,
-                'volume': price.volume
-            }
-            for price in prices
-        ]
+        return prices
+
+    @staticmethod
+    def get_latest_closes(asset_ids):
+        """Latest stored bar of many assets: {asset_id: (close, date, None)}"""
+        latest_dates = db.session.query(
+            AssetPrice.asset_id,
+            func.max(AssetPrice.date).label('max_date')
+        ).filter(
+            AssetPrice.asset_id.in_(asset_ids)
+        ).group_by(AssetPrice.asset_id).subquery()
+
+        latest_prices = db.session.query(AssetPrice.asset_id, AssetPrice.close, AssetPrice.date).join(
+            latest_dates,
+            (AssetPrice.asset_id == latest_dates.c.asset_id) & (AssetPrice.date == latest_dates.c.max_date)
+        ).all()
+        return {asset_id: (close, date, None) for asset_id, close, date in latest_prices}
+
+    @staticmethod
+    def catalogue_page(limit, sort='ticker', descending=False, after=None, filters=None):
+        """
+        Page of the asset catalogue filtered and sorted in SQL,
+        filters: {column: [values]}, after: (sort value, id) of the last row of the previous page
+        """
+        column = getattr(Asset, sort)
+        key = func.coalesce(column, '') if column.nullable else column
+
+        query = Asset.query
+        for name, values in (filters or {}).items():
+            query = query.filter(getattr(Asset, name).in_(values))
+        if after:
+            after_value, after_id = after
+            if descending:
+                query = query.filter(db.or_(key < after_value, db.and_(key == after_value, Asset.id < after_id)))
+            else:
+                query = query.filter(db.or_(key > after_value, db.and_(key == after_value, Asset.id > after_id)))
+
+        order = (key.desc(), Asset.id.desc()) if descending else (key, Asset.id)
+        return query.order_by(*order).limit(limit).all()
+
+    def get_price_history(self, period='1m', start=None, end=None, interval='1d'):
+        """Price history of a period or of start-end dates, one dict per bar"""
+        from ..services.price_history import PriceHistoryService
+
+        frame = PriceHistoryService.get_history(self.id, period, start, end, interval)
+        return PriceHistoryService.to_records(frame)
 
     def get_latest_metrics(self):
         """Get latest metrics"""
         metrics = AssetMetric.query.filter_by(asset_id=self.id).order_by(AssetMetric.date.desc()).first()
-        if metrics:
-            return {
-                'date': metrics.date.isoformat(),
-                'pe_ratio': metrics.pe_ratio,
-                'pb_ratio': metrics.pb_ratio,
-                'dividend_yield': metrics.dividend_yield,
-                'market_cap': metrics.market_cap,
-                'eps': metrics.eps,
-                'revenue': metrics.revenue,
-                'profit_margin': metrics.profit_margin,
-                'debt_to_equity': metrics.debt_to_equity
-            }
-        return None
+        return metrics.to_dict() if metrics else None
 
-    def get_dividends(self):
-        """Get dividends"""
-        dividends = Dividend.query.filter_by(asset_id=self.id).order_by(Dividend.ex_date).all()
+    def get_dividends(self, since=None):
+        """Get dividends, from since on when given"""
+        query = Dividend.query.filter_by(asset_id=self.id)
+        if since is not None:
+            query = query.filter(Dividend.ex_date >= since)
+        dividends = query.order_by(Dividend.ex_date).all()
         return [
             {
                 'ex_date': div.ex_date.isoformat(),
@@ -87,8 +151,9 @@ class Asset(db.Model):
             for div in dividends
         ]
 
-    def to_dict(self, include_details=False):
-        """Convert to dict for API"""
+    def to_dict(self, include_details=False, prices=None):
+        """Convert to dict for API, prices: prefetched {asset_id: price}"""
+        current_price = prices.get(self.id) if prices is not None else self.get_current_price()
         result = {
             'id': self.id,
             'ticker': self.ticker,
@@ -98,13 +163,14 @@ class Asset(db.Model):
             'exchange': self.exchange,
             'sector': self.sector,
             'industry': self.industry,
-            'current_price': self.get_current_price()
+            'current_price': current_price
         }
 
         if include_details:
             result.update({
                 'metrics': self.get_latest_metrics(),
-                'dividends': self.get_dividends()
+                'dividends': self.get_dividends(
+                    datetime.utcnow().date() - timedelta(days=365 * DIVIDEND_DETAIL_YEARS))
             })
 
         return result
@@ -133,6 +199,40 @@ class AssetPrice(db.Model):
         return f'<AssetPrice {self.asset_id} on {self.date}>'
 
 
+class AssetQuote(db.Model):
+    """Latest quote of an asset, one row per asset written by the refreshes"""
+    __tablename__ = 'asset_quotes'
+
+    id = db.Column(db.Integer, primary_key=True)
+    asset_id = db.Column(db.Integer, db.ForeignKey('assets.id'), nullable=False)
+    price = db.Column(db.Numeric(15, 6), nullable=False)
+    session_date = db.Column(db.Date, nullable=False)  # Trading day the price belongs to
+    quoted_at = db.Column(db.DateTime, nullable=False)  # When it was fetched, UTC
+    source = db.Column(db.String(20), nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('asset_id', name='_asset_quote_uc'),)
+
+    def __repr__(self):
+        return f'<AssetQuote {self.asset_id} {self.price} on {self.session_date}>'
+
+
+class FxRate(db.Model):
+    """Daily exchange rate Model, value of one unit of currency in USD"""
+    __tablename__ = 'fx_rates'
+
+    id = db.Column(db.Integer, primary_key=True)
+    currency = db.Column(db.String(10), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    rate = db.Column(db.Numeric(20, 10), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('currency', 'date', name='_fx_currency_date_uc'),)
+
+    def __repr__(self):
+        return f'<FxRate {self.currency} {self.rate} on {self.date}>'
+
+
 class AssetMetric(db.Model):
     """Asset financial metrics Model"""
     __tablename__ = 'asset_metrics'
@@ -152,6 +252,56 @@ class AssetMetric(db.Model):
 
     __table_args__ = (db.UniqueConstraint('asset_id', 'date', name='_asset_metrics_date_uc'),)
 
+    @staticmethod
+    def screen(limit, sort='market_cap', descending=True, after=None, ranges=None, filters=None):
+        """
+        Page of [(Asset, AssetMetric)] ranked by a metric of the latest metrics
+        row of each asset, assets without that metric are left out.
+        ranges: {metric: (min or None, max or None)}, filters: {asset column: [values]},
+        after: (metric value, asset id) of the last row of the previous page
+        """
+        latest = db.session.query(
+            AssetMetric.asset_id, func.max(AssetMetric.date).label('date')
+        ).group_by(AssetMetric.asset_id).subquery()
+
+        column = getattr(AssetMetric, sort)
+        query = db.session.query(Asset, AssetMetric).join(
+            latest, latest.c.asset_id == Asset.id
+        ).join(
+            AssetMetric, (AssetMetric.asset_id == latest.c.asset_id) & (AssetMetric.date == latest.c.date)
+        ).filter(column.isnot(None))
+
+        for name, (low, high) in (ranges or {}).items():
+            if low is not None:
+                query = query.filter(getattr(AssetMetric, name) >= low)
+            if high is not None:
+                query = query.filter(getattr(AssetMetric, name) <= high)
+        for name, values in (filters or {}).items():
+            query = query.filter(getattr(Asset, name).in_(values))
+        if after:
+            after_value, after_id = after
+            if descending:
+                query = query.filter(db.or_(column < after_value, db.and_(column == after_value, Asset.id < after_id)))
+            else:
+                query = query.filter(db.or_(column > after_value, db.and_(column == after_value, Asset.id > after_id)))
+
+        order = (column.desc(), Asset.id.desc()) if descending else (column, Asset.id)
+        return query.order_by(*order).limit(limit).all()
+
+    def to_dict(self):
+        """Convert to dict for API"""
+        return {
+            'date': self.date.isoformat(),
+            'pe_ratio': self.pe_ratio,
+            'pb_ratio': self.pb_ratio,
+            'dividend_yield': self.dividend_yield,
+            'market_cap': self.market_cap,
+            'eps': self.eps,
+            'revenue': self.revenue,
+            'profit_margin': self.profit_margin,
+            'debt_to_equity': self.debt_to_equity
+        }
+
     def __repr__(self):
         return f'<AssetMetric {self.asset_id} on {self.date}>'
 
@@ -167,7 +317,7 @@ class Dividend(db.Model):
     amount = db.Column(db.Numeric(15, 6), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    asset = db.relationship('Asset', backref=db.backref('dividends', lazy=True, cascade='all, delete-orphan'))
+    __table_args__ = (db.UniqueConstraint('asset_id', 'ex_date', name='_asset_ex_date_uc'),)
 
     def __repr__(self):
         return f'<Dividend {self.asset_id} on {self.ex_date}>'
\ No newline at end of file
@@ -2,14 +2,13 @@
 Portfolio model
 """
 from datetime import datetime
-from sqlalchemy import func
 from ..extensions import db
 
 class Portfolio(db.Model):
-    __tablename__ = 'portfolio'
+    __tablename__ = 'portfolios'
 
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -17,50 +16,31 @@ class Portfolio(db.Model):
 
     #relations
     transactions = db.relationship('Transaction', backref='portfolio', lazy='dynamic', cascade='all, delete-orphan')
+    positions = db.relationship('Position', backref='portfolio', lazy='dynamic', cascade='all, delete-orphan')
+    snapshots = db.relationship('PortfolioSnapshot', backref='portfolio', lazy='dynamic', cascade='all, delete-orphan')
     analyses = db.relationship('PortfolioAnalysis', backref='portfolio', lazy='dynamic', cascade='all, delete-orphan')
 
-    def calculate_total_value(self):
-        """Total value of portfolio"""
-        from .asset import Asset
-        from .transaction import Transaction
-
-        total_value = 0
-
-        asset_holdings = db.session.query(
-            Transaction.asset_id,
-            func.sum(Transaction.quantity).label('total_quantity')
-        ).filter(
-            Transaction.portfolio_id == self.id
-        ).group_by(Transaction.asset_id).all()
+    __table_args__ = (db.Index('ix_portfolios_user_id', 'user_id'),)
 
+    def get_valuation(self, currency=None):
+        """Holdings and prices computed once, shared by all totals"""
+        from ..services.portfolio_service import PortfolioService
 
-        for asset_id, quantity in asset_holdings:
-            asset = Asset.query.get(asset_id)
-            if asset and quantity > 0:
-                current_price = asset.get_current_price()
-                total_value += current_price * quantity
+        return PortfolioService.value_portfolio(self, currency)
 
-        return total_value
-
-
-    def calculate_total_profit(self):
+    def calculate_total_value(self, valuation=None):
         """Total value of portfolio"""
-        from .transaction import Transaction
-
-        buy_transactions = Transaction.query.filter_by(portfolio_id=self.id, transaction_type='buy').all()
-        sell_transactions = Transaction.query.filter_by(portfolio_id=self.id, transaction_type='sell').all()
+        valuation = valuation or self.get_valuation()
+        return valuation.total_value
 
-        total_buy_cost = sum(t.price * t.quantity for t in buy_transactions)
-        total_sell_value = sum(t.price * t.quantity for t in sell_transactions)
+    def calculate_total_profit(self, valuation=None):
+        """Total profit of portfolio"""
+        valuation = valuation or self.get_valuation()
+        return valuation.total_profit
 
-        current_value = self.calculate_total_value()
-
-        total_profit = (current_value + total_sell_value) - total_buy_cost
-
-        return total_profit
-
-    def to_dict(self, include_assets=False):
+    def to_dict(self, include_assets=False, valuation=None):
         """Convert to dict for API"""
+        valuation = valuation or self.get_valuation()
         result = {
             'id': self.id,
             'user_id': self.user_id,
@@ -68,57 +48,101 @@ class Portfolio(db.Model):
             'description': self.description,
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat(),
-            'total_value': self.calculate_total_value(),
-            'total_profit': self.calculate_total_profit()
+            'currency': valuation.currency,
+            'total_value': self.calculate_total_value(valuation),
+            'total_profit': self.calculate_total_profit(valuation),
+            # Holdings without an exchange rate to currency, the totals are None while there are any
+            'missing_fx_rates': valuation.missing_rates
         }
 
         if include_assets:
-            result['assets'] = self.get_assets_summary()
+            result['assets'] = self.get_assets_summary(valuation)
 
         return result
 
-    def get_assets_summary(self):
-        from .asset import Asset
-        from .transaction import Transaction
-
-        # Grouped data
-        asset_holdings = db.session.query(
-            Transaction.asset_id,
-            func.sum(Transaction.quantity).label('total_quantity')
-        ).filter(
-            Transaction.portfolio_id == self.id
-        ).group_by(Transaction.asset_id).all()
-
-        assets_summary = []
-
-        for asset_id, quantity in asset_holdings:
-            if quantity <= 0:  # Skip sold assets
-                continue
-
-            asset = Asset.query.get(asset_id)
-
-            # Average buy price
-            buy_transactions = Transaction.query.filter_by(
-                portfolio_id=self.id, asset_id=asset_id, transaction_type='buy').all()
-            total_cost = sum(t.price * t.quantity for t in buy_transactions)
-            total_bought = sum(t.quantity for t in buy_transactions)
-            avg_buy_price = total_cost / total_bought if total_bought > 0 else 0
-
-            current_price = asset.get_current_price()
-            profit_percent = ((current_price / avg_buy_price) - 1) * 100 if avg_buy_price > 0 else 0
-
-            assets_summary.append({
-                'asset_id': asset_id,
-                'ticker': asset.ticker,
-                'name': asset.name,
-                'quantity': quantity,
-                'avg_buy_price': avg_buy_price,
-                'current_price': current_price,
-                'total_value': current_price * quantity,
-                'profit_percent': profit_percent
-            })
-
-        return assets_summary
+    def get_assets_summary(self, valuation=None):
+        valuation = valuation or self.get_valuation()
+        return valuation.assets_summary
 
     def __repr__(self):
         return f'<Portfolio {self.name} of User {self.user_id}>'
+
+
+class Position(db.Model):
+    """Materialized position Model, maintained on every transaction write"""
+    __tablename__ = 'positions'
+
+    id = db.Column(db.Integer, primary_key=True)
+    portfolio_id = db.Column(db.Integer, db.ForeignKey('portfolios.id'), nullable=False)
+    asset_id = db.Column(db.Integer, db.ForeignKey('assets.id'), nullable=False)
+    quantity = db.Column(db.Numeric(20, 6), nullable=False, default=0)
+    cost_basis = db.Column(db.Numeric(20, 6), nullable=False, default=0)  # Average cost of the open quantity
+    realized_pnl = db.Column(db.Numeric(20, 6), nullable=False, default=0)
+    last_trade_date = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    asset = db.relationship('Asset')
+
+    __table_args__ = (db.UniqueConstraint('portfolio_id', 'asset_id', name='_portfolio_asset_uc'),)
+
+    def __repr__(self):
+        return f'<Position {self.asset_id} in Portfolio {self.portfolio_id}>'
+
+
+class PortfolioSnapshot(db.Model):
+    """Daily portfolio value snapshot Model"""
+    __tablename__ = 'portfolio_snapshots'
+
+    id = db.Column(db.Integer, primary_key=True)
+    portfolio_id = db.Column(db.Integer, db.ForeignKey('portfolios.id'), nullable=False)
+    currency = db.Column(db.String(10), nullable=False, default='USD', server_default='USD')
+    date = db.Column(db.Date, nullable=False)
+    value = db.Column(db.Numeric(20, 6), nullable=False)
+    cost_basis = db.Column(db.Numeric(20, 6), nullable=False)  # Net amount invested up to the day
+    cash_flow = db.Column(db.Numeric(20, 6), nullable=False)  # Net amount invested on the day
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('portfolio_id', 'currency', 'date', name='_portfolio_currency_date_uc'),)
+
+    def to_dict(self):
+        """Convert to dict for API"""
+        return {
+            'date': self.date.isoformat(),
+            'currency': self.currency,
+            'value': float(self.value),
+            'cost_basis': float(self.cost_basis),
+            'cash_flow': float(self.cash_flow)
+        }
+
+    def __repr__(self):
+        return f'<PortfolioSnapshot {self.portfolio_id} on {self.date}>'
+
+
+class PortfolioAnalysis(db.Model):
+    """Portfolio risk and return analysis Model"""
+    __tablename__ = 'portfolio_analyses'
+
+    id = db.Column(db.Integer, primary_key=True)
+    portfolio_id = db.Column(db.Integer, db.ForeignKey('portfolios.id'), nullable=False)
+    benchmark = db.Column(db.String(20))
+    period_days = db.Column(db.Integer, nullable=False)
+    # Hash of the holdings and latest price date the results were computed from
+    signature = db.Column(db.String(64), nullable=False)
+    results = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_portfolio_analyses_signature', 'portfolio_id', 'signature', 'created_at'),)
+
+    def to_dict(self):
+        """Convert to dict for API"""
+        return {
+            'id': self.id,
+            'portfolio_id': self.portfolio_id,
+            'benchmark': self.benchmark,
+            'period_days': self.period_days,
+            'created_at': self.created_at.isoformat(),
+            **self.results
+        }
+
+    def __repr__(self):
+        return f'<PortfolioAnalysis {self.portfolio_id} at {self.created_at}>'
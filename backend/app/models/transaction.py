@@ -20,9 +20,33 @@ class Transaction(db.Model):
     notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_transactions_portfolio_asset_type', 'portfolio_id', 'asset_id', 'transaction_type'),
+        # Date-ordered history and keyset pages of a portfolio
+        db.Index('ix_transactions_portfolio_date', 'portfolio_id', 'transaction_date', 'id'),
+    )
+
+    @staticmethod
+    def keyset_page(portfolio_id, limit, after=None):
+        """
+        Newest-first page of a portfolio's transactions with their assets joined,
+        after: (transaction_date, id) of the last row of the previous page
+        """
+        from sqlalchemy.orm import joinedload
+
+        query = Transaction.query.options(joinedload(Transaction.asset)).filter(
+            Transaction.portfolio_id == portfolio_id)
+        if after:
+            after_date, after_id = after
+            query = query.filter(db.or_(
+                Transaction.transaction_date < after_date,
+                db.and_(Transaction.transaction_date == after_date, Transaction.id < after_id)
+            ))
+        return query.order_by(Transaction.transaction_date.desc(), Transaction.id.desc()).limit(limit).all()
+
     def calculate_total(self):
         """Total transaction amount"""
-        return float(self.price * self.quantity + self.fee)
+        return float(self.price * self.quantity + (self.fee or 0))
 
     def to_dict(self, include_asset=False):
         """Convert to dict for API"""
@@ -33,7 +57,7 @@ class Transaction(db.Model):
             'transaction_type': self.transaction_type,
             'quantity': float(self.quantity),
             'price': float(self.price),
-            'fee': float(self.fee),
+            'fee': float(self.fee or 0),
             'total': self.calculate_total(),
             'transaction_date': self.transaction_date.isoformat(),
             'notes': self.notes,
@@ -0,0 +1,155 @@
+"""
+Service for portfolio analytics over AssetPrice history
+"""
+import hashlib
+import json
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from flask import current_app
+from sqlalchemy import delete, func
+from ..extensions import db
+from ..models.asset import Asset, AssetPrice
+from ..models.portfolio import PortfolioAnalysis
+from .portfolio_service import PortfolioService
+
+TRADING_DAYS = 252
+
+
+class PortfolioAnalyticsService:
+    """Returns, volatility, drawdown, Sharpe/Sortino, beta and correlations of a portfolio"""
+
+    @staticmethod
+    def analyze(portfolio, benchmark=None, period_days=365):
+        """
+        Analysis of the current holdings over the last period_days, reused
+        from portfolio_analyses while holdings and prices are unchanged. Only
+        the latest ANALYTICS_HISTORY analyses of a portfolio are kept
+        """
+        benchmark = (benchmark or current_app.config['ANALYTICS_BENCHMARK']).upper()
+        holdings = [
+            h for h in PortfolioService.get_holdings([portfolio.id]).get(portfolio.id, [])
+            if h['quantity'] > 0
+        ]
+        assets = {h['asset'].id: h['asset'] for h in holdings}
+        benchmark_asset = Asset.query.filter_by(ticker=benchmark).first()
+        asset_ids = list(assets) + ([benchmark_asset.id] if benchmark_asset else [])
+
+        latest_date = db.session.query(func.max(AssetPrice.date)).filter(
+            AssetPrice.asset_id.in_(asset_ids)).scalar() if asset_ids else None
+        signature = hashlib.sha256(json.dumps({
+            'holdings': sorted((h['asset'].id, h['quantity']) for h in holdings),
+            'benchmark': benchmark_asset.id if benchmark_asset else None,
+            'latest_date': latest_date.isoformat() if latest_date else None
+        }).encode()).hexdigest()
+
+        analysis = PortfolioAnalysis.query.filter_by(
+            portfolio_id=portfolio.id, benchmark=benchmark, period_days=period_days, signature=signature
+        ).order_by(PortfolioAnalysis.created_at.desc()).first()
+        if analysis:
+            return analysis
+
+        closes = PortfolioAnalyticsService.load_closes(asset_ids, latest_date, period_days)
+        quantities = pd.Series({h['asset'].id: h['quantity'] for h in holdings}, dtype=float)
+        results = PortfolioAnalyticsService.compute_metrics(
+            closes.reindex(columns=list(assets)),
+            quantities,
+            closes[benchmark_asset.id] if benchmark_asset and benchmark_asset.id in closes else None,
+            current_app.config['ANALYTICS_RISK_FREE_RATE']
+        )
+        results['correlation'] = {
+            assets[a].ticker: {assets[b].ticker: value for b, value in row.items()}
+            for a, row in results['correlation'].items()
+        }
+
+        analysis = PortfolioAnalysis(
+            portfolio_id=portfolio.id, benchmark=benchmark, period_days=period_days,
+            signature=signature, results=results
+        )
+        db.session.add(analysis)
+        db.session.flush()
+        PortfolioAnalyticsService.prune(portfolio.id, current_app.config['ANALYTICS_HISTORY'])
+        db.session.commit()
+        return analysis
+
+    @staticmethod
+    def prune(portfolio_id, keep):
+        """Delete all but the keep latest analyses of a portfolio"""
+        # Ids are read first, MySQL can neither LIMIT an IN subquery nor select from the table it deletes from
+        stale = [analysis_id for (analysis_id,) in db.session.query(PortfolioAnalysis.id).filter(
+            PortfolioAnalysis.portfolio_id == portfolio_id
+        ).order_by(PortfolioAnalysis.created_at.desc(), PortfolioAnalysis.id.desc()).offset(keep)]
+        if stale:
+            db.session.execute(delete(PortfolioAnalysis).where(PortfolioAnalysis.id.in_(stale)))
+
+    @staticmethod
+    def load_closes(asset_ids, latest_date, period_days):
+        """Aligned close matrix (date x asset_id) from one query, gaps carried forward"""
+        if not asset_ids or latest_date is None:
+            return pd.DataFrame(columns=asset_ids, dtype=float)
+
+        rows = db.session.query(AssetPrice.date, AssetPrice.asset_id, AssetPrice.close).filter(
+            AssetPrice.asset_id.in_(asset_ids),
+            AssetPrice.date > latest_date - timedelta(days=period_days)
+        ).all()
+        frame = pd.DataFrame(rows, columns=['date', 'asset_id', 'close'])
+        frame['close'] = frame['close'].astype(float)
+        closes = frame.pivot_table(index='date', columns='asset_id', values='close', aggfunc='last')
+        return closes.sort_index().ffill().reindex(columns=asset_ids)
+
+    @staticmethod
+    def compute_metrics(closes, quantities, benchmark_closes=None, risk_free_rate=0.0):
+        """
+        Metrics of a constant-quantity portfolio, all vectorized
+        closes: DataFrame (date x asset), quantities: Series indexed like closes.columns.
+        Assets without any close are left out, the series starts on the first
+        day every other one has a close
+        """
+        closes = closes.dropna(axis=1, how='all').ffill().dropna(how='any')
+        if len(closes) < 2 or quantities.empty:
+            return {
+                'observations': 0, 'total_return': None, 'annualized_return': None,
+                'annualized_volatility': None, 'max_drawdown': None, 'sharpe_ratio': None,
+                'sortino_ratio': None, 'beta': None, 'correlation': {}
+            }
+
+        values = closes.to_numpy() @ quantities.reindex(closes.columns).fillna(0.0).to_numpy()
+        returns = values[1:] / values[:-1] - 1
+        returns = returns[np.isfinite(returns)]
+
+        mean = returns.mean()
+        volatility = returns.std(ddof=1) * np.sqrt(TRADING_DAYS)
+        annualized_return = mean * TRADING_DAYS
+        downside = np.sqrt(np.mean(np.minimum(returns, 0.0) ** 2)) * np.sqrt(TRADING_DAYS)
+        drawdowns = values / np.maximum.accumulate(values) - 1
+
+        beta = None
+        if benchmark_closes is not None:
+            benchmark_values = benchmark_closes.reindex(closes.index).ffill().to_numpy()
+            benchmark_returns = benchmark_values[1:] / benchmark_values[:-1] - 1
+            portfolio_returns = values[1:] / values[:-1] - 1
+            mask = np.isfinite(benchmark_returns) & np.isfinite(portfolio_returns)
+            if mask.sum() > 1:
+                covariance = np.cov(portfolio_returns[mask], benchmark_returns[mask])
+                beta = covariance[0, 1] / covariance[1, 1] if covariance[1, 1] > 0 else None
+
+        asset_returns = closes.replace(0.0, np.nan).pct_change(fill_method=None).iloc[1:]
+        correlation = asset_returns.corr().round(6)
+
+        def clean(value):
+            return round(float(value), 6) if value is not None and np.isfinite(value) else None
+
+        return {
+            'observations': int(len(returns)),
+            'total_return': clean(values[-1] / values[0] - 1) if values[0] else None,
+            'annualized_return': clean(annualized_return),
+            'annualized_volatility': clean(volatility),
+            'max_drawdown': clean(drawdowns.min()),
+            'sharpe_ratio': clean((annualized_return - risk_free_rate) / volatility) if volatility > 0 else None,
+            'sortino_ratio': clean((annualized_return - risk_free_rate) / downside) if downside > 0 else None,
+            'beta': clean(beta) if beta is not None else None,
+            'correlation': {
+                a: {b: (None if pd.isna(v) else float(v)) for b, v in row.items()}
+                for a, row in correlation.to_dict(orient='index').items()
+            }
+        }
@@ -0,0 +1,411 @@
+"""
+Caching: a two-tier backend (per-worker LRU in front of Redis) and
+stampede protection for upstream calls
+"""
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from flask_caching.backends.rediscache import RedisCache
+
+
+class LocalLRUCache:
+    """Size-bounded in-memory cache with a TTL per entry"""
+
+    def __init__(self, maxsize=1024, ttl=5):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """(found, value) of a live entry"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[0] <= time.monotonic():
+                del self.entries[key]
+                return False, None
+            self.entries.move_to_end(key)
+            return True, entry[1]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if not ttl or ttl <= 0 else min(ttl, self.ttl)
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class TwoTierRedisCache(RedisCache):
+    """
+    Flask-Caching Redis backend with a per-worker LRU tier in front of it.
+    Local entries live at most CACHE_LOCAL_TTL seconds, and every write or
+    delete is published on a Redis channel so other workers drop their copy.
+    Values from the local tier are shared objects and must not be mutated.
+    """
+
+    def __init__(self, *args, local_size=1024, local_ttl=5, channel='cache:invalidate', **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local = LocalLRUCache(local_size, local_ttl)
+        self.channel = channel
+        self.origin = uuid.uuid4().hex
+        self.counters = {'local_hits': 0, 'local_misses': 0, 'redis_hits': 0, 'redis_misses': 0}
+        self.counters_lock = threading.Lock()
+        self.subscriber = None
+        self.subscriber_pid = None
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs.update(
+            local_size=config.get('CACHE_LOCAL_SIZE', 1024),
+            local_ttl=config.get('CACHE_LOCAL_TTL', 5),
+            channel=config.get('CACHE_INVALIDATION_CHANNEL', 'cache:invalidate')
+        )
+        return super().factory(app, config, args, kwargs)
+
+    # Statistics
+
+    def _count(self, **increments):
+        with self.counters_lock:
+            for name, value in increments.items():
+                self.counters[name] += value
+
+    def stats(self):
+        """Hit and miss counters of each tier"""
+        with self.counters_lock:
+            counters = dict(self.counters)
+        return {
+            'local': {'hits': counters['local_hits'], 'misses': counters['local_misses'], 'size': len(self.local)},
+            'redis': {'hits': counters['redis_hits'], 'misses': counters['redis_misses']}
+        }
+
+    # Invalidation
+
+    def _ensure_subscribed(self):
+        """Listen for invalidations, once per process (gunicorn forks after import)"""
+        if self.subscriber_pid == os.getpid():
+            return
+        self.subscriber_pid = os.getpid()
+        self.local.clear()
+        try:
+            pubsub = self._read_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: self._on_invalidate})
+            self.subscriber = pubsub.run_in_thread(sleep_time=1, daemon=True)
+        except Exception as e:
+            # Local entries still expire after their short TTL
+            print(f"Error subscribing to cache invalidations: {e}")
+
+    def _on_invalidate(self, message):
+        try:
+            data = json.loads(message['data'])
+        except (TypeError, ValueError):
+            return
+        if data.get('origin') == self.origin:
+            return
+        if data.get('clear'):
+            self.local.clear()
+        else:
+            self.local.delete(*data.get('keys', []))
+
+    def _publish(self, keys=None, clear=False):
+        try:
+            self._write_client.publish(
+                self.channel, json.dumps({'origin': self.origin, 'keys': list(keys or []), 'clear': clear}))
+        except Exception as e:
+            print(f"Error publishing cache invalidation: {e}")
+
+    # Reads
+
+    def get(self, key):
+        self._ensure_subscribed()
+        found, value = self.local.get(key)
+        if found:
+            self._count(local_hits=1)
+            return value
+
+        value = super().get(key)
+        self._count(local_misses=1, redis_hits=value is not None, redis_misses=value is None)
+        if value is not None:
+            self.local.set(key, value)
+        return value
+
+    def get_many(self, *keys):
+        self._ensure_subscribed()
+        values = {}
+        missing = []
+        for key in keys:
+            found, value = self.local.get(key)
+            if found:
+                values[key] = value
+            else:
+                missing.append(key)
+
+        if missing:
+            for key, value in zip(missing, super().get_many(*missing)):
+                values[key] = value
+                if value is not None:
+                    self.local.set(key, value)
+
+        redis_hits = sum(1 for key in missing if values[key] is not None)
+        self._count(
+            local_hits=len(keys) - len(missing), local_misses=len(missing),
+            redis_hits=redis_hits, redis_misses=len(missing) - redis_hits
+        )
+        return [values[key] for key in keys]
+
+    def has(self, key):
+        found, _ = self.local.get(key)
+        return found or super().has(key)
+
+    # Writes
+
+    def set(self, key, value, timeout=None):
+        result = super().set(key, value, timeout=timeout)
+        self.local.set(key, value, self._normalize_timeout(timeout))
+        self._publish([key])
+        return result
+
+    def add(self, key, value, timeout=None):
+        result = super().add(key, value, timeout=timeout)
+        if result:
+            self.local.set(key, value, self._normalize_timeout(timeout))
+            self._publish([key])
+        return result
+
+    def set_many(self, mapping, timeout=None):
+        result = super().set_many(mapping, timeout=timeout)
+        ttl = self._normalize_timeout(timeout)
+        for key, value in mapping.items():
+            self.local.set(key, value, ttl)
+        self._publish(mapping.keys())
+        return result
+
+    def delete(self, key):
+        self.local.delete(key)
+        result = super().delete(key)
+        self._publish([key])
+        return result
+
+    def delete_many(self, *keys):
+        self.local.delete(*keys)
+        result = super().delete_many(*keys)
+        self._publish(keys)
+        return result
+
+    def inc(self, key, delta=1):
+        self.local.delete(key)
+        result = super().inc(key, delta=delta)
+        self._publish([key])
+        return result
+
+    def dec(self, key, delta=1):
+        self.local.delete(key)
+        result = super().dec(key, delta=delta)
+        self._publish([key])
+        return result
+
+    def clear(self):
+        self.local.clear()
+        result = super().clear()
+        self._publish(clear=True)
+        return result
+
+
+# Stampede protection
+
+_local_locks = {}
+_local_locks_guard = threading.Lock()
+
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def _redis_client():
+    """Redis client of the configured cache backend, None for non-Redis backends"""
+    from ..extensions import cache
+
+    return getattr(cache.cache, '_write_client', None)
+
+
+def acquire_lock(key, timeout=30):
+    """
+    Try to take the lock of a cache key without blocking, returns a token or None.
+    A Redis lock when the cache is Redis-backed, so it holds across workers,
+    otherwise an in-process one.
+    """
+    token = uuid.uuid4().hex
+    client = _redis_client()
+    if client is not None:
+        try:
+            return token if client.set(f'lock:{key}', token, nx=True, ex=timeout) else None
+        except Exception as e:
+            print(f"Error taking lock for {key}, using local lock: {e}")
+
+    with _local_locks_guard:
+        lock = _local_locks.get(key)
+        if lock and lock[1] > time.monotonic():
+            return None
+        _local_locks[key] = (token, time.monotonic() + timeout)
+    return token
+
+
+def release_lock(key, token):
+    with _local_locks_guard:
+        lock = _local_locks.get(key)
+        if lock and lock[0] == token:
+            del _local_locks[key]
+            return
+
+    client = _redis_client()
+    if client is not None:
+        try:
+            client.eval(_RELEASE_SCRIPT, 1, f'lock:{key}', token)
+        except Exception as e:
+            print(f"Error releasing lock for {key}: {e}")
+
+
+def single_flight(timeout, grace=0, lock_timeout=30, wait=5, negative_timeout=5):
+    """
+    Cache a single-argument upstream call with request coalescing.
+    Fresh values are served for timeout seconds, then for another grace
+    seconds the stale value is served while exactly one caller (holding the
+    lock of the key) refreshes it. On a cold miss one caller fetches and the
+    others wait up to wait seconds for its result. A None result of a cold
+    miss is cached for negative_timeout seconds, so the waiters get it rather
+    than all fetching; a failed refresh keeps the stale value.
+    """
+    from ..extensions import cache
+
+    def decorator(f):
+        prefix = f'{f.__module__}.{f.__qualname__}'
+
+        def make_cache_key(arg):
+            return f'{prefix}:{arg}'
+
+        def store_many(values):
+            """Cache {arg: value} as fresh entries"""
+            expires_at = time.time() + timeout
+            entries = {
+                make_cache_key(arg): {'value': value, 'expires_at': expires_at}
+                for arg, value in values.items() if value is not None
+            }
+            if entries:
+                try:
+                    cache.set_many(entries, timeout=timeout + grace)
+                except Exception as e:
+                    print(f"Error caching {prefix}: {e}")
+
+        def store_missing(args):
+            """Cache None for args upstream had no value of"""
+            expires_at = time.time() + negative_timeout
+            try:
+                cache.set_many(
+                    {make_cache_key(arg): {'value': None, 'expires_at': expires_at} for arg in args},
+                    timeout=negative_timeout
+                )
+            except Exception as e:
+                print(f"Error caching {prefix}: {e}")
+
+        def lookup_many(args):
+            """{arg: cache entry} of the cached args"""
+            try:
+                entries = cache.get_many(*[make_cache_key(arg) for arg in args])
+            except Exception as e:
+                print(f"Error reading cache for {prefix}: {e}")
+                return {}
+            return {arg: entry for arg, entry in zip(args, entries) if entry is not None}
+
+        def get_many(args, fetch_many):
+            """
+            Values for many args: fresh cache hits as they are, one batched
+            fetch_many(args) -> {arg: value} for whatever this caller has to refresh
+            """
+            args = list(dict.fromkeys(args))
+            now = time.time()
+            entries = lookup_many(args)
+            values = {arg: entry['value'] for arg, entry in entries.items() if entry['expires_at'] > now}
+
+            locks = {}
+            waiting = []
+            for arg in args:
+                if arg in values:
+                    continue
+                token = acquire_lock(make_cache_key(arg), lock_timeout)
+                if token:
+                    locks[arg] = token
+                elif arg in entries:
+                    values[arg] = entries[arg]['value']  # stale, someone else is refreshing
+                else:
+                    waiting.append(arg)
+
+            try:
+                if locks:
+                    fetched = fetch_many(list(locks))
+                    store_many(fetched)
+                    missing = [
+                        arg for arg in locks
+                        if fetched.get(arg) is None and entries.get(arg, {}).get('value') is None
+                    ]
+                    if missing:
+                        store_missing(missing)
+                    for arg in locks:
+                        value = fetched.get(arg)
+                        if value is None and arg in entries:
+                            value = entries[arg]['value']  # keep serving stale on upstream failure
+                        values[arg] = value
+            finally:
+                for arg, token in locks.items():
+                    release_lock(make_cache_key(arg), token)
+
+            if waiting:
+                deadline = time.monotonic() + wait
+                while waiting and time.monotonic() < deadline:
+                    time.sleep(0.05)
+                    for arg, entry in lookup_many(waiting).items():
+                        values[arg] = entry['value']
+                    waiting = [arg for arg in waiting if arg not in values]
+                if waiting:
+                    # The other caller failed or is too slow, fetch without the lock
+                    fetched = fetch_many(waiting)
+                    store_many(fetched)
+                    values.update(fetched)
+
+            return {arg: values.get(arg) for arg in args}
+
+        @functools.wraps(f)
+        def decorated(arg):
+            return get_many([arg], lambda missing: {a: f(a) for a in missing})[arg]
+
+        decorated.uncached = f
+        decorated.cache_timeout = timeout
+        decorated.make_cache_key = make_cache_key
+        decorated.store_many = store_many
+        decorated.get_many = get_many
+        # Cached values, fresh or stale, without ever calling f
+        decorated.peek_many = lambda args: {arg: entry['value'] for arg, entry in lookup_many(list(args)).items()}
+        decorated.delete = lambda arg: cache.delete(make_cache_key(arg))
+        return decorated
+
+    return decorator
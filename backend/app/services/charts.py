@@ -0,0 +1,115 @@
+"""
+Service for downsampled chart series
+"""
+import numpy as np
+from ..extensions import cache
+from .price_history import PriceHistoryService
+from .snapshots import SnapshotService
+
+METHODS = ('lttb', 'minmax')
+CHART_CACHE_TIMEOUT = 300
+
+
+def lttb(x, y, threshold):
+    """
+    Indices of the points kept by Largest-Triangle-Three-Buckets. Each
+    bucket keeps the point forming the largest triangle with the point kept
+    before it and the mean of the next bucket. Bucket means come from
+    cumulative sums and each bucket is scored with one array operation.
+    """
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # Buckets between the fixed first and last points
+    edges = (np.arange(threshold - 1) * ((n - 2) / (threshold - 2))).astype(int) + 1
+    edges[-1] = n - 1
+    cum_x = np.concatenate(([0.0], np.cumsum(x)))
+    cum_y = np.concatenate(([0.0], np.cumsum(y)))
+    sizes = edges[1:] - edges[:-1]
+    mean_x = (cum_x[edges[1:]] - cum_x[edges[:-1]]) / sizes
+    mean_y = (cum_y[edges[1:]] - cum_y[edges[:-1]]) / sizes
+    # The next bucket of the last one is the last point
+    next_x = np.append(mean_x[1:], x[-1])
+    next_y = np.append(mean_y[1:], y[-1])
+
+    selected = np.empty(threshold, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        area = np.abs((x[a] - next_x[i]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y[i] - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def minmax(y, threshold):
+    """Indices of the minimum and maximum of each of threshold / 2 buckets, plus both ends"""
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    buckets = np.arange(n) * (threshold // 2) // n
+    order = np.lexsort((y, buckets))
+    sorted_buckets = buckets[order]
+    first = np.flatnonzero(np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]])
+    last = np.r_[first[1:] - 1, n - 1]
+    return np.unique(np.concatenate(([0, n - 1], order[first], order[last])))
+
+
+class ChartService:
+    """Series downsampled to a target number of points"""
+
+    @staticmethod
+    def downsample(dates, values, points, method='lttb'):
+        """(dates, values) reduced to about points points"""
+        if method not in METHODS:
+            raise ValueError(f"method must be one of {', '.join(METHODS)}")
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return [], []
+
+        if method == 'lttb':
+            keep = lttb(np.array([d.toordinal() for d in dates], dtype=float), values, points)
+        else:
+            keep = minmax(values, points)
+
+        return [dates[i] for i in keep], values[keep]
+
+    @staticmethod
+    def asset_series(asset_id, period='1y', start=None, end=None, points=500, method='lttb'):
+        """
+        Downsampled close series of an asset, cached by (asset, range, resolution)
+        """
+        start, end = PriceHistoryService.resolve_range(period, start, end)
+        key = f'chart:asset:{asset_id}:{start}:{end}:{points}:{method}'
+        series = cache.get(key)
+        if series is not None:
+            return series
+
+        frame = PriceHistoryService.load(asset_id, start, end)
+        dates, closes = ChartService.downsample(list(frame.index.date), frame['close'].to_numpy(), points, method)
+        series = ChartService.to_series(dates, closes, 'close')
+        try:
+            cache.set(key, series, timeout=CHART_CACHE_TIMEOUT)
+        except Exception as e:
+            print(f"Error caching chart of asset {asset_id}: {e}")
+        return series
+
+    @staticmethod
+    def portfolio_series(portfolio_id, start=None, end=None, points=500, method='lttb', currency=None):
+        """
+        Downsampled value series of a portfolio in currency. Not cached,
+        snapshots are already materialized and change with every transaction write
+        """
+        snapshots = SnapshotService.get_history(portfolio_id, start, end, currency)
+        dates, values = ChartService.downsample(
+            [snapshot.date for snapshot in snapshots], [float(snapshot.value) for snapshot in snapshots],
+            points, method)
+        return ChartService.to_series(dates, values, 'value')
+
+    @staticmethod
+    def to_series(dates, values, name):
+        """Parallel arrays"""
+        return {'date': [d.isoformat() for d in dates], name: [float(value) for value in values]}
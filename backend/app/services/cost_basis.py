@@ -0,0 +1,270 @@
+"""
+Lot-level cost basis engine (FIFO / LIFO / average cost)
+"""
+import copy
+from bisect import bisect_left
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from ..extensions import db, cache
+from ..models.asset import Asset
+from ..models.transaction import Transaction
+from .positions import ZERO, _decimal
+
+METHODS = ('fifo', 'lifo', 'average')
+STATE_TIMEOUT = 24 * 3600
+
+
+class LotBook:
+    """
+    Open lots of one position. Lots are kept as prefix sums of quantity and
+    cost in buy order, so a sell finds the lots it consumes with a binary
+    search instead of walking them: O(log n) per sell, O(1) per buy.
+    FIFO consumes from the front (a consumed-quantity offset), LIFO from the
+    back (truncating the prefix sums), average cost keeps one pooled lot.
+    Sells beyond the open quantity are not tracked as short lots.
+    """
+
+    def __init__(self, method='fifo'):
+        if method not in METHODS:
+            raise ValueError(f"method must be one of {', '.join(METHODS)}")
+        self.method = method
+        self.cum_quantity = [ZERO]
+        self.cum_cost = [ZERO]
+        self.dates = [None]
+        self.consumed = ZERO  # FIFO: quantity matched from the front
+        self.realized_pnl = ZERO
+        self.fees = ZERO
+
+    @property
+    def quantity(self):
+        return self.cum_quantity[-1] - self.consumed
+
+    @property
+    def cost_basis(self):
+        return self.cum_cost[-1] - self._cost_at(self.consumed)
+
+    def _cost_at(self, quantity):
+        """Cost of the first quantity units in buy order"""
+        if quantity <= 0:
+            return ZERO
+        i = bisect_left(self.cum_quantity, quantity)
+        if i >= len(self.cum_quantity):
+            return self.cum_cost[-1]
+        lot_quantity = self.cum_quantity[i] - self.cum_quantity[i - 1]
+        lot_cost = self.cum_cost[i] - self.cum_cost[i - 1]
+        return self.cum_cost[i - 1] + (quantity - self.cum_quantity[i - 1]) * lot_cost / lot_quantity
+
+    def buy(self, quantity, price, fee=0, date=None):
+        quantity, price, fee = _decimal(quantity), _decimal(price), _decimal(fee)
+        self.fees += fee
+        if quantity <= 0:
+            return
+        cost = quantity * price + fee
+        if self.method == 'average' and len(self.cum_quantity) > 1:
+            self.cum_quantity[-1] += quantity
+            self.cum_cost[-1] += cost
+            self.dates[-1] = date
+            return
+        self.cum_quantity.append(self.cum_quantity[-1] + quantity)
+        self.cum_cost.append(self.cum_cost[-1] + cost)
+        self.dates.append(date)
+
+    def sell(self, quantity, price, fee=0, date=None):
+        """Match a sell against the open lots, returns its realized P&L"""
+        quantity, price, fee = _decimal(quantity), _decimal(price), _decimal(fee)
+        held = self.quantity
+        matched = min(quantity, held) if held > 0 else ZERO
+
+        if self.method == 'fifo':
+            start = self.consumed
+            self.consumed += matched
+            cost = self._cost_at(self.consumed) - self._cost_at(start)
+            self._compact()
+        elif self.method == 'lifo':
+            start = self.cum_quantity[-1] - matched
+            cost = self.cum_cost[-1] - self._cost_at(start)
+            self._truncate(start)
+        else:
+            cost = self.cost_basis * matched / held if held > 0 else ZERO
+            self.cum_quantity[-1] -= matched
+            self.cum_cost[-1] = self.cum_cost[-1] - cost if self.cum_quantity[-1] > 0 else ZERO
+
+        realized = quantity * price - fee - cost
+        self.realized_pnl += realized
+        self.fees += fee
+        return realized
+
+    def _truncate(self, quantity):
+        """Keep only the first quantity units in buy order (LIFO)"""
+        cost = self._cost_at(quantity)
+        i = bisect_left(self.cum_quantity, quantity)
+        del self.cum_quantity[i + 1:], self.cum_cost[i + 1:], self.dates[i + 1:]
+        if i > 0:
+            # Lot i is partially sold
+            self.cum_quantity[i] = quantity
+            self.cum_cost[i] = cost
+
+    def _compact(self):
+        """Drop fully consumed FIFO lots once they are half of the book, amortized O(1)"""
+        i = bisect_left(self.cum_quantity, self.consumed)
+        if i < len(self.cum_quantity) and self.cum_quantity[i] == self.consumed:
+            i += 1  # lot i is fully consumed too
+        if i <= 1 or i * 2 < len(self.cum_quantity):
+            return
+        base_quantity, base_cost = self.cum_quantity[i - 1], self.cum_cost[i - 1]
+        self.cum_quantity = [ZERO] + [q - base_quantity for q in self.cum_quantity[i:]]
+        self.cum_cost = [ZERO] + [c - base_cost for c in self.cum_cost[i:]]
+        self.dates = [None] + self.dates[i:]
+        self.consumed -= base_quantity
+
+    def open_lots(self):
+        """Open lots in buy order with their remaining quantity and cost"""
+        lots = []
+        for i in range(1, len(self.cum_quantity)):
+            low = max(self.cum_quantity[i - 1], self.consumed)
+            high = self.cum_quantity[i]
+            if high <= low:
+                continue
+            lots.append({
+                'date': self.dates[i].isoformat() if self.dates[i] else None,
+                'quantity': float(high - low),
+                'cost': float(self._cost_at(high) - self._cost_at(low))
+            })
+        return lots
+
+
+class CostBasisService:
+    """Lot books of a portfolio, advanced incrementally from a cached state"""
+
+    @staticmethod
+    def state_key(portfolio_id, method):
+        return f'cost_basis:{portfolio_id}:{method}'
+
+    @staticmethod
+    def get_books(portfolio_id, method='fifo'):
+        """
+        {asset_id: LotBook} of a portfolio. The cached books remember the last
+        transaction they processed and only trades added since are applied,
+        a back-dated trade replays the history. Updates and deletes of
+        transactions, and inserts with an id below the cursor, drop the
+        cached books on commit. The books returned may be shared with the
+        local cache tier, callers never mutate them
+        """
+        key = CostBasisService.state_key(portfolio_id, method)
+        state = cache.get(key) or {'books': {}, 'last_id': 0, 'last_date': None}
+
+        trades = db.session.query(
+            Transaction.id, Transaction.asset_id, Transaction.transaction_type, Transaction.quantity,
+            Transaction.price, Transaction.fee, Transaction.transaction_date
+        ).filter(
+            Transaction.portfolio_id == portfolio_id, Transaction.id > state['last_id']
+        ).order_by(Transaction.transaction_date, Transaction.id).all()
+        if not trades:
+            return state['books']
+
+        if state['last_date'] and trades[0].transaction_date < state['last_date']:
+            cache.delete(key)
+            return CostBasisService.get_books(portfolio_id, method)
+
+        # Values of the local cache tier are shared, copied only when trades are applied
+        state = copy.deepcopy(state)
+        CostBasisService.apply(state['books'], trades, method)
+        state['last_id'] = max(state['last_id'], max(trade.id for trade in trades))
+        state['last_date'] = trades[-1].transaction_date
+        try:
+            cache.set(key, state, timeout=STATE_TIMEOUT)
+        except Exception as e:
+            print(f"Error caching cost basis of portfolio {portfolio_id}: {e}")
+        return state['books']
+
+    @staticmethod
+    def apply(books, trades, method):
+        """Apply trades in date order to {asset_id: LotBook}"""
+        for trade in trades:
+            book = books.get(trade.asset_id)
+            if book is None:
+                book = books[trade.asset_id] = LotBook(method)
+            if trade.transaction_type == 'buy':
+                book.buy(trade.quantity, trade.price, trade.fee, trade.transaction_date)
+            else:
+                book.sell(trade.quantity, trade.price, trade.fee, trade.transaction_date)
+        return books
+
+    @staticmethod
+    def invalidate(portfolio_id):
+        cache.delete_many(*[CostBasisService.state_key(portfolio_id, method) for method in METHODS])
+
+    @staticmethod
+    def invalidate_inserted(portfolio_id, first_id):
+        """
+        Drop the cached books already past first_id, the lowest id of trades
+        just committed. Ids are allocated before commit, a trade committed
+        after a higher id was read would never reach the books otherwise
+        """
+        for method in METHODS:
+            key = CostBasisService.state_key(portfolio_id, method)
+            state = cache.get(key)
+            if state and state['last_id'] >= first_id:
+                cache.delete(key)
+
+    @staticmethod
+    def summary(portfolio_id, method='fifo', include_lots=False):
+        """Quantity, cost basis, realized and unrealized P&L per asset"""
+        books = CostBasisService.get_books(portfolio_id, method)
+        assets = Asset.query.filter(Asset.id.in_(books)).all() if books else []
+        prices = Asset.get_current_prices([asset for asset in assets if books[asset.id].quantity > 0])
+
+        result = []
+        for asset in sorted(assets, key=lambda asset: asset.ticker):
+            book = books[asset.id]
+            quantity, cost_basis = float(book.quantity), float(book.cost_basis)
+            price = prices.get(asset.id)
+            row = {
+                'asset_id': asset.id,
+                'ticker': asset.ticker,
+                'quantity': quantity,
+                'cost_basis': cost_basis,
+                'avg_buy_price': cost_basis / quantity if quantity > 0 else 0,
+                'current_price': price,
+                'realized_pnl': float(book.realized_pnl),
+                'unrealized_pnl': price * quantity - cost_basis if price is not None else None,
+                'fees': float(book.fees)
+            }
+            if include_lots:
+                row['lots'] = book.open_lots()
+            result.append(row)
+        return result
+
+
+@event.listens_for(Session, 'before_flush')
+def collect_changed_portfolios(session, flush_context, instances):
+    """Updated or deleted trades invalidate the cached books of their portfolio"""
+    changed = session.info.setdefault('cost_basis_changed', set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Transaction) and (obj in session.deleted or session.is_modified(obj)):
+            changed.add(obj.portfolio_id)
+            history = db.inspect(obj).attrs.portfolio_id.history
+            changed.update(history.deleted)
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_inserted_trades(session, flush_context):
+    """Lowest id of the trades inserted per portfolio, known once flushed"""
+    inserted = session.info.setdefault('cost_basis_inserted', {})
+    for obj in session.new:
+        if isinstance(obj, Transaction) and obj.id is not None:
+            inserted[obj.portfolio_id] = min(obj.id, inserted.get(obj.portfolio_id, obj.id))
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_changed_portfolios(session):
+    for portfolio_id in session.info.pop('cost_basis_changed', set()):
+        CostBasisService.invalidate(portfolio_id)
+    for portfolio_id, first_id in session.info.pop('cost_basis_inserted', {}).items():
+        CostBasisService.invalidate_inserted(portfolio_id, first_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changed_portfolios(session):
+    session.info.pop('cost_basis_changed', None)
+    session.info.pop('cost_basis_inserted', None)
@@ -0,0 +1,194 @@
+"""
+Service for portfolio dividend income
+"""
+import math
+import uuid
+from collections import defaultdict
+from datetime import date, timedelta
+from sqlalchemy import case, event, func
+from sqlalchemy.orm import Session
+from ..extensions import db, cache
+from ..models.asset import Asset, Dividend
+from ..models.portfolio import Position
+from ..models.transaction import Transaction
+from .fx import FxService
+
+INCOME_TIMEOUT = 24 * 3600
+# Bumped when dividends are ingested, cached income computed before is stale
+VERSION_KEY = 'dividend_income:version'
+
+
+def _next_year(day):
+    """Same day a year later, Feb 29 moves to Feb 28"""
+    try:
+        return day.replace(year=day.year + 1)
+    except ValueError:
+        return day.replace(year=day.year + 1, day=28)
+
+
+class DividendService:
+    """
+    Trailing 12-month dividend income of the portfolio and projected income
+    of its current holdings. Computed from set-based joins of positions and
+    transactions against dividends and cached until the next dividend ingest
+    or transaction change
+    """
+
+    @staticmethod
+    def income_key(portfolio_id):
+        return f'dividend_income:{portfolio_id}'
+
+    @staticmethod
+    def version():
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            version = uuid.uuid4().hex
+            cache.set(VERSION_KEY, version, timeout=0)
+        return version
+
+    @staticmethod
+    def get_income(portfolio_id, today=None):
+        """
+        Per-asset income and projected schedule in each asset's currency:
+        {'assets': [...], 'schedule': {(month, currency): amount}}.
+        Trailing income pays the quantity held on each ex-date, positions
+        closed since included; the projection is forward looking, the current
+        quantity times every payment of the last 12 months
+        """
+        today = today or date.today()
+        key = DividendService.income_key(portfolio_id)
+        version = DividendService.version()
+        cached = cache.get(key)
+        if cached and cached['version'] == version and cached['date'] == today:
+            return cached['income']
+
+        in_window = (Dividend.ex_date > today - timedelta(days=365)) & (Dividend.ex_date <= today)
+        current = db.session.query(
+            Position.asset_id, Asset.ticker, Asset.currency, Position.quantity, Dividend.ex_date, Dividend.amount
+        ).join(
+            Asset, Asset.id == Position.asset_id
+        ).join(
+            Dividend, Dividend.asset_id == Position.asset_id
+        ).filter(
+            Position.portfolio_id == portfolio_id,
+            Position.quantity > 0,
+            in_window
+        ).all()
+
+        # Quantity held at the close before each ex-date, trades of the ex-date itself do not count
+        held_quantity = func.sum(case(
+            (Transaction.transaction_type == 'sell', -Transaction.quantity),
+            else_=Transaction.quantity
+        ))
+        held = db.session.query(
+            Dividend.asset_id, Asset.ticker, Asset.currency, held_quantity, Dividend.ex_date, Dividend.amount
+        ).join(
+            Asset, Asset.id == Dividend.asset_id
+        ).join(
+            Transaction,
+            (Transaction.asset_id == Dividend.asset_id) & (Transaction.portfolio_id == portfolio_id)
+            & (Transaction.transaction_date < Dividend.ex_date)
+        ).filter(
+            in_window
+        ).group_by(
+            Dividend.id, Dividend.asset_id, Asset.ticker, Asset.currency, Dividend.ex_date, Dividend.amount
+        ).having(held_quantity > 0).all()
+
+        assets = {}
+        payments = defaultdict(dict)
+        schedule = defaultdict(float)
+
+        def asset_row(asset_id, ticker, currency):
+            return assets.setdefault(asset_id, {
+                'asset_id': asset_id,
+                'ticker': ticker,
+                'currency': currency,
+                'quantity': 0.0,
+                'trailing_income': 0.0
+            })
+
+        for asset_id, ticker, currency, quantity, ex_date, amount in current:
+            asset_row(asset_id, ticker, currency)['quantity'] = float(quantity)
+            payments[asset_id][ex_date] = float(amount)
+            # Each payment of the last 12 months is expected again a year later
+            schedule[(_next_year(ex_date).strftime('%Y-%m'), currency)] += float(amount) * float(quantity)
+
+        for asset_id, ticker, currency, quantity, ex_date, amount in held:
+            asset_row(asset_id, ticker, currency)['trailing_income'] += float(amount) * float(quantity)
+            payments[asset_id][ex_date] = float(amount)
+
+        for asset_id, row in assets.items():
+            row['payments'] = len(payments[asset_id])
+            row['trailing_per_share'] = sum(payments[asset_id].values())
+            row['last_ex_date'] = max(payments[asset_id]).isoformat()
+            row['projected_income'] = row['trailing_per_share'] * row['quantity']
+
+        income = {'assets': sorted(assets.values(), key=lambda row: row['ticker']), 'schedule': dict(schedule)}
+        try:
+            cache.set(key, {'version': version, 'date': today, 'income': income}, timeout=INCOME_TIMEOUT)
+        except Exception as e:
+            print(f"Error caching dividend income of portfolio {portfolio_id}: {e}")
+        return income
+
+    @staticmethod
+    def summary(portfolio_id, currency=None):
+        """Dividend income converted to currency (default BASE_CURRENCY)"""
+        currency = FxService.base_currency(currency)
+        income = DividendService.get_income(portfolio_id)
+        rates = FxService.rates_to(currency, {row['currency'] for row in income['assets']})
+
+        # Income in a currency without a known rate is left out of the totals
+        rates = {code: rate for code, rate in rates.items() if not math.isnan(rate)}
+
+        assets = []
+        for row in income['assets']:
+            rate = rates.get(row['currency'])
+            assets.append(dict(
+                row, fx_rate=rate, base_trailing_income=row['trailing_income'] * rate if rate is not None else None))
+
+        schedule = defaultdict(float)
+        for (month, code), amount in income['schedule'].items():
+            if code in rates:
+                schedule[month] += amount * rates[code]
+
+        return {
+            'currency': currency,
+            'trailing_12m': sum(row['base_trailing_income'] for row in assets
+                                if row['base_trailing_income'] is not None),
+            'projected_12m': sum(schedule.values()),
+            'assets': assets,
+            'schedule': [{'month': month, 'amount': schedule[month]} for month in sorted(schedule)]
+        }
+
+    @staticmethod
+    def invalidate(portfolio_id):
+        cache.delete(DividendService.income_key(portfolio_id))
+
+    @staticmethod
+    def invalidate_all():
+        """Dividends changed, every cached income is stale"""
+        cache.set(VERSION_KEY, uuid.uuid4().hex, timeout=0)
+
+
+@event.listens_for(Session, 'before_flush')
+def collect_changed_holdings(session, flush_context, instances):
+    """New, updated or deleted trades change the holdings the income is computed from"""
+    changed = session.info.setdefault('dividend_income_changed', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Transaction) and obj.portfolio_id is not None:
+            changed.add(obj.portfolio_id)
+            changed.update(db.inspect(obj).attrs.portfolio_id.history.deleted)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_changed_income(session):
+    for portfolio_id in session.info.pop('dividend_income_changed', set()):
+        DividendService.invalidate(portfolio_id)
+    if session.info.pop('dividends_changed', False):
+        DividendService.invalidate_all()
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changed_income(session):
+    session.info.pop('dividend_income_changed', None)
+    session.info.pop('dividends_changed', None)
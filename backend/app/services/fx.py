@@ -0,0 +1,179 @@
+"""
+Service for exchange rates and conversion to a base currency
+"""
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+from flask import current_app
+from sqlalchemy import func
+from ..extensions import db, cache
+from ..models.asset import FxRate
+from ..utils.db import upsert
+from .market_calendar import MarketCalendar
+from .yahoo_finance import YahooFinanceService
+
+# Currency every rate is stored against
+PIVOT = 'USD'
+# Minor units some exchanges are quoted in: code -> (currency, units per currency)
+MINOR_UNITS = {'GBp': ('GBP', 100), 'GBX': ('GBP', 100), 'ZAc': ('ZAR', 100), 'ILA': ('ILS', 100)}
+# Days of rates before a range used to carry the last rate forward
+RATE_LOOKBACK_DAYS = 14
+# History fetched the first time a currency is seen
+RATE_HISTORY_DAYS = 365
+FX_CACHE_TIMEOUT = 300
+# A missing range of rates goes upstream at most once per interval (seconds)
+FX_SYNC_INTERVAL = 3600
+
+
+class FxService:
+    """Daily rates against USD in fx_rates, cross rates derived from them"""
+
+    @staticmethod
+    def base_currency(currency=None):
+        """currency, or the configured BASE_CURRENCY"""
+        return currency or current_app.config.get('BASE_CURRENCY', PIVOT)
+
+    @staticmethod
+    def is_valid(currency):
+        return isinstance(currency, str) and len(currency) == 3 and currency.isalpha()
+
+    @staticmethod
+    def split(code):
+        """(currency rates are stored for, units of code per unit of that currency)"""
+        return MINOR_UNITS.get(code, (code.upper(), 1))
+
+    @staticmethod
+    def sync(codes, start=None):
+        """
+        Fetch the missing daily rates of codes in one batched download: back
+        to start (or RATE_HISTORY_DAYS) for currencies without rates that far
+        back, from the day after the last stored rate for stale ones.
+        Returns the number of rates written
+        """
+        currencies = sorted({FxService.split(code)[0] for code in codes} - {PIVOT})
+        if not currencies:
+            return 0
+
+        bounds = {
+            currency: (first, last) for currency, first, last in db.session.query(
+                FxRate.currency, func.min(FxRate.date), func.max(FxRate.date)
+            ).filter(FxRate.currency.in_(currencies)).group_by(FxRate.currency)
+        }
+        history_start = (start or date.today() - timedelta(days=RATE_HISTORY_DAYS)) - timedelta(
+            days=RATE_LOOKBACK_DAYS)
+        last_session = MarketCalendar.last_closed_session()
+        gaps = {}
+        for currency in currencies:
+            first, last = bounds.get(currency, (None, None))
+            if first is None or (start and first > start):
+                gaps[currency] = history_start
+            elif last < last_session:
+                gaps[currency] = last + timedelta(days=1)
+
+        # Rates missing upstream too are not asked for again on every request
+        gaps = {
+            currency: since for currency, since in gaps.items()
+            if cache.add(f'fx:sync:{currency}:{since.isoformat()}', True, timeout=FX_SYNC_INTERVAL)
+        }
+        if not gaps:
+            return 0
+
+        tickers = {f'{currency}{PIVOT}=X': currency for currency in gaps}
+        bars = YahooFinanceService._download_bars(list(tickers), start=min(gaps.values()))
+        rows = [
+            {'currency': tickers[ticker], 'date': day.date(), 'rate': float(close)}
+            for ticker, frame in bars.items() for day, close in frame['Close'].items()
+        ]
+        if not rows:
+            print(f"No exchange rates found for {', '.join(tickers)}")
+            return 0
+
+        upsert(FxRate, rows, index_elements=['currency', 'date'], update_columns=['rate'])
+        db.session.commit()
+        return len(rows)
+
+    @staticmethod
+    def usd_rates(currencies, day=None):
+        """Latest rate on or before day (default: latest) of each currency: {currency: float}"""
+        currencies = list(currencies)
+        if not currencies:
+            return {}
+
+        latest = db.session.query(
+            FxRate.currency, func.max(FxRate.date).label('date')
+        ).filter(FxRate.currency.in_(currencies))
+        if day is not None:
+            latest = latest.filter(FxRate.date <= day)
+        latest = latest.group_by(FxRate.currency).subquery()
+
+        rates = db.session.query(FxRate.currency, FxRate.rate).join(
+            latest, (FxRate.currency == latest.c.currency) & (FxRate.date == latest.c.date)
+        )
+        return {currency: float(rate) for currency, rate in rates}
+
+    @staticmethod
+    def matrix(codes, day=None):
+        """
+        (codes, matrix): amount * matrix[i, j] converts an amount in codes[i]
+        to codes[j], from the rates as of day (default: latest, synced
+        first). Cached once every rate is known, NaN where one is missing
+        """
+        codes = tuple(sorted(set(codes)))
+        key = f"fx:matrix:{day.isoformat() if day else 'latest'}:{','.join(codes)}"
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+        currencies = {FxService.split(code)[0] for code in codes} - {PIVOT}
+        if day is None:
+            FxService.sync(currencies)
+        usd = FxService.usd_rates(currencies, day)
+        usd[PIVOT] = 1.0
+
+        in_usd = np.array([usd.get(currency, np.nan) / units for currency, units in map(FxService.split, codes)])
+        result = (codes, in_usd[:, None] / in_usd[None, :])
+        if not np.isnan(in_usd).any():
+            try:
+                cache.set(key, result, timeout=FX_CACHE_TIMEOUT)
+            except Exception as e:
+                print(f"Error caching exchange rates of {', '.join(codes)}: {e}")
+        return result
+
+    @staticmethod
+    def rates_to(currency, codes, day=None):
+        """Factor converting an amount in each of codes to currency: {code: float, NaN without a rate}"""
+        codes = set(codes)
+        if codes <= {currency}:
+            return {currency: 1.0}
+
+        codes, matrix = FxService.matrix(codes | {currency}, day)
+        return dict(zip(codes, matrix[:, codes.index(currency)].tolist()))
+
+    @staticmethod
+    def history(codes, currency, start, end):
+        """
+        Factor converting an amount in each of codes to currency on every day
+        from start to end, the last known rate carried over weekends and
+        holidays: DataFrame (day x code)
+        """
+        days = pd.date_range(start, end, freq='D')
+        codes = sorted(set(codes) | {currency})
+        currencies = sorted({FxService.split(code)[0] for code in codes} - {PIVOT})
+
+        rows = db.session.query(FxRate.date, FxRate.currency, FxRate.rate).filter(
+            FxRate.currency.in_(currencies),
+            FxRate.date >= start - timedelta(days=RATE_LOOKBACK_DAYS),
+            FxRate.date <= end
+        ).all() if currencies else []
+        frame = pd.DataFrame(rows, columns=['date', 'currency', 'rate'])
+        frame['date'] = pd.to_datetime(frame['date'])
+        frame['rate'] = frame['rate'].astype(float)
+        usd = frame.pivot_table(index='date', columns='currency', values='rate', aggfunc='last')
+        usd = usd.reindex(usd.index.union(days)).ffill().reindex(index=days, columns=currencies)
+        usd[PIVOT] = 1.0
+
+        in_usd = pd.DataFrame(
+            {code: usd[major] / units for code, (major, units) in zip(codes, map(FxService.split, codes))},
+            index=days
+        )
+        return in_usd.div(in_usd[currency], axis=0)
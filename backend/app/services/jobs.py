@@ -0,0 +1,190 @@
+"""
+Asynchronous asset sync jobs
+"""
+import json
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+
+class MemoryJobBackend:
+    """In-process job store running jobs on a thread pool, for tests and single-process setups"""
+
+    def __init__(self, runner, max_workers):
+        self.runner = runner
+        self.jobs = {}
+        self.active = {}  # ticker -> job id
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sync-job')
+
+    def claim(self, ticker, job):
+        """Store a new job unless the ticker already has one queued or running"""
+        with self.lock:
+            active_id = self.active.get(ticker)
+            if active_id:
+                return dict(self.jobs[active_id])
+            self.active[ticker] = job['id']
+            self.jobs[job['id']] = job
+        self.executor.submit(self.runner, dict(job))
+        return dict(job)
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def update(self, job_id, **fields):
+        with self.lock:
+            if job_id in self.jobs:
+                self.jobs[job_id].update(fields)
+
+    def release(self, ticker, job_id):
+        with self.lock:
+            if self.active.get(ticker) == job_id:
+                del self.active[ticker]
+
+
+class RedisJobBackend:
+    """
+    Redis job store, jobs are consumed from a list by the worker process.
+    The ticker key holds a queued job for ttl, a taken job only for a lease
+    its worker keeps renewing, so a dead worker frees the ticker
+    """
+
+    QUEUE_KEY = 'sync:queue'
+
+    def __init__(self, url, ttl, lease=120):
+        import redis
+
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.ttl = ttl
+        self.lease = lease
+
+    @staticmethod
+    def job_key(job_id):
+        return f'sync:job:{job_id}'
+
+    @staticmethod
+    def ticker_key(ticker):
+        return f'sync:ticker:{ticker}'
+
+    def claim(self, ticker, job):
+        """Store and queue a new job unless the ticker already has one queued or running"""
+        if self.redis.set(self.ticker_key(ticker), job['id'], nx=True, ex=self.ttl):
+            pipe = self.redis.pipeline()
+            pipe.set(self.job_key(job['id']), json.dumps(job), ex=self.ttl)
+            pipe.rpush(self.QUEUE_KEY, job['id'])
+            pipe.execute()
+            return job
+
+        active_id = self.redis.get(self.ticker_key(ticker))
+        return self.get(active_id) or dict(job, id=active_id)
+
+    def get(self, job_id):
+        data = self.redis.get(self.job_key(job_id)) if job_id else None
+        return json.loads(data) if data else None
+
+    def update(self, job_id, **fields):
+        job = self.get(job_id)
+        if job:
+            job.update(fields)
+            self.redis.set(self.job_key(job_id), json.dumps(job), ex=self.ttl)
+
+    def release(self, ticker, job_id):
+        if self.redis.get(self.ticker_key(ticker)) == job_id:
+            self.redis.delete(self.ticker_key(ticker))
+
+    def renew(self, ticker, job_id):
+        """Extend the lease of a taken job on its ticker"""
+        if self.redis.get(self.ticker_key(ticker)) == job_id:
+            self.redis.expire(self.ticker_key(ticker), self.lease)
+
+    def next_job(self, timeout):
+        item = self.redis.blpop(self.QUEUE_KEY, timeout=timeout)
+        job = self.get(item[1]) if item else None
+        if job:
+            self.renew(job['ticker'], job['id'])
+        return job
+
+
+class SyncJobQueue:
+    """
+    Queue of asset sync jobs with status tracking and per-ticker deduplication.
+    Redis-backed by default, SYNC_JOBS_BACKEND='memory' runs jobs in-process.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        if app.config.get('SYNC_JOBS_BACKEND', 'redis') == 'redis':
+            self.backend = RedisJobBackend(
+                app.config['REDIS_URL'], app.config.get('SYNC_JOB_TTL', 24 * 3600),
+                app.config.get('SYNC_JOB_LEASE', 120)
+            )
+        else:
+            self.backend = MemoryJobBackend(self.run_job, app.config.get('SYNC_JOBS_WORKERS', 2))
+        app.extensions['sync_jobs'] = self
+
+    def enqueue(self, ticker):
+        """Queue a sync of ticker, or return the job already queued or running for it"""
+        job = {
+            'id': uuid.uuid4().hex,
+            'ticker': ticker,
+            'status': 'queued',
+            'error': None,
+            'created_at': datetime.utcnow().isoformat(),
+            'finished_at': None
+        }
+        return self.backend.claim(ticker, job)
+
+    def enqueue_many(self, tickers):
+        return [self.enqueue(ticker) for ticker in dict.fromkeys(tickers)]
+
+    def get(self, job_id):
+        return self.backend.get(job_id)
+
+    def run_job(self, job):
+        """Run one sync job and record its outcome"""
+        from ..extensions import db
+        from .yahoo_finance import YahooFinanceService
+
+        self.backend.update(job['id'], status='running')
+        done = threading.Event()
+        if isinstance(self.backend, RedisJobBackend):
+            threading.Thread(target=self.keep_lease, args=(job, done), daemon=True).start()
+        try:
+            with self.app.app_context():
+                try:
+                    YahooFinanceService.sync_asset(job['ticker'])
+                finally:
+                    db.session.remove()
+            self.backend.update(job['id'], status='finished', finished_at=datetime.utcnow().isoformat())
+        except Exception as e:
+            print(f"Error syncing {job['ticker']}: {e}")
+            self.backend.update(job['id'], status='failed', error=str(e),
+                                finished_at=datetime.utcnow().isoformat())
+        finally:
+            done.set()
+            self.backend.release(job['ticker'], job['id'])
+
+    def keep_lease(self, job, done):
+        """Renew the job's lease on its ticker until it is done"""
+        interval = max(1, self.backend.lease / 3)
+        while not done.wait(interval):
+            try:
+                self.backend.renew(job['ticker'], job['id'])
+            except Exception as e:
+                print(f"Error renewing sync job lease of {job['ticker']}: {e}")
+
+    def work(self, timeout=5):
+        """Consume the Redis queue forever, run by the worker process"""
+        while True:
+            job = self.backend.next_job(timeout)
+            if job:
+                self.run_job(job)
@@ -0,0 +1,100 @@
+"""
+Trading calendar used to decide whether a stored quote is current
+"""
+from datetime import date, datetime, time, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+from pandas.tseries.holiday import (
+    AbstractHolidayCalendar, Holiday, GoodFriday, USMartinLutherKingJr, USPresidentsDay,
+    USMemorialDay, USLaborDay, USThanksgivingDay, nearest_workday, sunday_to_monday
+)
+
+
+class NYSEHolidayCalendar(AbstractHolidayCalendar):
+    """Full-day NYSE holidays, early closes are treated as regular sessions"""
+    rules = [
+        # Not observed on the Friday before when it falls on a Saturday
+        Holiday('New Years Day', month=1, day=1, observance=sunday_to_monday),
+        USMartinLutherKingJr,
+        USPresidentsDay,
+        GoodFriday,
+        USMemorialDay,
+        Holiday('Juneteenth', month=6, day=19, start_date='2022-01-01', observance=nearest_workday),
+        Holiday('Independence Day', month=7, day=4, observance=nearest_workday),
+        USLaborDay,
+        USThanksgivingDay,
+        Holiday('Christmas Day', month=12, day=25, observance=nearest_workday),
+    ]
+
+
+class MarketCalendar:
+    """
+    NYSE sessions, 9:30 to 16:00 America/New_York on weekdays that are not
+    holidays. Used for every asset, whatever its exchange.
+    """
+
+    TIMEZONE = ZoneInfo('America/New_York')
+    OPEN = time(9, 30)
+    CLOSE = time(16, 0)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def holidays(year):
+        return frozenset(
+            day.date() for day in NYSEHolidayCalendar().holidays(date(year, 1, 1), date(year, 12, 31))
+        )
+
+    @staticmethod
+    def is_session(day):
+        return day.weekday() < 5 and day not in MarketCalendar.holidays(day.year)
+
+    @staticmethod
+    def local_now(now=None):
+        """now (naive UTC or aware, default current time) in exchange time"""
+        now = now or datetime.now(timezone.utc)
+        if now.tzinfo is None:
+            now = now.replace(tzinfo=timezone.utc)
+        return now.astimezone(MarketCalendar.TIMEZONE)
+
+    @staticmethod
+    def is_open(now=None):
+        local = MarketCalendar.local_now(now)
+        return MarketCalendar.is_session(local.date()) and MarketCalendar.OPEN <= local.time() < MarketCalendar.CLOSE
+
+    @staticmethod
+    def last_closed_session(now=None):
+        """Latest session whose close has passed"""
+        local = MarketCalendar.local_now(now)
+        day = local.date()
+        if local.time() < MarketCalendar.CLOSE:
+            day -= timedelta(days=1)
+        while not MarketCalendar.is_session(day):
+            day -= timedelta(days=1)
+        return day
+
+    @staticmethod
+    def is_current(session_date, quoted_at=None, now=None, max_age=900):
+        """
+        Whether a quote of session_date, fetched at quoted_at (naive UTC), is
+        current. While the market is open only a quote of today's session
+        younger than max_age seconds is, otherwise the close of the last
+        session is: a Friday close stays current over the weekend, holidays
+        and the next pre-market. A quote fetched before its session closed
+        is an intraday price, never the close.
+        """
+        if session_date is None:
+            return False
+        if MarketCalendar.is_open(now):
+            local = MarketCalendar.local_now(now)
+            if session_date != local.date():
+                return False
+            if quoted_at is None:
+                return True  # a stored bar of today, no fetch time to judge by
+            age = local - MarketCalendar.local_now(quoted_at)
+            return age.total_seconds() <= max_age
+        if session_date < MarketCalendar.last_closed_session(now):
+            return False
+        if quoted_at is None:
+            return True
+        close = datetime.combine(session_date, MarketCalendar.CLOSE, MarketCalendar.TIMEZONE)
+        return MarketCalendar.local_now(quoted_at) >= close
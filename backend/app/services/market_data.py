@@ -0,0 +1,282 @@
+"""
+Pluggable market data providers
+"""
+import json
+import os
+import re
+import time
+import zlib
+from datetime import date, timedelta
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+# First day of every synthetic series, so a ticker's walk is the same whatever range is asked for
+SYNTHETIC_EPOCH = date(2010, 1, 4)
+SYNTHETIC_SECTORS = ('Technology', 'Healthcare', 'Financial Services', 'Energy', 'Consumer Defensive', 'Industrials')
+# Ticker suffix -> currency of synthetic assets, the rest are USD
+SUFFIX_CURRENCIES = {'.L': 'GBp', '.DE': 'EUR', '.PA': 'EUR', '.AS': 'EUR', '.T': 'JPY', '.TO': 'CAD'}
+PERIOD_UNITS = {'d': 1, 'wk': 7, 'mo': 31, 'y': 366}
+
+
+class MarketDataProvider:
+    """
+    Upstream market data behind YahooFinanceService. ticker() returns a
+    handle the sub-steps of one sync share, history, info and dividends
+    take it
+    """
+
+    name = None
+
+    def ticker(self, ticker):
+        raise NotImplementedError
+
+    def quote(self, ticker):
+        """Latest close of a ticker, None when unknown"""
+        raise NotImplementedError
+
+    def bars(self, tickers, period='5d', start=None):
+        """Daily Open/High/Low/Close/Volume bars (of period, or since start) of many tickers: {ticker: DataFrame}"""
+        raise NotImplementedError
+
+    def history(self, ticker_data, period='1y', start=None):
+        """Daily bars of one ticker, of period or since start"""
+        raise NotImplementedError
+
+    def info(self, ticker_data):
+        """Profile and fundamentals, keyed like Yahoo's .info payload"""
+        raise NotImplementedError
+
+    def dividends(self, ticker_data):
+        """Amount paid per share, indexed by ex-date"""
+        raise NotImplementedError
+
+    def search(self, query, limit=10):
+        """[{'ticker', 'name', 'exchange', 'type'}] matching query"""
+        raise NotImplementedError
+
+
+class LocalTicker:
+    """Handle of a ticker served by the local provider"""
+
+    def __init__(self, ticker):
+        self.ticker = ticker
+
+
+class LocalProvider(MarketDataProvider):
+    """
+    Offline provider for load tests: bars, dividends and info from fixture
+    files when the directory has them, deterministic synthetic random walks
+    otherwise, each call delayed by latency seconds.
+
+    Fixture layout: prices/<TICKER>.parquet|csv (Date, Open, High, Low,
+    Close, Volume), dividends/<TICKER>.parquet|csv (Date, Dividends) and
+    info.json ({ticker: info})
+    """
+
+    name = 'local'
+
+    def __init__(self, path=None, latency=0.0, seed=0):
+        self.path = path
+        self.latency = latency
+        self.seed = seed
+        self.infos = {}
+        if path and os.path.exists(os.path.join(path, 'info.json')):
+            with open(os.path.join(path, 'info.json')) as f:
+                self.infos = json.load(f)
+        self._frames = lru_cache(maxsize=1024)(self._load_frames)
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def ticker(self, ticker):
+        return LocalTicker(ticker)
+
+    def quote(self, ticker):
+        self.wait()
+        prices, _ = self._frames(ticker, date.today())
+        return float(prices['Close'].iloc[-1]) if not prices.empty else None
+
+    def bars(self, tickers, period='5d', start=None):
+        self.wait()
+        bars = {}
+        for ticker in tickers:
+            frame = self._slice(self._frames(ticker, date.today())[0], period, start)
+            if not frame.empty:
+                bars[ticker] = frame
+        return bars
+
+    def history(self, ticker_data, period='1y', start=None):
+        self.wait()
+        return self._slice(self._frames(ticker_data.ticker, date.today())[0], period, start)
+
+    def info(self, ticker_data):
+        self.wait()
+        ticker = ticker_data.ticker
+        if ticker in self.infos:
+            return self.infos[ticker]
+
+        prices, dividends = self._frames(ticker, date.today())
+        if prices.empty:
+            return None
+
+        rng = self._rng(ticker, 'info')
+        close = float(prices['Close'].iloc[-1])
+        eps = close / rng.uniform(8, 40)
+        yearly_dividend = float(dividends[dividends.index > prices.index[-1] - pd.Timedelta(days=365)].sum())
+        shares = rng.uniform(5e7, 5e9)
+        return {
+            'longName': f'{ticker} Synthetic Inc.',
+            'shortName': ticker,
+            'currency': self._currency(ticker),
+            'exchange': 'LOCAL',
+            'quoteType': 'CURRENCY' if ticker.endswith('=X') else 'EQUITY',
+            'sector': SYNTHETIC_SECTORS[int(rng.integers(len(SYNTHETIC_SECTORS)))],
+            'industry': '',
+            'trailingPE': close / eps,
+            'trailingEps': eps,
+            'priceToBook': rng.uniform(0.5, 15),
+            'dividendYield': yearly_dividend / close if yearly_dividend else None,
+            'marketCap': close * shares,
+            'totalRevenue': eps * shares * rng.uniform(3, 12),
+            'profitMargins': rng.uniform(0.02, 0.35),
+            'debtToEquity': rng.uniform(0, 200)
+        }
+
+    def dividends(self, ticker_data):
+        self.wait()
+        return self._frames(ticker_data.ticker, date.today())[1]
+
+    def search(self, query, limit=10):
+        self.wait()
+        query = query.strip()
+        if not query:
+            return []
+        known = sorted(set(self.infos) | set(self._fixture_tickers()))
+        matches = [ticker for ticker in known if query.lower() in ticker.lower()
+                   or query.lower() in str(self.infos.get(ticker, {}).get('longName', '')).lower()]
+        # Anything else is served as a synthetic ticker
+        matches = matches or [query.upper()]
+        return [
+            {
+                'ticker': ticker,
+                'name': self.infos.get(ticker, {}).get('longName', f'{ticker} Synthetic Inc.'),
+                'exchange': self.infos.get(ticker, {}).get('exchange', 'LOCAL'),
+                'type': self.infos.get(ticker, {}).get('quoteType', 'EQUITY')
+            }
+            for ticker in matches[:limit]
+        ]
+
+    def _rng(self, ticker, stream):
+        """Generator seeded from the ticker, stable across processes"""
+        return np.random.default_rng([self.seed, zlib.crc32(f'{ticker}:{stream}'.encode())])
+
+    @staticmethod
+    def _currency(ticker):
+        for suffix, currency in SUFFIX_CURRENCIES.items():
+            if ticker.endswith(suffix):
+                return currency
+        return 'USD'
+
+    def _fixture_tickers(self):
+        if not self.path or not os.path.isdir(os.path.join(self.path, 'prices')):
+            return []
+        return [os.path.splitext(name)[0] for name in os.listdir(os.path.join(self.path, 'prices'))]
+
+    def _read_fixture(self, kind, ticker):
+        """Fixture frame indexed by date, None when there is no file"""
+        if not self.path:
+            return None
+        for extension, reader in (('.parquet', pd.read_parquet), ('.csv', pd.read_csv)):
+            file = os.path.join(self.path, kind, f'{ticker}{extension}')
+            if os.path.exists(file):
+                frame = reader(file)
+                if 'Date' in frame.columns:
+                    frame = frame.set_index('Date')
+                frame.index = pd.to_datetime(frame.index)
+                return frame.sort_index()
+        return None
+
+    def _load_frames(self, ticker, today):
+        """(bars, dividends) of a ticker up to today, from fixtures or synthetic"""
+        prices = self._read_fixture('prices', ticker)
+        dividends = self._read_fixture('dividends', ticker)
+        if prices is None:
+            prices = self._random_walk(ticker, today)
+        prices = prices[prices.index.date <= today]
+        if dividends is None:
+            dividends = self._synthetic_dividends(ticker, prices)
+        else:
+            dividends = dividends['Dividends']
+        return prices, dividends[dividends.index.date <= today]
+
+    def _random_walk(self, ticker, today):
+        """Business-day geometric random walk from SYNTHETIC_EPOCH to today"""
+        days = pd.bdate_range(SYNTHETIC_EPOCH, today)
+        rng = self._rng(ticker, 'prices')
+        fx = ticker.endswith('=X')
+        first = rng.uniform(0.5, 2.0) if fx else rng.uniform(10, 500)
+        volatility = 0.005 if fx else rng.uniform(0.01, 0.03)
+
+        closes = first * np.exp(np.cumsum(rng.normal(0.0002, volatility, len(days))))
+        opens = np.concatenate(([first], closes[:-1]))
+        spread = np.abs(rng.normal(0, volatility / 2, (2, len(days))))
+        return pd.DataFrame({
+            'Open': opens,
+            'High': np.maximum(opens, closes) * (1 + spread[0]),
+            'Low': np.minimum(opens, closes) * (1 - spread[1]),
+            'Close': closes,
+            'Volume': 0.0 if fx else rng.integers(10 ** 5, 10 ** 7, len(days)).astype(float)
+        }, index=days)
+
+    def _synthetic_dividends(self, ticker, prices):
+        """Quarterly payments for about half of the tickers"""
+        rng = self._rng(ticker, 'dividends')
+        if ticker.endswith('=X') or prices.empty or rng.random() < 0.5:
+            return pd.Series(dtype=float, index=pd.DatetimeIndex([]), name='Dividends')
+        quarterly_yield = rng.uniform(0.0025, 0.015)
+        payments = prices['Close'].iloc[::63]
+        return (payments * quarterly_yield).round(4).rename('Dividends')
+
+    @staticmethod
+    def _slice(frame, period, start):
+        if start is not None:
+            return frame[frame.index.date >= start]
+        if period == 'max':
+            return frame
+        if period == 'ytd':
+            return frame[frame.index.year == date.today().year]
+        match = re.fullmatch(r'(\d+)(d|wk|mo|y)', period or '')
+        if not match:
+            raise ValueError(f'Invalid period {period}')
+        if match.group(2) == 'd':
+            # Trading days, as Yahoo counts them
+            return frame.iloc[-int(match.group(1)):]
+        days = int(match.group(1)) * PERIOD_UNITS[match.group(2)]
+        return frame[frame.index.date > date.today() - timedelta(days=days)]
+
+
+class MarketData:
+    """
+    Market data provider of the app: Yahoo Finance by default,
+    MARKET_DATA_PROVIDER='local' serves fixtures and synthetic series offline
+    """
+
+    def __init__(self, app=None):
+        self.provider = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config.get('MARKET_DATA_PROVIDER', 'yahoo') == 'local':
+            self.provider = LocalProvider(
+                path=app.config.get('MARKET_DATA_PATH'),
+                latency=app.config.get('MARKET_DATA_LATENCY', 0.0),
+                seed=app.config.get('MARKET_DATA_SEED', 0)
+            )
+        else:
+            from .yahoo_finance import YahooProvider
+
+            self.provider = YahooProvider()
+        app.extensions['market_data'] = self
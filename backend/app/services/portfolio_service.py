@@ -0,0 +1,173 @@
+"""
+Service for portfolio holdings and valuation
+"""
+from collections import defaultdict
+import numpy as np
+from ..extensions import db
+from ..models.asset import Asset
+from ..models.portfolio import Position
+from .fx import FxService
+
+
+class PortfolioValuation:
+    """
+    Holdings and prices of one portfolio, computed once and shared by all
+    totals. Totals are in currency, each holding converted at fx_rates; they
+    are None while a holding's currency has no rate, see missing_rates
+    """
+
+    def __init__(self, holdings, prices, currency='USD', fx_rates=None):
+        self.holdings = holdings
+        self.prices = prices
+        self.currency = currency
+        self.fx_rates = fx_rates or {currency: 1.0}
+        self._assets_summary = None
+
+    @property
+    def assets_summary(self):
+        """
+        Quantity, cost basis, average buy price, market value and P&L per held
+        asset in its own currency, market value and P&L in the base currency
+        """
+        if self._assets_summary is None:
+            summary = [
+                PortfolioService.summarize_holding(holding, self.prices.get(holding['asset'].id))
+                for holding in self.holdings if holding['quantity'] > 0
+            ]
+            rates = self.rates(row['currency'] for row in summary)
+            values = np.array([np.nan if row['total_value'] is None else row['total_value'] for row in summary])
+            profits = np.array([np.nan if row['profit'] is None else row['profit'] for row in summary])
+            for row, rate, value, profit in zip(summary, rates, values * rates, profits * rates):
+                row['fx_rate'] = None if np.isnan(rate) else float(rate)
+                row['base_total_value'] = None if np.isnan(value) else float(value)
+                row['base_profit'] = None if np.isnan(profit) else float(profit)
+            self._assets_summary = summary
+        return self._assets_summary
+
+    def rates(self, codes):
+        """Conversion factor of each of codes to the base currency, NaN when unknown"""
+        return np.array([self.fx_rates.get(code, np.nan) for code in codes], dtype=float)
+
+    @property
+    def missing_rates(self):
+        """Tickers of open or realized holdings whose currency has no rate to the base currency"""
+        return sorted({
+            holding['asset'].ticker for holding, rate in zip(
+                self.holdings, self.rates(holding['asset'].currency for holding in self.holdings))
+            if np.isnan(rate) and (holding['quantity'] > 0 or holding['realized_pnl'])
+        })
+
+    @property
+    def total_value(self):
+        if self.missing_rates:
+            return None
+        values = np.array([np.nan if row['base_total_value'] is None else row['base_total_value']
+                           for row in self.assets_summary])
+        return float(np.nansum(values))
+
+    @property
+    def total_profit(self):
+        """Unrealized plus realized P&L, realized P&L converted at the current rate"""
+        if self.missing_rates:
+            return None
+        unrealized = np.array([np.nan if row['base_profit'] is None else row['base_profit']
+                               for row in self.assets_summary])
+        realized = np.array([holding['realized_pnl'] for holding in self.holdings], dtype=float)
+        realized *= self.rates(holding['asset'].currency for holding in self.holdings)
+        return float(np.nansum(unrealized) + np.nansum(realized))
+
+
+class PortfolioService:
+    """Set-based holdings engine for portfolios"""
+
+    @staticmethod
+    def get_holdings(portfolio_ids):
+        """
+        Quantity, cost basis and realized P&L of every position in the given
+        portfolios, read from the positions table: {portfolio_id: [holding, ...]}
+        """
+        rows = db.session.query(
+            Position.portfolio_id, Asset, Position.quantity, Position.cost_basis, Position.realized_pnl
+        ).join(
+            Asset, Position.asset_id == Asset.id
+        ).filter(
+            Position.portfolio_id.in_(portfolio_ids)
+        ).all()
+
+        holdings = defaultdict(list)
+        for portfolio_id, asset, quantity, cost_basis, realized_pnl in rows:
+            holdings[portfolio_id].append({
+                'asset': asset,
+                'quantity': float(quantity or 0),
+                'cost_basis': float(cost_basis or 0),
+                'realized_pnl': float(realized_pnl or 0)
+            })
+        return holdings
+
+    @staticmethod
+    def value_portfolios(portfolios, currency=None):
+        """
+        Valuation in currency (default BASE_CURRENCY) for many portfolios
+        with one holdings query, one bulk price lookup and one exchange rate
+        matrix for every currency held: {portfolio_id: PortfolioValuation}
+        """
+        portfolio_ids = [portfolio.id for portfolio in portfolios]
+        if not portfolio_ids:
+            return {}
+
+        holdings = PortfolioService.get_holdings(portfolio_ids)
+
+        # Every distinct held asset is priced once, however many portfolios hold it
+        held_assets = {
+            holding['asset'].id: holding['asset']
+            for portfolio_holdings in holdings.values()
+            for holding in portfolio_holdings if holding['quantity'] > 0
+        }
+        prices = Asset.get_current_prices(held_assets.values())
+
+        currency = FxService.base_currency(currency)
+        fx_rates = FxService.rates_to(currency, {
+            holding['asset'].currency
+            for portfolio_holdings in holdings.values() for holding in portfolio_holdings
+        })
+
+        return {
+            portfolio_id: PortfolioValuation(holdings.get(portfolio_id, []), prices, currency, fx_rates)
+            for portfolio_id in portfolio_ids
+        }
+
+    @staticmethod
+    def value_portfolio(portfolio, currency=None):
+        """Valuation for a single portfolio"""
+        return PortfolioService.value_portfolios([portfolio], currency)[portfolio.id]
+
+    @staticmethod
+    def summarize_holding(holding, current_price):
+        """Summary row of a single position"""
+        asset = holding['asset']
+        quantity = holding['quantity']
+
+        # Average cost of the open quantity
+        cost_basis = holding['cost_basis']
+        avg_buy_price = cost_basis / quantity if quantity > 0 else 0
+
+        if current_price is not None:
+            total_value = current_price * quantity
+            profit = total_value - cost_basis
+            profit_percent = ((current_price / avg_buy_price) - 1) * 100 if avg_buy_price > 0 else 0
+        else:
+            total_value = profit = profit_percent = None
+
+        return {
+            'asset_id': asset.id,
+            'ticker': asset.ticker,
+            'name': asset.name,
+            'currency': asset.currency,
+            'quantity': quantity,
+            'avg_buy_price': avg_buy_price,
+            'cost_basis': cost_basis,
+            'current_price': current_price,
+            'total_value': total_value,
+            'profit': profit,
+            'profit_percent': profit_percent
+        }
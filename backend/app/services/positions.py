@@ -0,0 +1,188 @@
+"""
+Service maintaining the materialized positions table
+"""
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+import click
+from flask.cli import AppGroup
+from sqlalchemy import delete, event, select
+from sqlalchemy.orm import Session
+from ..extensions import db
+from ..models.portfolio import Portfolio, Position
+from ..models.transaction import Transaction
+from ..utils.db import upsert
+
+ZERO = Decimal(0)
+
+
+def _decimal(value):
+    return value if isinstance(value, Decimal) else Decimal(str(value or 0))
+
+
+class PositionService:
+    """Net quantity, average cost basis and realized P&L per (portfolio, asset)"""
+
+    @staticmethod
+    def apply(state, transaction_type, quantity, price, fee, transaction_date):
+        """Apply one trade to a position state dict, average cost method"""
+        quantity, price, fee = _decimal(quantity), _decimal(price), _decimal(fee)
+        if transaction_type == 'buy':
+            state['quantity'] += quantity
+            state['cost_basis'] += quantity * price + fee
+        else:
+            held = state['quantity']
+            avg_cost = state['cost_basis'] / held if held > 0 else ZERO
+            sold = min(quantity, held) if held > 0 else ZERO
+            state['realized_pnl'] += quantity * price - fee - sold * avg_cost
+            state['cost_basis'] -= sold * avg_cost
+            state['quantity'] -= quantity
+            if state['quantity'] <= 0:
+                state['cost_basis'] = ZERO
+        state['last_trade_date'] = max(filter(None, (state['last_trade_date'], transaction_date)))
+        return state
+
+    @staticmethod
+    def empty_state():
+        return {'quantity': ZERO, 'cost_basis': ZERO, 'realized_pnl': ZERO, 'last_trade_date': None}
+
+    @staticmethod
+    def compute(portfolio_id, asset_ids=None, session=None):
+        """Position states replayed from a portfolio's transactions in one query: {asset_id: state}"""
+        session = session or db.session
+        query = select(
+            Transaction.asset_id, Transaction.transaction_type, Transaction.quantity,
+            Transaction.price, Transaction.fee, Transaction.transaction_date
+        ).where(Transaction.portfolio_id == portfolio_id)
+        if asset_ids is not None:
+            query = query.where(Transaction.asset_id.in_(asset_ids))
+        query = query.order_by(Transaction.transaction_date, Transaction.id)
+
+        states = defaultdict(PositionService.empty_state)
+        for asset_id, *trade in session.execute(query):
+            PositionService.apply(states[asset_id], *trade)
+        return states
+
+    @staticmethod
+    def save(portfolio_id, states, asset_ids=None, session=None):
+        """Write position states, drop positions of asset_ids without any state"""
+        session = session or db.session
+        stale = set(asset_ids or []) - set(states)
+        if stale:
+            session.execute(delete(Position).where(
+                Position.portfolio_id == portfolio_id, Position.asset_id.in_(stale)))
+
+        now = datetime.utcnow()
+        upsert(
+            Position,
+            [dict(state, portfolio_id=portfolio_id, asset_id=asset_id, updated_at=now)
+             for asset_id, state in states.items()],
+            index_elements=['portfolio_id', 'asset_id'],
+            update_columns=['quantity', 'cost_basis', 'realized_pnl', 'last_trade_date', 'updated_at'],
+            session=session
+        )
+
+    @staticmethod
+    def rebuild(portfolio_id, asset_ids=None, session=None):
+        """Recompute positions of a portfolio (or of some of its assets) from transactions"""
+        if asset_ids is None:
+            session = session or db.session
+            session.execute(delete(Position).where(Position.portfolio_id == portfolio_id))
+        states = PositionService.compute(portfolio_id, asset_ids, session)
+        PositionService.save(portfolio_id, states, asset_ids, session)
+        return len(states)
+
+    @staticmethod
+    def apply_changes(session, new_transactions, rebuild_pairs):
+        """
+        Bring positions up to date after a flush: new trades dated at or after
+        the position's last trade are applied incrementally, anything else
+        (back-dated trades, updates, deletes) rebuilds that position
+        """
+        by_pair = defaultdict(list)
+        for transaction in new_transactions:
+            by_pair[(transaction.portfolio_id, transaction.asset_id)].append(transaction)
+
+        pairs = set(by_pair) | set(rebuild_pairs)
+        if not pairs:
+            return
+
+        portfolio_ids = {portfolio_id for portfolio_id, _ in pairs}
+        asset_ids = {asset_id for _, asset_id in pairs}
+        existing = {
+            (row.portfolio_id, row.asset_id): {
+                'quantity': row.quantity, 'cost_basis': row.cost_basis,
+                'realized_pnl': row.realized_pnl, 'last_trade_date': row.last_trade_date
+            }
+            for row in session.execute(select(
+                Position.portfolio_id, Position.asset_id, Position.quantity, Position.cost_basis,
+                Position.realized_pnl, Position.last_trade_date
+            ).where(Position.portfolio_id.in_(portfolio_ids), Position.asset_id.in_(asset_ids)))
+            if (row.portfolio_id, row.asset_id) in pairs
+        }
+
+        rebuild = defaultdict(set)
+        incremental = defaultdict(dict)
+        for pair in pairs:
+            portfolio_id, asset_id = pair
+            trades = sorted(by_pair.get(pair, []), key=lambda t: (t.transaction_date, t.id))
+            state = existing.get(pair)
+            if pair in rebuild_pairs or (trades and state and state['last_trade_date']
+                                         and trades[0].transaction_date < state['last_trade_date']):
+                rebuild[portfolio_id].add(asset_id)
+                continue
+
+            state = dict(state) if state else PositionService.empty_state()
+            for trade in trades:
+                PositionService.apply(state, trade.transaction_type, trade.quantity, trade.price,
+                                      trade.fee, trade.transaction_date)
+            incremental[portfolio_id][asset_id] = state
+
+        for portfolio_id, states in incremental.items():
+            PositionService.save(portfolio_id, states, session=session)
+        for portfolio_id, rebuild_ids in rebuild.items():
+            PositionService.rebuild(portfolio_id, rebuild_ids, session)
+
+
+@event.listens_for(Session, 'before_flush')
+def collect_position_changes(session, flush_context, instances):
+    """Remember which transactions change in this flush"""
+    changes = session.info.setdefault('position_changes', {'new': [], 'rebuild': set()})
+    for obj in session.new:
+        if isinstance(obj, Transaction):
+            changes['new'].append(obj)
+    for obj in list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, Transaction) or (obj in session.dirty and not session.is_modified(obj)):
+            continue
+        state = db.inspect(obj)
+        for attr in ('portfolio_id', 'asset_id'):
+            history = state.attrs[attr].history
+            if history.deleted:
+                old = dict(portfolio_id=obj.portfolio_id, asset_id=obj.asset_id, **{attr: history.deleted[0]})
+                changes['rebuild'].add((old['portfolio_id'], old['asset_id']))
+        changes['rebuild'].add((obj.portfolio_id, obj.asset_id))
+
+
+@event.listens_for(Session, 'after_flush')
+def apply_position_changes(session, flush_context):
+    """Update positions in the same DB transaction as the transaction writes"""
+    changes = session.info.pop('position_changes', None)
+    if changes:
+        PositionService.apply_changes(session, changes['new'], changes['rebuild'])
+
+
+positions_cli = AppGroup('positions', help='Materialized positions.')
+
+
+@positions_cli.command('rebuild')
+@click.option('--portfolio-id', type=int, help='Only this portfolio.')
+def rebuild_command(portfolio_id):
+    """Rebuild positions from transactions, repairing any drift"""
+    query = db.session.query(Portfolio.id)
+    if portfolio_id:
+        query = query.filter(Portfolio.id == portfolio_id)
+    total = 0
+    for (pid,) in query.all():
+        total += PositionService.rebuild(pid)
+    db.session.commit()
+    click.echo(f'Rebuilt {total} positions')
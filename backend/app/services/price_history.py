@@ -0,0 +1,91 @@
+"""
+Service for bounded price history queries
+"""
+import re
+from datetime import date, timedelta
+import pandas as pd
+from ..extensions import db
+from ..models.asset import AssetPrice
+
+COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+PERIOD_UNITS = {'d': 1, 'w': 7, 'm': 30, 'mo': 30, 'y': 365}
+# Bucket rules, labelled by the last trading day in the bucket
+INTERVALS = {'1d': None, '1wk': 'W-FRI', '1mo': 'ME'}
+
+
+class PriceHistoryService:
+    """Date-range filtered OHLCV history, resampled and shaped for charts"""
+
+    @staticmethod
+    def resolve_range(period='1m', start=None, end=None, today=None):
+        """
+        (start, end) dates of a request, explicit dates win over the period.
+        period: '5d', '2w', '1m'/'1mo', '1y', 'ytd' or 'max'. Raises ValueError
+        """
+        end = end or today or date.today()
+        if start:
+            if start > end:
+                raise ValueError('start must not be after end')
+            return start, end
+
+        period = (period or '1m').lower()
+        if period == 'max':
+            return None, end
+        if period == 'ytd':
+            return date(end.year, 1, 1), end
+        match = re.fullmatch(r'(\d+)(d|w|mo|m|y)', period)
+        if not match:
+            raise ValueError("period must look like '5d', '1m', '1y', 'ytd' or 'max'")
+        return end - timedelta(days=int(match.group(1)) * PERIOD_UNITS[match.group(2)]), end
+
+    @staticmethod
+    def load(asset_id, start=None, end=None):
+        """OHLCV frame indexed by date, bounded in SQL"""
+        query = db.session.query(
+            AssetPrice.date, AssetPrice.open, AssetPrice.high, AssetPrice.low, AssetPrice.close, AssetPrice.volume
+        ).filter(AssetPrice.asset_id == asset_id)
+        if start:
+            query = query.filter(AssetPrice.date >= start)
+        if end:
+            query = query.filter(AssetPrice.date <= end)
+
+        frame = pd.DataFrame(query.order_by(AssetPrice.date).all(), columns=['date'] + COLUMNS)
+        frame[COLUMNS] = frame[COLUMNS].astype(float)
+        frame['date'] = pd.to_datetime(frame['date'])
+        return frame.set_index('date')
+
+    @staticmethod
+    def resample(frame, interval='1d'):
+        """Weekly or monthly OHLCV bars, vectorized"""
+        if interval not in INTERVALS:
+            raise ValueError(f"interval must be one of {', '.join(INTERVALS)}")
+        rule = INTERVALS[interval]
+        if rule is None or frame.empty:
+            return frame
+
+        frame = frame.assign(last_date=frame.index)
+        bars = frame.resample(rule).agg({
+            'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last', 'volume': 'sum', 'last_date': 'last'
+        })
+        bars = bars.dropna(subset=['last_date'])
+        return bars.set_index('last_date').rename_axis('date')[COLUMNS]
+
+    @staticmethod
+    def get_history(asset_id, period='1m', start=None, end=None, interval='1d'):
+        start, end = PriceHistoryService.resolve_range(period, start, end)
+        return PriceHistoryService.resample(PriceHistoryService.load(asset_id, start, end), interval)
+
+    @staticmethod
+    def to_columns(frame):
+        """Parallel arrays {'date': [...], 'open': [...], ...}, NaN as None"""
+        values = frame[COLUMNS].astype({'volume': 'Int64'}).astype(object)
+        values = values.where(frame[COLUMNS].notna(), None)
+        result = {'date': [d.isoformat() for d in frame.index.date]}
+        result.update((column, values[column].tolist()) for column in COLUMNS)
+        return result
+
+    @staticmethod
+    def to_records(frame):
+        """One dict per bar"""
+        columns = PriceHistoryService.to_columns(frame)
+        return [dict(zip(columns, row)) for row in zip(*columns.values())]
@@ -0,0 +1,135 @@
+"""
+Background market data refresh
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ..extensions import db
+from ..models.asset import Asset
+from .market_calendar import MarketCalendar
+from .yahoo_finance import YahooFinanceService
+
+
+class RefreshScheduler:
+    """
+    Keeps every ticker of the asset table on a refresh schedule and runs due
+    refreshes in bounded thread pools. Quotes are refreshed in batches on
+    their own pool so they never queue behind history, metrics and dividends,
+    which are refreshed per asset, each on its own cadence. Quotes only move
+    during a session, outside of one they are refreshed once after the close.
+    Upstream calls are rate limited by the shared upstream session.
+    """
+
+    TASKS = ('quotes', 'history', 'metrics', 'dividends')
+
+    def __init__(self, app):
+        self.app = app
+        self.cadences = {task: app.config[f'REFRESH_{task.upper()}_INTERVAL'] for task in self.TASKS}
+        self.batch_size = app.config['REFRESH_QUOTE_BATCH_SIZE']
+        self.quote_executor = ThreadPoolExecutor(
+            max_workers=app.config['REFRESH_QUOTE_WORKERS'], thread_name_prefix='refresh-quotes')
+        self.executor = ThreadPoolExecutor(
+            max_workers=app.config['REFRESH_MAX_WORKERS'], thread_name_prefix='refresh')
+        self.next_run = {}  # (task, ticker) -> monotonic time
+        self.in_flight = set()
+        self.tickers = frozenset()
+        self.closed_session = None  # last session whose close was refreshed
+        self.lock = threading.Lock()
+
+    def load_tickers(self):
+        """All tickers of the asset table"""
+        with self.app.app_context():
+            return [ticker for (ticker,) in db.session.query(Asset.ticker).order_by(Asset.ticker)]
+
+    def due_jobs(self, tickers, now, market_now=None):
+        """
+        Due (task, [tickers]) jobs, quotes grouped into batches. now is the
+        monotonic time, market_now the wall clock time (default: current)
+        quotes are gated on
+        """
+        jobs = []
+        with self.lock:
+            if self.tickers != set(tickers):
+                # Tickers no longer tracked leave the schedule
+                self.tickers = frozenset(tickers)
+                self.next_run = {key: at for key, at in self.next_run.items() if key[1] in self.tickers}
+
+            market_open = MarketCalendar.is_open(market_now)
+            session = MarketCalendar.last_closed_session(market_now)
+            closing = not market_open and session != self.closed_session
+            if closing:
+                self.closed_session = session
+
+            for task in self.TASKS:
+                if task == 'quotes' and not (market_open or closing):
+                    continue
+                due = [
+                    ticker for ticker in tickers
+                    if (task, ticker) not in self.in_flight and (
+                        (task == 'quotes' and closing) or self.next_run.get((task, ticker), 0) <= now)
+                ]
+                if task == 'quotes':
+                    jobs.extend((task, due[i:i + self.batch_size]) for i in range(0, len(due), self.batch_size))
+                else:
+                    jobs.extend((task, [ticker]) for ticker in due)
+
+                for ticker in due:
+                    self.in_flight.add((task, ticker))
+                    self.next_run[(task, ticker)] = now + self.cadences[task]
+        return jobs
+
+    def run_once(self, tickers=None):
+        """Submit every due job, returns the futures"""
+        tickers = self.load_tickers() if tickers is None else tickers
+        return [
+            (self.quote_executor if task == 'quotes' else self.executor).submit(self.run_job, task, job_tickers)
+            for task, job_tickers in self.due_jobs(tickers, time.monotonic())
+        ]
+
+    def run_forever(self, poll_interval=5):
+        """Main loop of the worker process"""
+        print(f"Refresh worker started, cadences: {self.cadences}")
+        try:
+            while True:
+                self.run_once()
+                time.sleep(poll_interval)
+        finally:
+            self.quote_executor.shutdown(wait=True)
+            self.executor.shutdown(wait=True)
+
+    def run_job(self, task, tickers):
+        """Run one refresh in the pool thread"""
+        try:
+            with self.app.app_context():
+                try:
+                    getattr(self, f'refresh_{task}')(tickers)
+                finally:
+                    db.session.remove()
+        except Exception as e:
+            print(f"Error refreshing {task} for {', '.join(tickers)}: {e}")
+        finally:
+            with self.lock:
+                for ticker in tickers:
+                    self.in_flight.discard((task, ticker))
+
+    @staticmethod
+    def refresh_quotes(tickers):
+        YahooFinanceService.refresh_current_prices(tickers)
+
+    @staticmethod
+    def refresh_history(tickers):
+        for asset in Asset.query.filter(Asset.ticker.in_(tickers)):
+            YahooFinanceService.update_asset_prices(asset)
+        db.session.commit()
+
+    @staticmethod
+    def refresh_metrics(tickers):
+        for asset in Asset.query.filter(Asset.ticker.in_(tickers)):
+            YahooFinanceService.update_asset_metrics(asset)
+        db.session.commit()
+
+    @staticmethod
+    def refresh_dividends(tickers):
+        for asset in Asset.query.filter(Asset.ticker.in_(tickers)):
+            YahooFinanceService.update_dividends(asset)
+        db.session.commit()
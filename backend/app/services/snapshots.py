@@ -0,0 +1,280 @@
+"""
+Service for daily portfolio value snapshots
+"""
+from datetime import datetime, timedelta
+import pandas as pd
+from sqlalchemy import case, delete, event, func
+from sqlalchemy.orm import Session
+from ..extensions import db
+from ..models.asset import Asset, AssetPrice
+from ..models.portfolio import PortfolioSnapshot
+from ..models.transaction import Transaction
+from ..utils.db import upsert
+from .fx import FxService
+from .market_calendar import MarketCalendar
+
+# Days of prices before the first snapshot day used to carry the last close forward
+PRICE_LOOKBACK_DAYS = 14
+
+
+class SnapshotService:
+    """
+    Builds portfolio_snapshots incrementally from transactions and AssetPrice
+    history, one series per currency
+    """
+
+    @staticmethod
+    def build(portfolio_id, until=None, currency=None):
+        """
+        Roll snapshots in currency (default BASE_CURRENCY) forward from the
+        day after the last stored one (or the first transaction) up to until,
+        returns the number of days written. Days after the last closed session
+        have no final prices yet and are never stored
+        """
+        last_session = MarketCalendar.last_closed_session()
+        until = min(until or last_session, last_session)
+        currency = FxService.base_currency(currency)
+
+        rows = SnapshotService.compute(portfolio_id, until, currency)
+        upsert(
+            PortfolioSnapshot, rows,
+            index_elements=['portfolio_id', 'currency', 'date'],
+            update_columns=['value', 'cost_basis', 'cash_flow']
+        )
+        db.session.commit()
+        return len(rows)
+
+    @staticmethod
+    def compute(portfolio_id, until, currency):
+        """
+        Snapshot rows in currency from the day after the last stored one (or
+        the first transaction) up to until, without writing them
+        """
+        last = db.session.query(PortfolioSnapshot.date, PortfolioSnapshot.cost_basis).filter(
+            PortfolioSnapshot.portfolio_id == portfolio_id,
+            PortfolioSnapshot.currency == currency
+        ).order_by(PortfolioSnapshot.date.desc()).first()
+        if last:
+            start = last.date + timedelta(days=1)
+        else:
+            first_trade = db.session.query(func.min(Transaction.transaction_date)).filter(
+                Transaction.portfolio_id == portfolio_id).scalar()
+            if first_trade is None:
+                return []
+            start = first_trade.date()
+
+        if start > until:
+            return []
+
+        start_dt = datetime.combine(start, datetime.min.time())
+        end_dt = datetime.combine(until + timedelta(days=1), datetime.min.time())
+        signed_quantity = case(
+            (Transaction.transaction_type == 'sell', -Transaction.quantity),
+            else_=Transaction.quantity
+        )
+        fee = func.coalesce(Transaction.fee, 0)
+        cash_flow = case(
+            (Transaction.transaction_type == 'sell', -(Transaction.price * Transaction.quantity) + fee),
+            else_=Transaction.price * Transaction.quantity + fee
+        )
+
+        # Holdings carried into the first day, the invested amount is the last snapshot's
+        opening = db.session.query(
+            Transaction.asset_id, func.sum(signed_quantity)
+        ).filter(
+            Transaction.portfolio_id == portfolio_id,
+            Transaction.transaction_date < start_dt
+        ).group_by(Transaction.asset_id).all()
+
+        trades = db.session.query(
+            Transaction.asset_id, Transaction.transaction_date, signed_quantity, cash_flow
+        ).filter(
+            Transaction.portfolio_id == portfolio_id,
+            Transaction.transaction_date >= start_dt,
+            Transaction.transaction_date < end_dt
+        ).all()
+
+        asset_ids = {asset_id for asset_id, *_ in opening} | {asset_id for asset_id, *_ in trades}
+        if not asset_ids:
+            return []
+
+        prices = db.session.query(AssetPrice.asset_id, AssetPrice.date, AssetPrice.close).filter(
+            AssetPrice.asset_id.in_(asset_ids),
+            AssetPrice.date >= start - timedelta(days=PRICE_LOOKBACK_DAYS),
+            AssetPrice.date <= until
+        ).all()
+
+        # Exchange rate of each asset's currency as of every day, when any differs
+        currencies = dict(db.session.query(Asset.id, Asset.currency).filter(Asset.id.in_(asset_ids)))
+        fx = None
+        if set(currencies.values()) != {currency}:
+            FxService.sync(set(currencies.values()) | {currency}, start)
+            rates = FxService.history(currencies.values(), currency, start, until)
+            fx = pd.DataFrame({asset_id: rates[code] for asset_id, code in currencies.items()})
+
+        return SnapshotService.roll_forward(
+            portfolio_id, start, until, opening, trades, prices,
+            float(last.cost_basis) if last else 0.0, currency, fx
+        )
+
+    @staticmethod
+    def roll_forward(portfolio_id, start, until, opening, trades, prices, opening_invested=0.0,
+                     currency='USD', fx=None):
+        """
+        Vectorized daily value, cost basis and cash flow between start and until
+        opening: [(asset_id, quantity)], trades: [(asset_id, datetime, quantity, cash flow)],
+        prices: [(asset_id, date, close)], fx: DataFrame (day x asset_id) of
+        the rate converting each asset's currency to currency, None when all match.
+        Rows stop before the first day an asset held or traded has no rate,
+        the next build rolls forward from there once it is synced
+        """
+        days = pd.date_range(start, until, freq='D')
+
+        trades_frame = pd.DataFrame(trades, columns=['asset_id', 'date', 'quantity', 'cash_flow'])
+        trades_frame['date'] = pd.to_datetime(trades_frame['date']).dt.normalize()
+        trades_frame[['quantity', 'cash_flow']] = trades_frame[['quantity', 'cash_flow']].astype(float)
+        if fx is not None:
+            # Each trade converted at the rate of its day
+            trades_frame['cash_flow'] *= fx.to_numpy()[
+                days.get_indexer(trades_frame['date']), fx.columns.get_indexer(trades_frame['asset_id'])]
+
+        opening_frame = pd.DataFrame(opening, columns=['asset_id', 'quantity'])
+        opening_quantity = opening_frame.set_index('asset_id')['quantity'].astype(float)
+
+        # Quantity held per day and asset: opening holdings plus cumulative trades
+        quantity_deltas = trades_frame.pivot_table(
+            index='date', columns='asset_id', values='quantity', aggfunc='sum'
+        ).reindex(days, fill_value=0.0).fillna(0.0)
+        asset_ids = quantity_deltas.columns.union(opening_quantity.index)
+        quantities = quantity_deltas.reindex(columns=asset_ids, fill_value=0.0).cumsum()
+        quantities += opening_quantity.reindex(asset_ids, fill_value=0.0)
+
+        # Close per day and asset, last known close carried over weekends and holidays
+        prices_frame = pd.DataFrame(prices, columns=['asset_id', 'date', 'close'])
+        prices_frame['date'] = pd.to_datetime(prices_frame['date'])
+        prices_frame['close'] = prices_frame['close'].astype(float)
+        closes = prices_frame.pivot_table(index='date', columns='asset_id', values='close', aggfunc='last')
+        closes = closes.reindex(closes.index.union(days)).ffill().reindex(days)
+        closes = closes.reindex(columns=asset_ids)
+        valued = len(days)
+        if fx is not None:
+            fx = fx.reindex(columns=asset_ids)
+            unconverted = ((quantities != 0) & fx.isna()).any(axis=1)
+            unconverted |= days.isin(trades_frame.loc[trades_frame['cash_flow'].isna(), 'date'])
+            if unconverted.any():
+                valued = int(unconverted.to_numpy().argmax())
+                print(f"Missing exchange rates to {currency} for portfolio {portfolio_id}, "
+                      f"snapshots stop before {days[valued].date()}")
+            closes = closes * fx
+        closes = closes.fillna(0.0)
+
+        values = (quantities * closes).sum(axis=1)
+        cash_flows = trades_frame.groupby('date')['cash_flow'].sum().reindex(days, fill_value=0.0)
+        cost_basis = opening_invested + cash_flows.cumsum()
+
+        return [
+            {
+                'portfolio_id': portfolio_id,
+                'currency': currency,
+                'date': day.date(),
+                'value': round(float(value), 6),
+                'cost_basis': round(float(basis), 6),
+                'cash_flow': round(float(flow), 6)
+            }
+            for day, value, basis, flow in zip(
+                days[:valued], values.to_numpy(), cost_basis.to_numpy(), cash_flows.to_numpy())
+        ]
+
+    @staticmethod
+    def invalidate(portfolio_id, from_date, session=None):
+        """Drop snapshots from from_date on, the next build rolls forward from there"""
+        (session or db.session).execute(delete(PortfolioSnapshot).where(
+            PortfolioSnapshot.portfolio_id == portfolio_id,
+            PortfolioSnapshot.date >= from_date
+        ))
+
+    @staticmethod
+    def invalidate_prices(rows):
+        """
+        Drop snapshots of the portfolios trading an asset from the earliest of
+        its AssetPrice rows whose close differs from the stored one on, called
+        before the rows are upserted. Bars after the last closed session are
+        never part of a stored snapshot
+        """
+        last_session = MarketCalendar.last_closed_session()
+        rows = [row for row in rows if row['date'] <= last_session]
+        if not rows:
+            return
+
+        stored = {
+            (asset_id, day): float(close) for asset_id, day, close in db.session.query(
+                AssetPrice.asset_id, AssetPrice.date, AssetPrice.close
+            ).filter(
+                AssetPrice.asset_id.in_({row['asset_id'] for row in rows}),
+                AssetPrice.date >= min(row['date'] for row in rows),
+                AssetPrice.date <= max(row['date'] for row in rows)
+            )
+        }
+        earliest = {}
+        for row in rows:
+            # Re-upserting an unchanged bar, as every quote refresh after the close does, keeps the snapshots
+            close = stored.get((row['asset_id'], row['date']))
+            if close is not None and round(close, 6) == round(float(row['close']), 6):
+                continue
+            earliest[row['asset_id']] = min(row['date'], earliest.get(row['asset_id'], row['date']))
+        if not earliest:
+            return
+
+        portfolios = {}
+        for portfolio_id, asset_id in db.session.query(Transaction.portfolio_id, Transaction.asset_id).filter(
+                Transaction.asset_id.in_(list(earliest))).distinct():
+            day = earliest[asset_id]
+            portfolios[portfolio_id] = min(day, portfolios.get(portfolio_id, day))
+        for portfolio_id, day in portfolios.items():
+            SnapshotService.invalidate(portfolio_id, day)
+
+    @staticmethod
+    def get_history(portfolio_id, start=None, end=None, currency=None):
+        """
+        Snapshots of a portfolio in currency (default BASE_CURRENCY), rolled
+        forward first. Days after the last closed session are computed on the
+        fly from the latest prices and not stored
+        """
+        currency = FxService.base_currency(currency)
+        SnapshotService.build(portfolio_id, currency=currency)
+
+        query = PortfolioSnapshot.query.filter_by(portfolio_id=portfolio_id, currency=currency)
+        if start:
+            query = query.filter(PortfolioSnapshot.date >= start)
+        if end:
+            query = query.filter(PortfolioSnapshot.date <= end)
+        snapshots = query.order_by(PortfolioSnapshot.date).all()
+
+        today = MarketCalendar.local_now().date()
+        if end is None or end > MarketCalendar.last_closed_session():
+            snapshots += [
+                PortfolioSnapshot(**row)
+                for row in SnapshotService.compute(portfolio_id, min(end or today, today), currency)
+                if start is None or row['date'] >= start
+            ]
+        return snapshots
+
+
+@event.listens_for(Session, 'before_flush')
+def invalidate_snapshots(session, flush_context, instances):
+    """
+    Drop snapshots from the earliest day touched by a new, changed or deleted
+    transaction, the next build rolls forward from there
+    """
+    earliest = {}
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, Transaction) or obj.portfolio_id is None:
+            continue
+        history = db.inspect(obj).attrs.transaction_date.history
+        dates = [d for d in (obj.transaction_date, *history.deleted) if d is not None]
+        if dates:
+            day = min(dates).date() if isinstance(min(dates), datetime) else min(dates)
+            earliest[obj.portfolio_id] = min(day, earliest.get(obj.portfolio_id, day))
+
+    for portfolio_id, day in earliest.items():
+        SnapshotService.invalidate(portfolio_id, day, session)
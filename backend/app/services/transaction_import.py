@@ -0,0 +1,174 @@
+"""
+Service for importing broker statements as transactions
+"""
+import csv
+import io
+import json
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from flask import current_app
+from sqlalchemy import insert
+from ..extensions import db, sync_jobs
+from ..models.asset import Asset
+from ..models.transaction import Transaction
+from .cost_basis import CostBasisService
+from .positions import PositionService
+from .dividends import DividendService
+from .snapshots import SnapshotService
+from .yahoo_finance import YahooFinanceService, TICKER_PATTERN
+
+REQUIRED_FIELDS = ('ticker', 'transaction_type', 'quantity', 'price', 'transaction_date')
+INSERT_CHUNK_SIZE = 1000
+
+
+class TransactionImportService:
+    """Bulk transaction import with batched asset resolution"""
+
+    @staticmethod
+    def parse_row(row):
+        """
+        Validated transaction fields from a raw row, raises ValueError
+        """
+        missing = [field for field in REQUIRED_FIELDS if row.get(field) in (None, '')]
+        if missing:
+            raise ValueError(f"Missing required fields: {', '.join(missing)}")
+
+        transaction_type = str(row['transaction_type']).strip().lower()
+        if transaction_type not in ('buy', 'sell'):
+            raise ValueError("transaction_type must be 'buy' or 'sell'")
+
+        try:
+            quantity = Decimal(str(row['quantity']).strip())
+            price = Decimal(str(row['price']).strip())
+            fee = Decimal(str(row.get('fee') or 0).strip())
+        except InvalidOperation:
+            raise ValueError('quantity, price and fee must be numbers')
+        if not quantity.is_finite() or quantity <= 0:
+            raise ValueError('quantity must be positive')
+        if not price.is_finite() or price < 0 or not fee.is_finite() or fee < 0:
+            raise ValueError('price and fee must not be negative')
+
+        try:
+            transaction_date = datetime.fromisoformat(str(row['transaction_date']).strip())
+        except ValueError:
+            raise ValueError('transaction_date must be an ISO date or datetime')
+
+        ticker = str(row['ticker']).strip().upper()
+        if not TICKER_PATTERN.match(ticker):
+            raise ValueError('Invalid ticker symbol')
+
+        return {
+            'ticker': ticker,
+            'transaction_type': transaction_type,
+            'quantity': quantity,
+            'price': price,
+            'fee': fee,
+            'transaction_date': transaction_date,
+            'notes': row.get('notes') or None
+        }
+
+    @staticmethod
+    def read_rows(stream, content_type):
+        """
+        Raw rows from an uploaded statement, CSV and NDJSON are read as a stream
+        """
+        text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+        if 'csv' in content_type:
+            yield from csv.DictReader(text)
+        elif 'ndjson' in content_type:
+            for line in text:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            rows = json.load(text)
+            if isinstance(rows, dict):
+                rows = rows.get('transactions', [])
+            yield from rows
+
+    @staticmethod
+    def resolve_assets(tickers, max_lookups=None):
+        """
+        {ticker: Asset} for every ticker, unknown ones looked up once each and
+        created in one batch. Returns (assets, created tickers, rejected
+        tickers): with more than max_lookups unknown tickers none is looked
+        up and all of them are rejected
+        """
+        tickers = set(tickers)
+        assets = {asset.ticker: asset for asset in Asset.query.filter(Asset.ticker.in_(tickers))} if tickers else {}
+
+        unknown = sorted(tickers - set(assets))
+        if max_lookups is not None and len(unknown) > max_lookups:
+            return assets, [], unknown
+
+        new_assets = []
+        for ticker in unknown:
+            info = YahooFinanceService.get_stock_info(ticker)
+            if info:
+                new_assets.append(Asset(**dict(info, ticker=ticker)))
+
+        if new_assets:
+            db.session.add_all(new_assets)
+            db.session.flush()
+            assets.update((asset.ticker, asset) for asset in new_assets)
+
+        return assets, [asset.ticker for asset in new_assets], []
+
+    @staticmethod
+    def import_rows(portfolio_id, rows):
+        """
+        Import raw rows into a portfolio in one DB transaction, returns a report
+        with the per-row errors. Rows with errors are skipped.
+        """
+        errors = []
+        parsed = []
+        for number, row in enumerate(rows, start=1):
+            try:
+                if not isinstance(row, dict):
+                    raise ValueError('Row must be an object')
+                parsed.append((number, TransactionImportService.parse_row(row)))
+            except ValueError as e:
+                errors.append({'row': number, 'error': str(e)})
+
+        # Every unknown ticker is a serial upstream lookup, a statement gets as many as a sync batch
+        max_lookups = current_app.config['SYNC_BATCH_MAX']
+        assets, created, rejected = TransactionImportService.resolve_assets(
+            (data['ticker'] for _, data in parsed), max_lookups)
+        if rejected:
+            return {
+                'error': f'At most {max_lookups} new tickers can be imported at once',
+                'tickers': rejected,
+                'imported': 0
+            }
+
+        values = []
+        for number, data in parsed:
+            asset = assets.get(data.pop('ticker'))
+            if asset is None:
+                errors.append({'row': number, 'error': 'Invalid ticker symbol'})
+                continue
+            values.append(dict(data, portfolio_id=portfolio_id, asset_id=asset.id, created_at=datetime.utcnow()))
+
+        try:
+            for start in range(0, len(values), INSERT_CHUNK_SIZE):
+                db.session.execute(insert(Transaction), values[start:start + INSERT_CHUNK_SIZE])
+            if values:
+                # Core inserts skip the ORM flush hooks, update derived tables here
+                PositionService.rebuild(portfolio_id, {v['asset_id'] for v in values})
+                SnapshotService.invalidate(portfolio_id, min(v['transaction_date'] for v in values).date())
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if values:
+            DividendService.invalidate(portfolio_id)
+            CostBasisService.invalidate(portfolio_id)
+
+        # History is synced in the background, not in this request
+        jobs = sync_jobs.enqueue_many(created)
+
+        return {
+            'imported': len(values),
+            'errors': sorted(errors, key=lambda error: error['row']),
+            'created_assets': created,
+            'sync_jobs': [job['id'] for job in jobs]
+        }
@@ -0,0 +1,159 @@
+"""
+Shared HTTP session and rate limiting for upstream market data calls
+"""
+import os
+import threading
+import time
+import requests
+from flask import current_app, has_app_context
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .cache import _redis_client
+
+# Statuses retried with backoff, Retry-After is honoured when sent
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Settings used outside an app context
+DEFAULTS = {
+    'UPSTREAM_CONNECT_TIMEOUT': 3.05,
+    'UPSTREAM_READ_TIMEOUT': 20,
+    'UPSTREAM_RETRIES': 3,
+    'UPSTREAM_BACKOFF': 0.5,
+    'UPSTREAM_POOL_SIZE': 20,
+    'UPSTREAM_RATE_LIMIT': 5,
+    'UPSTREAM_RATE_BURST': 10
+}
+RATE_LIMIT_KEY = 'ratelimit:upstream'
+
+# Refills the bucket from the Redis clock and takes a token, returns the
+# seconds to wait before asking again (0 when a token was taken)
+_TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local clock = redis.call('time')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('hset', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('expire', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RateLimiter:
+    """Token bucket limiting calls per second to one upstream, shared by threads"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Take a token if one is available, returns the seconds to wait otherwise"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Block until a token is available"""
+        while True:
+            wait = self.take()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+class RedisRateLimiter(RateLimiter):
+    """
+    Token bucket kept in Redis so every worker process shares one budget,
+    falls back to the in-process bucket when the cache is not Redis-backed
+    or Redis is unreachable
+    """
+
+    def __init__(self, rate, capacity=None, key=RATE_LIMIT_KEY, client=None):
+        super().__init__(rate, capacity)
+        self.key = key
+        self.client = client
+
+    def take(self):
+        try:
+            client = self.client or _redis_client()
+            if client is not None:
+                return float(client.eval(_TOKEN_BUCKET_SCRIPT, 1, self.key, self.rate, self.capacity))
+        except Exception as e:
+            print(f"Error taking rate limit token from Redis, using local limit: {e}")
+        return super().take()
+
+
+class UpstreamSession(requests.Session):
+    """
+    Pooled keep-alive session: connect and read timeouts on every request
+    that does not set its own, 429 and 5xx retried with jittered exponential
+    backoff, and a rate limit token taken before each request
+    """
+
+    def __init__(self, timeout=(3.05, 20), retries=3, backoff=0.5, pool_size=20, limiter=None):
+        super().__init__()
+        self.timeout = timeout
+        self.limiter = limiter
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            backoff_jitter=backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=None,
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        if self.limiter is not None:
+            self.limiter.acquire()
+        return super().request(method, url, *args, **kwargs)
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    The process-wide upstream session, created on first use from the
+    UPSTREAM_* settings. A forked worker builds its own instead of sharing
+    its parent's sockets
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            config = dict(DEFAULTS)
+            if has_app_context():
+                config.update({name: current_app.config[name] for name in DEFAULTS if name in current_app.config})
+            _session = UpstreamSession(
+                timeout=(config['UPSTREAM_CONNECT_TIMEOUT'], config['UPSTREAM_READ_TIMEOUT']),
+                retries=config['UPSTREAM_RETRIES'],
+                backoff=config['UPSTREAM_BACKOFF'],
+                pool_size=config['UPSTREAM_POOL_SIZE'],
+                limiter=RedisRateLimiter(config['UPSTREAM_RATE_LIMIT'], config['UPSTREAM_RATE_BURST'])
+            )
+            _session_pid = os.getpid()
+        return _session
@@ -1,90 +1,300 @@
 """
-Service for working with Yahoo Finance API
+Service for market data: Yahoo Finance, or the provider configured in MARKET_DATA_PROVIDER
 """
-import requests
+import math
+import re
 from datetime import datetime
 import yfinance as yf
 import pandas as pd
-from ..extensions import cache, db
-from ..models.asset import Asset, AssetPrice, AssetMetric
+from sqlalchemy import func
+from ..extensions import db, market_data
+from ..models.asset import Asset, AssetPrice, AssetQuote, AssetMetric, Dividend
+from ..utils.db import upsert
+from .cache import single_flight
+from .market_data import MarketDataProvider
+from .upstream import get_session
+
+# AssetMetric column -> .info key
+METRIC_FIELDS = {
+    'pe_ratio': 'trailingPE',
+    'pb_ratio': 'priceToBook',
+    'dividend_yield': 'dividendYield',
+    'market_cap': 'marketCap',
+    'eps': 'trailingEps',
+    'revenue': 'totalRevenue',
+    'profit_margin': 'profitMargins',
+    'debt_to_equity': 'debtToEquity'
+}
+SEARCH_URL = 'https://query2.finance.yahoo.com/v1/finance/search'
+# Yahoo symbols: AAPL, BRK-B, SAP.DE, EURUSD=X, ^GSPC
+TICKER_PATTERN = re.compile(r'^\^?[A-Z0-9][A-Z0-9.=-]{0,19}$')
+
+
+class YahooProvider(MarketDataProvider):
+    """Yahoo Finance through yfinance, on the shared upstream session"""
+
+    name = 'yahoo'
+
+    def ticker(self, ticker):
+        return yf.Ticker(ticker, session=get_session())
+
+    def quote(self, ticker):
+        last_quote = self.ticker(ticker).history(period="1d")
+        if not last_quote.empty:
+            return float(last_quote['Close'].iloc[-1])
+        return None
+
+    def bars(self, tickers, period='5d', start=None):
+        span = {'start': start} if start else {'period': period}
+        data = yf.download(
+            tickers, group_by="ticker", auto_adjust=True,
+            threads=True, progress=False, session=get_session(), **span
+        )
+        if data is None or data.empty:
+            return {}
+
+        bars = {}
+        for ticker in tickers:
+            if isinstance(data.columns, pd.MultiIndex):
+                if ticker not in data.columns.get_level_values(0):
+                    continue
+                bars[ticker] = data[ticker]
+            else:
+                bars[ticker] = data
+        return bars
+
+    def history(self, ticker_data, period='1y', start=None):
+        if start:
+            return ticker_data.history(start=start)
+        return ticker_data.history(period=period)
+
+    def info(self, ticker_data):
+        return ticker_data.info
+
+    def dividends(self, ticker_data):
+        return ticker_data.dividends
+
+    def search(self, query, limit=10):
+        params = {
+            'q': query,
+            'quotesCount': limit,
+            'newsCount': 0
+        }
+
+        response = get_session().get(SEARCH_URL, params=params)
+        if response.status_code != 200:
+            return []
+        return [
+            {
+                'ticker': item.get('symbol'),
+                'name': item.get('longname', item.get('shortname', '')),
+                'exchange': item.get('exchange', ''),
+                'type': item.get('quoteType', '')
+            }
+            for item in response.json().get('quotes', [])
+        ]
 
 
 class YahooFinanceService:
-    """Service for interacting with Yahoo Finance API"""
+    """Service for market data, fetched through the configured provider"""
+
+    @staticmethod
+    def ticker(ticker):
+        """
+        Provider handle of a ticker (a yfinance Ticker for Yahoo), one per
+        sync so its sub-steps share it
+        """
+        return market_data.provider.ticker(ticker)
 
     @staticmethod
-    @cache.memoize(timeout=300)  # Cache for 5 minutes
+    @single_flight(timeout=300, grace=300)  # Fresh for 5 minutes, stale for 5 more
     def get_current_price(ticker):
         """
         Get the current price of an asset
         """
         try:
-            ticker_data = yf.Ticker(ticker)
-            # Get the latest data
-            last_quote = ticker_data.history(period="1d")
-            if not last_quote.empty:
-                return float(last_quote['Close'].iloc[-1])
-            return None
+            return market_data.provider.quote(ticker)
         except Exception as e:
             print(f"Error fetching price for {ticker}: {e}")
             return None
 
     @staticmethod
-    @cache.memoize(timeout=3600)  # Cache for 1 hour
-    def get_stock_info(ticker):
+    def get_current_prices(tickers):
+        """
+        Get the current prices of many assets: {ticker: price or None}
+        Tickers already in the get_current_price cache are served from it,
+        the rest are fetched together in one batched download
+        """
+        return YahooFinanceService.get_current_price.get_many(tickers, YahooFinanceService._download_prices)
+
+    @staticmethod
+    def get_cached_prices(tickers):
         """
-        Get information about an asset
+        Prices of the tickers found in the get_current_price cache, never calls upstream
+        """
+        return YahooFinanceService.get_current_price.peek_many(tickers)
+
+    @staticmethod
+    def refresh_current_prices(tickers):
+        """
+        Fetch the current prices of many assets bypassing the cache, then
+        write them to the cache and the quote table, and upsert the latest bar
+        as an AssetPrice row
+        """
+        tickers = list(dict.fromkeys(tickers))
+        if not tickers:
+            return {}
+
+        bars = YahooFinanceService._download_bars(tickers)
+        prices = {ticker: float(frame['Close'].iloc[-1]) for ticker, frame in bars.items()}
+        YahooFinanceService._cache_prices(prices)
+
+        asset_ids = dict(db.session.query(Asset.ticker, Asset.id).filter(Asset.ticker.in_(list(bars))).all())
+        rows = []
+        for ticker, frame in bars.items():
+            if ticker in asset_ids:
+                rows.extend(YahooFinanceService._price_rows(asset_ids[ticker], frame.iloc[-1:]))
+        YahooFinanceService._invalidate_snapshots(rows)
+        upsert(
+            AssetPrice, rows,
+            index_elements=['asset_id', 'date'],
+            update_columns=['open', 'high', 'low', 'close', 'volume']
+        )
+        YahooFinanceService.save_quotes(rows, market_data.provider.name)
+        db.session.commit()
+
+        return prices
+
+    @staticmethod
+    def _cache_prices(prices):
+        """
+        Store prices as fresh get_current_price cache entries
+        """
+        YahooFinanceService.get_current_price.store_many(prices)
+
+    @staticmethod
+    def _download_prices(tickers):
+        """
+        Latest close of every ticker from one batched download
+        """
+        bars = YahooFinanceService._download_bars(tickers)
+        return {ticker: float(frame['Close'].iloc[-1]) for ticker, frame in bars.items()}
+
+    @staticmethod
+    def _download_bars(tickers, period="5d", start=None):
+        """
+        Recent daily bars (of period, or since start) of every ticker from one
+        batched download: {ticker: DataFrame}
+        Tickers without any close are left out
         """
         try:
-            ticker_data = yf.Ticker(ticker)
-            info = ticker_data.info
-
-            # Basic information
-            result = {
-                'ticker': ticker,
-                'name': info.get('longName', info.get('shortName', ticker)),
-                'currency': info.get('currency', 'USD'),
-                'exchange': info.get('exchange', ''),
-                'sector': info.get('sector', ''),
-                'industry': info.get('industry', '')
-            }
+            bars = {}
+            for ticker, frame in market_data.provider.bars(tickers, period, start).items():
+                # Markets close on different days, keep each ticker's own last bar
+                frame = frame[frame['Close'].notna()]
+                if not frame.empty:
+                    bars[ticker] = frame
+            return bars
+        except Exception as e:
+            print(f"Error fetching prices for {', '.join(tickers)}: {e}")
+            return {}
 
-            # Determine asset type
-            if 'quoteType' in info:
-                if info['quoteType'] == 'EQUITY':
-                    result['asset_type'] = 'stock'
-                elif info['quoteType'] == 'ETF':
-                    result['asset_type'] = 'etf'
-                elif info['quoteType'] == 'BOND':
-                    result['asset_type'] = 'bond'
-                else:
-                    result['asset_type'] = 'other'
-            else:
-                result['asset_type'] = 'stock'  # Default
+    @staticmethod
+    @single_flight(timeout=3600, grace=3600)  # Fresh for 1 hour, stale for 1 more
+    def get_info(ticker):
+        """
+        Raw .info payload of an asset, one upstream call shared by its stock
+        info and its metrics
+        """
+        return YahooFinanceService._fetch_info(YahooFinanceService.ticker(ticker))
 
-            return result
+    @staticmethod
+    def _fetch_info(ticker_data):
+        try:
+            return market_data.provider.info(ticker_data) or None
         except Exception as e:
-            print(f"Error fetching info for {ticker}: {e}")
+            print(f"Error fetching info for {ticker_data.ticker}: {e}")
+            return None
+
+    @staticmethod
+    def get_stock_info(ticker, info=None):
+        """
+        Get information about an asset, from an already fetched .info payload when given
+        """
+        info = info or YahooFinanceService.get_info(ticker)
+        if not info:
             return None
 
+        # Basic information
+        result = {
+            'ticker': ticker,
+            'name': info.get('longName', info.get('shortName', ticker)),
+            'currency': info.get('currency', 'USD'),
+            'exchange': info.get('exchange', ''),
+            'sector': info.get('sector', ''),
+            'industry': info.get('industry', '')
+        }
+
+        # Determine asset type
+        if 'quoteType' in info:
+            if info['quoteType'] == 'EQUITY':
+                result['asset_type'] = 'stock'
+            elif info['quoteType'] == 'ETF':
+                result['asset_type'] = 'etf'
+            elif info['quoteType'] == 'BOND':
+                result['asset_type'] = 'bond'
+            else:
+                result['asset_type'] = 'other'
+        else:
+            result['asset_type'] = 'stock'  # Default
+
+        return result
+
     @staticmethod
-    def update_asset_historical_data(ticker, period='1y'):
+    def sync_asset(ticker):
         """
-        Update historical data for an asset
+        Refresh or add an asset with its info and historical data
+        """
+        ticker_data = YahooFinanceService.ticker(ticker)
+        info = YahooFinanceService.get_info.get_many(
+            [ticker], lambda missing: {ticker: YahooFinanceService._fetch_info(ticker_data)})[ticker]
+        asset_info = YahooFinanceService.get_stock_info(ticker, info)
+        if not asset_info:
+            raise ValueError('Invalid ticker symbol')
+
+        asset = Asset.query.filter_by(ticker=ticker).first()
+        if not asset:
+            asset = Asset(**asset_info)
+            db.session.add(asset)
+        else:
+            for key, value in asset_info.items():
+                setattr(asset, key, value)
+
+        db.session.commit()
+        if not YahooFinanceService.update_asset_historical_data(ticker, info=info, ticker_data=ticker_data):
+            raise RuntimeError('Historical data update failed')
+        return asset
+
+    @staticmethod
+    def update_asset_historical_data(ticker, period='1y', info=None, ticker_data=None):
+        """
+        Update historical data for an asset, info: its .info payload when
+        already fetched, ticker_data: the Ticker to reuse
         """
         try:
             asset = Asset.query.filter_by(ticker=ticker).first()
             if not asset:
-                info = YahooFinanceService.get_stock_info(ticker)
-                if info:
+                info = info or YahooFinanceService.get_info(ticker)
+                asset_info = YahooFinanceService.get_stock_info(ticker, info)
+                if asset_info:
                     asset = Asset(
                         ticker=ticker,
-                        name=info['name'],
-                        asset_type=info['asset_type'],
-                        currency=info['currency'],
-                        exchange=info['exchange'],
-                        sector=info['sector'],
-                        industry=info['industry']
+                        name=asset_info['name'],
+                        asset_type=asset_info['asset_type'],
+                        currency=asset_info['currency'],
+                        exchange=asset_info['exchange'],
+                        sector=asset_info['sector'],
+                        industry=asset_info['industry']
                     )
                     db.session.add(asset)
                     db.session.commit()
@@ -92,31 +302,14 @@ class YahooFinanceService:
             if not asset:
                 return False
 
-            # Get historical data
-            ticker_data = yf.Ticker(ticker)
-            hist_data = ticker_data.history(period=period)
-
-            # Delete old data
-            AssetPrice.query.filter_by(asset_id=asset.id).delete()
-
-            # Add new data
-            for date, row in hist_data.iterrows():
-                price = AssetPrice(
-                    asset_id=asset.id,
-                    date=date.date(),
-                    open=float(row['Open']) if 'Open' in row and pd.notnull(row['Open']) else None,
-                    high=float(row['High']) if 'High' in row and pd.notnull(row['High']) else None,
-                    low=float(row['Low']) if 'Low' in row and pd.notnull(row['Low']) else None,
-                    close=float(row['Close']) if 'Close' in row and pd.notnull(row['Close']) else None,
-                    volume=int(row['Volume']) if 'Volume' in row and pd.notnull(row['Volume']) else None
-                )
-                db.session.add(price)
+            ticker_data = ticker_data or YahooFinanceService.ticker(ticker)
+            YahooFinanceService.update_asset_prices(asset, period, ticker_data)
 
             # Update metrics
-            YahooFinanceService.update_asset_metrics(asset)
+            YahooFinanceService.update_asset_metrics(asset, info)
 
             # Update dividends
-            YahooFinanceService.update_dividends(asset)
+            YahooFinanceService.update_dividends(asset, ticker_data)
 
             db.session.commit()
             return True
@@ -126,59 +319,141 @@ class YahooFinanceService:
             return False
 
     @staticmethod
-    def update_asset_metrics(asset):
+    def update_asset_prices(asset, period='1y', ticker_data=None):
+        """
+        Upsert daily prices of an asset, from the latest stored date on
+        """
+        # Only fetch bars from the latest stored date on, the last one may have been partial
+        latest_date = db.session.query(func.max(AssetPrice.date)).filter(
+            AssetPrice.asset_id == asset.id).scalar()
+
+        ticker_data = ticker_data or YahooFinanceService.ticker(asset.ticker)
+        hist_data = market_data.provider.history(ticker_data, period, start=latest_date)
+
+        rows = YahooFinanceService._price_rows(asset.id, hist_data)
+        YahooFinanceService._invalidate_snapshots(rows)
+        upsert(
+            AssetPrice, rows,
+            index_elements=['asset_id', 'date'],
+            update_columns=['open', 'high', 'low', 'close', 'volume']
+        )
+        YahooFinanceService.save_quotes(rows[-1:], 'history')
+        return True
+
+    @staticmethod
+    def _invalidate_snapshots(rows):
         """
-        Update financial metrics of an asset
+        Snapshots valued with bars that rows change are rebuilt on next read,
+        called before rows are upserted
+        """
+        # Imported here, snapshots depend on this module through FxService
+        from .snapshots import SnapshotService
+        SnapshotService.invalidate_prices(rows)
+
+    @staticmethod
+    def save_quotes(rows, source):
+        """
+        Upsert the latest quote of each asset from AssetPrice rows, a quote of
+        a later session than the row's is kept
+        """
+        latest = {}
+        for row in rows:
+            if row['asset_id'] not in latest or row['date'] >= latest[row['asset_id']]['date']:
+                latest[row['asset_id']] = row
+        if not latest:
+            return
+
+        stored = dict(db.session.query(AssetQuote.asset_id, AssetQuote.session_date).filter(
+            AssetQuote.asset_id.in_(list(latest))).all())
+        now = datetime.utcnow()
+        upsert(
+            AssetQuote,
+            [
+                {'asset_id': asset_id, 'price': row['close'], 'session_date': row['date'],
+                 'quoted_at': now, 'source': source, 'updated_at': now}
+                for asset_id, row in latest.items()
+                if asset_id not in stored or stored[asset_id] <= row['date']
+            ],
+            index_elements=['asset_id'],
+            update_columns=['price', 'session_date', 'quoted_at', 'source', 'updated_at']
+        )
+
+    @staticmethod
+    def _price_rows(asset_id, hist_data):
+        """
+        Convert a history DataFrame to AssetPrice rows column-wise
+        """
+        if hist_data is None or hist_data.empty:
+            return []
+
+        frame = hist_data.reindex(columns=['Open', 'High', 'Low', 'Close', 'Volume'])
+        frame = frame[frame['Close'].notna()]
+        if frame.empty:
+            return []
+
+        rows = pd.DataFrame({
+            'asset_id': asset_id,
+            'date': frame.index.date,
+            'open': frame['Open'].to_numpy(),
+            'high': frame['High'].to_numpy(),
+            'low': frame['Low'].to_numpy(),
+            'close': frame['Close'].to_numpy(),
+            'volume': frame['Volume'].round().astype('Int64').to_numpy()
+        })
+        # NaN/NA to None, numpy scalars to plain Python values
+        rows = rows.astype(object).where(rows.notna(), None)
+        return rows.to_dict('records')
+
+    @staticmethod
+    def update_asset_metrics(asset, info=None):
+        """
+        Upsert today's financial metrics of an asset, earlier days are kept
+        as history. info: its .info payload when already fetched
         """
         try:
-            ticker_data = yf.Ticker(asset.ticker)
-            info = ticker_data.info
-
-            # Delete old metrics
-            AssetMetric.query.filter_by(asset_id=asset.id).delete()
-
-            # Create new metrics record
-            metrics = AssetMetric(
-                asset_id=asset.id,
-                date=datetime.now().date(),
-                pe_ratio=info.get('trailingPE'),
-                pb_ratio=info.get('priceToBook'),
-                dividend_yield=info.get('dividendYield'),
-                market_cap=info.get('marketCap'),
-                eps=info.get('trailingEps'),
-                revenue=info.get('totalRevenue'),
-                profit_margin=info.get('profitMargins'),
-                debt_to_equity=info.get('debtToEquity')
-            )
-            db.session.add(metrics)
+            info = info or YahooFinanceService.get_info(asset.ticker)
+            if not info:
+                return False
+
+            row = {'asset_id': asset.id, 'date': datetime.utcnow().date()}
+            for column, key in METRIC_FIELDS.items():
+                value = info.get(key)
+                # Missing values come as None, 'Infinity' or NaN
+                row[column] = float(value) if isinstance(value, (int, float)) and math.isfinite(value) else None
+
+            upsert(AssetMetric, [row], index_elements=['asset_id', 'date'], update_columns=list(METRIC_FIELDS))
             return True
         except Exception as e:
             print(f"Error updating metrics for {asset.ticker}: {e}")
             return False
 
     @staticmethod
-    def update_dividends(asset):
+    def update_dividends(asset, ticker_data=None):
         """
-        Update dividend information
+        Upsert dividends of an asset, from the latest stored ex-date on
         """
         try:
-            ticker_data = yf.Ticker(asset.ticker)
+            ticker_data = ticker_data or YahooFinanceService.ticker(asset.ticker)
 
             # Get dividend data
-            dividends = ticker_data.dividends
+            dividends = market_data.provider.dividends(ticker_data)
+
+            latest = db.session.query(Dividend.ex_date, Dividend.amount).filter(
+                Dividend.asset_id == asset.id
+            ).order_by(Dividend.ex_date.desc()).first()
 
-            # Delete old dividend records
-            Dividend.query.filter_by(asset_id=asset.id).delete()
+            # The latest stored payment is sent again in case it was corrected
+            rows = [
+                {'asset_id': asset.id, 'ex_date': day.date(), 'amount': round(float(amount), 6)}
+                for day, amount in dividends.items()
+                if latest is None or day.date() >= latest.ex_date
+            ]
+            upsert(Dividend, rows, index_elements=['asset_id', 'ex_date'], update_columns=['amount'])
 
-            # Add new dividend records
-            for date, amount in dividends.items():
-                div = Dividend(
-                    asset_id=asset.id,
-                    ex_date=date.date(),
-                    payment_date=None,  # For simplicity, not filling payment date
-                    amount=float(amount)
-                )
-                db.session.add(div)
+            if any(latest is None or row['ex_date'] > latest.ex_date or row['amount'] != float(latest.amount)
+                   for row in rows):
+                # Cached dividend income is dropped once this is committed
+                db.session.info['dividends_changed'] = True
 
             return True
         except Exception as e:
@@ -191,28 +466,7 @@ class YahooFinanceService:
         Search for stock tickers by query
         """
         try:
-            # Use Yahoo Finance API for search
-            url = f"https://query2.finance.yahoo.com/v1/finance/search"
-            params = {
-                'q': query,
-                'quotesCount': 10,
-                'newsCount': 0
-            }
-
-            response = requests.get(url, params=params)
-            if response.status_code == 200:
-                data = response.json()
-                if 'quotes' in data:
-                    return [
-                        {
-                            'ticker': item.get('symbol'),
-                            'name': item.get('longname', item.get('shortname', '')),
-                            'exchange': item.get('exchange', ''),
-                            'type': item.get('quoteType', '')
-                        }
-                        for item in data['quotes']
-                    ]
-            return []
+            return market_data.provider.search(query)
         except Exception as e:
             print(f"Error searching tickers: {e}")
             return []
\ No newline at end of file
@@ -0,0 +1,38 @@
+"""
+Database helpers
+"""
+from ..extensions import db
+
+
+def upsert(model, rows, index_elements, update_columns, chunk_size=1000, session=None):
+    """
+    Insert rows in chunked multi-row statements, updating update_columns
+    when a row with the same index_elements (a unique key) already exists.
+    Uses INSERT ... ON DUPLICATE KEY UPDATE on MySQL and
+    INSERT ... ON CONFLICT DO UPDATE elsewhere. Returns the number of rows sent.
+    """
+    if not rows:
+        return 0
+
+    session = session or db.session
+    dialect = session.get_bind().dialect.name
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+
+    table = model.__table__
+    for start in range(0, len(rows), chunk_size):
+        stmt = insert(table).values(rows[start:start + chunk_size])
+        if dialect == 'mysql':
+            stmt = stmt.on_duplicate_key_update({col: stmt.inserted[col] for col in update_columns})
+        else:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=index_elements,
+                set_={col: stmt.excluded[col] for col in update_columns}
+            )
+        session.execute(stmt)
+
+    return len(rows)
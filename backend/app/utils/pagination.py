@@ -0,0 +1,42 @@
+"""
+Keyset pagination helpers
+"""
+import base64
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+
+def encode_cursor(*values):
+    """
+    Opaque cursor from the sort key of the last row of a page, decimals
+    are kept as strings so the next page compares against the exact value
+    """
+    payload = [
+        {'dt': value.isoformat()} if isinstance(value, datetime)
+        else {'d': value.isoformat()} if isinstance(value, date)
+        else {'n': str(value)} if isinstance(value, Decimal)
+        else value
+        for value in values
+    ]
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Sort key values of a cursor, raises ValueError when malformed"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception as e:
+        raise ValueError('Invalid cursor') from e
+    if not isinstance(payload, list):
+        raise ValueError('Invalid cursor')
+    try:
+        return [
+            datetime.fromisoformat(value['dt']) if isinstance(value, dict) and 'dt' in value
+            else date.fromisoformat(value['d']) if isinstance(value, dict) and 'd' in value
+            else Decimal(value['n']) if isinstance(value, dict) and 'n' in value
+            else value
+            for value in payload
+        ]
+    except (ArithmeticError, TypeError) as e:
+        raise ValueError('Invalid cursor') from e
@@ -0,0 +1,94 @@
+"""
+JSON provider for API responses: orjson when installed, stdlib otherwise
+"""
+import json
+import math
+from datetime import date, datetime, time
+from decimal import Decimal
+from flask.json.provider import JSONProvider
+from sqlalchemy.engine import Row, RowMapping
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+
+def default(obj):
+    """Types neither encoder handles by itself"""
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, Row):
+        return tuple(obj)
+    if isinstance(obj, RowMapping):
+        return dict(obj)
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()  # numpy scalars and arrays
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+class FiniteJSONEncoder(json.JSONEncoder):
+    """
+    stdlib encoder writing NaN and infinities as null, as orjson does.
+    Payloads of finite floats go through the C encoder as they are, the
+    others are encoded again by the pure Python one with null for them
+    """
+
+    def encode(self, o):
+        try:
+            return super().encode(o)
+        except ValueError:
+            if self.allow_nan:
+                raise
+            return ''.join(self.iterencode_finite(o))
+
+    def iterencode_finite(self, o):
+        def floatstr(value):
+            return float.__repr__(value) if math.isfinite(value) else 'null'
+
+        encoder = json.encoder.encode_basestring_ascii if self.ensure_ascii else json.encoder.encode_basestring
+        return json.encoder._make_iterencode(
+            {} if self.check_circular else None, self.default, encoder, self.indent, floatstr,
+            self.key_separator, self.item_separator, self.sort_keys, self.skipkeys, False
+        )(o, 0)
+
+
+class FastJSONProvider(JSONProvider):
+    """
+    Serializes Decimal, date and datetime values and SQLAlchemy rows as they
+    are, so Core results can be returned without building a dict per row.
+    Uses orjson when it is installed, the stdlib json module otherwise;
+    both write NaN and infinities as null.
+    """
+
+    ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY) if orjson else 0
+
+    def dumps_bytes(self, obj, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.dumps(obj, default=default, option=self.ORJSON_OPTIONS)
+        return self.dumps_stdlib(obj, **kwargs).encode()
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.dumps(obj, default=default, option=self.ORJSON_OPTIONS).decode()
+        return self.dumps_stdlib(obj, **kwargs)
+
+    @staticmethod
+    def dumps_stdlib(obj, **kwargs):
+        encode = kwargs.pop('default', default)
+        kwargs.setdefault('separators', (',', ':'))
+        kwargs.setdefault('ensure_ascii', False)
+        kwargs.setdefault('allow_nan', False)
+        kwargs.setdefault('cls', FiniteJSONEncoder)
+        return json.dumps(obj, default=encode, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj), mimetype='application/json')
@@ -0,0 +1,103 @@
+"""
+Microbenchmark of API JSON serialization: the stdlib provider on to_dict()
+rows against FastJSONProvider on to_dict() rows and on Core result rows.
+
+    python benchmarks/bench_json.py [--rows 5000] [--repeat 20]
+"""
+import argparse
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for key in ('SECRET_KEY', 'JWT_SECRET_KEY', 'YAHOO_FINANCE_API_KEY'):
+    os.environ.setdefault(key, 'benchmark-secret-key-at-least-32-bytes')
+os.environ.setdefault('REDIS_URL', 'redis://localhost:6379/0')
+for key in ('DEV_DATABASE_URL', 'TEST_DATABASE_URL', 'DATABASE_URL'):
+    os.environ.setdefault(key, 'sqlite://')
+
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import insert, select
+from sqlalchemy.orm import joinedload
+
+from app import create_app
+from app.extensions import db
+from app.models.asset import Asset
+from app.models.portfolio import Portfolio
+from app.models.transaction import Transaction
+from app.models.user import User
+from app.utils import serialization
+from app.utils.serialization import FastJSONProvider
+
+
+def seed(rows):
+    user = User(username='bench', email='bench@example.com', password_hash='-')
+    assets = [Asset(ticker=f'T{i:03d}', name=f'Ticker {i}', asset_type='stock', currency='USD') for i in range(50)]
+    db.session.add_all([user] + assets)
+    db.session.flush()
+    portfolio = Portfolio(user_id=user.id, name='Benchmark')
+    db.session.add(portfolio)
+    db.session.flush()
+    db.session.execute(insert(Transaction), [
+        {'portfolio_id': portfolio.id, 'asset_id': assets[i % 50].id, 'transaction_type': 'buy',
+         'quantity': '1.5', 'price': '101.25', 'fee': '0.99',
+         'transaction_date': datetime(2020, 1, 1) + timedelta(hours=i)}
+        for i in range(rows)
+    ])
+    db.session.commit()
+    return portfolio.id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        portfolio_id = seed(args.rows)
+
+        transactions = Transaction.query.options(joinedload(Transaction.asset)).filter_by(
+            portfolio_id=portfolio_id).all()
+        columns = [
+            Transaction.id, Transaction.transaction_type, Transaction.quantity, Transaction.price,
+            Transaction.fee, Transaction.transaction_date, Asset.ticker
+        ]
+        core_rows = db.session.execute(
+            select(*columns).join(Asset, Transaction.asset_id == Asset.id).where(
+                Transaction.portfolio_id == portfolio_id)
+        ).all()
+
+        stdlib = DefaultJSONProvider(app)
+        fast = FastJSONProvider(app)
+        name = 'orjson' if serialization.orjson else 'stdlib'
+        dicts = {'transactions': [t.to_dict(include_asset=True) for t in transactions]}
+        cases = [
+            ('stdlib, encode only', lambda: stdlib.dumps(dicts)),
+            (f'{name} provider, encode only', lambda: fast.dumps_bytes(dicts)),
+            ('stdlib, to_dict rows', lambda: stdlib.dumps(
+                {'transactions': [t.to_dict(include_asset=True) for t in transactions]})),
+            (f'{name} provider, to_dict rows', lambda: fast.dumps_bytes(
+                {'transactions': [t.to_dict(include_asset=True) for t in transactions]})),
+            (f'{name} provider, Core rows', lambda: fast.dumps_bytes(
+                {'columns': [column.key for column in columns], 'rows': core_rows})),
+        ]
+
+        print(f'{args.rows} transactions, best of {args.repeat} runs')
+        baseline = None
+        for label, case in cases:
+            best = min(timeit.repeat(case, number=1, repeat=args.repeat))
+            if label.startswith('stdlib, to_dict'):
+                baseline = best
+            speedup = f'{baseline / best:5.1f}x' if baseline else '     '
+            print(f'  {label:<32} {best * 1000:8.2f} ms  {speedup}  {len(case()):>9} bytes')
+
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
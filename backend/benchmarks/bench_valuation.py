@@ -0,0 +1,135 @@
+"""
+Throughput of the portfolio valuation endpoints on the offline market data
+provider: synthetic assets are synced through the local provider, then every
+endpoint is hit from a pool of client threads. Nothing goes to Yahoo.
+
+    python benchmarks/bench_valuation.py [--assets 200] [--portfolios 20] [--requests 200] [--threads 8]
+                                         [--latency 0.0] [--fixtures DIR]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for key in ('SECRET_KEY', 'JWT_SECRET_KEY', 'YAHOO_FINANCE_API_KEY'):
+    os.environ.setdefault(key, 'benchmark-secret-key-at-least-32-bytes')
+os.environ.setdefault('REDIS_URL', 'redis://localhost:6379/0')
+DATABASE = os.path.join(tempfile.mkdtemp(prefix='bench-valuation-'), 'bench.db')
+for key in ('DEV_DATABASE_URL', 'TEST_DATABASE_URL', 'DATABASE_URL'):
+    os.environ[key] = f'sqlite:///{DATABASE}'
+os.environ['MARKET_DATA_PROVIDER'] = 'local'
+
+from flask_jwt_extended import create_access_token
+from sqlalchemy import insert
+
+from app import create_app
+from app.extensions import db, market_data
+from app.models.asset import Asset, AssetPrice
+from app.models.portfolio import Portfolio, Position
+from app.models.transaction import Transaction
+from app.models.user import User
+from app.services.positions import PositionService
+from app.services.yahoo_finance import YahooFinanceService
+
+# Share of synthetic tickers listed in other currencies, so valuations convert
+SUFFIXES = ['', '', '', '', '.DE', '', '.L']
+
+
+def seed(assets, portfolios, holdings):
+    tickers = [f'SYN{i:04d}{SUFFIXES[i % len(SUFFIXES)]}' for i in range(assets)]
+    started = time.perf_counter()
+    for ticker in tickers:
+        YahooFinanceService.sync_asset(ticker)
+    synced = time.perf_counter() - started
+
+    rng = random.Random(0)
+    user = User(username='bench', email='bench@example.com', password_hash='-')
+    db.session.add(user)
+    db.session.flush()
+    asset_ids = [asset_id for (asset_id,) in db.session.query(Asset.id)]
+    ids = []
+    for p in range(portfolios):
+        portfolio = Portfolio(user_id=user.id, name=f'Benchmark {p}')
+        db.session.add(portfolio)
+        db.session.flush()
+        ids.append(portfolio.id)
+        rows = []
+        for asset_id in rng.sample(asset_ids, min(holdings, len(asset_ids))):
+            day = datetime.now() - timedelta(days=rng.randint(30, 360))
+            close = db.session.query(AssetPrice.close).filter(
+                AssetPrice.asset_id == asset_id, AssetPrice.date <= day.date()
+            ).order_by(AssetPrice.date.desc()).limit(1).scalar() or 100
+            rows.append({'portfolio_id': portfolio.id, 'asset_id': asset_id, 'transaction_type': 'buy',
+                         'quantity': rng.randint(1, 100), 'price': close, 'fee': 1, 'transaction_date': day})
+        db.session.execute(insert(Transaction), rows)
+        # Core inserts skip the ORM hooks that maintain positions
+        PositionService.rebuild(portfolio.id)
+    db.session.commit()
+
+    held = Position.query.filter(Position.portfolio_id.in_(ids), Position.quantity > 0).count()
+    assert held == portfolios * min(holdings, len(asset_ids)), f'{held} positions seeded'
+    return user, ids, synced
+
+
+def run(app, headers, paths, threads):
+    """Latency of each request (seconds), status codes other than 200 are counted as errors"""
+    def hit(path):
+        client = app.test_client()
+        started = time.perf_counter()
+        status = client.get(path, headers=headers).status_code
+        return time.perf_counter() - started, status
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        started = time.perf_counter()
+        results = list(executor.map(hit, paths))
+        elapsed = time.perf_counter() - started
+    return [latency for latency, _ in results], sum(status != 200 for _, status in results), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--assets', type=int, default=200)
+    parser.add_argument('--portfolios', type=int, default=20)
+    parser.add_argument('--holdings', type=int, default=15)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every provider call')
+    parser.add_argument('--fixtures', help='Directory of price, dividend and info fixtures')
+    args = parser.parse_args()
+
+    app = create_app('testing')
+    app.config.update(MARKET_DATA_LATENCY=args.latency, MARKET_DATA_PATH=args.fixtures)
+    market_data.init_app(app)
+    with app.app_context():
+        db.create_all()
+        user, ids, synced = seed(args.assets, args.portfolios, args.holdings)
+        headers = {'Authorization': f'Bearer {create_access_token(identity=str(user.id))}'}
+
+    print(f'{args.assets} assets synced in {synced:.1f} s, {args.portfolios} portfolios of {args.holdings} holdings, '
+          f'{args.requests} requests per endpoint on {args.threads} threads, provider latency {args.latency} s')
+    endpoints = [
+        ('list', lambda i: '/api/portfolios/'),
+        ('detail', lambda i: f'/api/portfolios/{ids[i % len(ids)]}'),
+        ('history', lambda i: f'/api/portfolios/{ids[i % len(ids)]}/history'),
+        ('dividends', lambda i: f'/api/portfolios/{ids[i % len(ids)]}/dividends'),
+    ]
+    for label, path in endpoints:
+        paths = [path(i) for i in range(args.requests)]
+        run(app, headers, paths[:len(ids)], args.threads)  # warm caches and snapshots
+        latencies, errors, elapsed = run(app, headers, paths, args.threads)
+        latencies.sort()
+        print(f'  {label:<10} {len(paths) / elapsed:8.1f} req/s  '
+              f'p50 {latencies[len(latencies) // 2] * 1000:7.1f} ms  '
+              f'p95 {latencies[int(len(latencies) * 0.95)] * 1000:7.1f} ms  {errors} errors')
+
+    os.remove(DATABASE)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Shared pytest fixtures
+"""
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Config reads these at import time
+for key in ('SECRET_KEY', 'JWT_SECRET_KEY', 'YAHOO_FINANCE_API_KEY'):
+    os.environ.setdefault(key, 'test-secret-key-at-least-32-bytes-long')
+os.environ.setdefault('REDIS_URL', 'redis://localhost:6379/0')
+for key in ('DEV_DATABASE_URL', 'TEST_DATABASE_URL', 'DATABASE_URL'):
+    os.environ.setdefault(key, 'sqlite://')
+
+from app import create_app
+from app.extensions import db as _db, cache as _cache
+
+
+@pytest.fixture
+def app():
+    app = create_app('testing')
+    with app.app_context():
+        _db.create_all()
+        yield app
+        _db.session.remove()
+        _db.drop_all()
+        _cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    """Tests never reach Yahoo, the ones that need market data patch in their own fakes"""
+    from app.services import yahoo_finance
+
+    def upstream_called(*args, **kwargs):
+        pytest.fail('upstream called')
+
+    monkeypatch.setattr(yahoo_finance.yf, 'download', upstream_called)
+    monkeypatch.setattr(yahoo_finance.yf, 'Ticker', upstream_called)
+    monkeypatch.setattr(yahoo_finance, 'SEARCH_URL', 'http://upstream.invalid/search')
+
+
+@pytest.fixture
+def db(app):
+    return _db
+
+
+@pytest.fixture
+def count_queries(db):
+    """Collects every SQL statement executed inside the block"""
+    from contextlib import contextmanager
+    from sqlalchemy import event
+
+    @contextmanager
+    def counter():
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+    return counter
+
+
+@pytest.fixture
+def user(db):
+    from app.models.user import User
+
+    user = User(username='investor', email='investor@example.com')
+    user.password = 'secret'
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+@pytest.fixture
+def make_asset(db):
+    from app.models.asset import Asset
+
+    def make(ticker, **kwargs):
+        asset = Asset(
+            ticker=ticker,
+            name=kwargs.pop('name', f'{ticker} Inc.'),
+            asset_type=kwargs.pop('asset_type', 'stock'),
+            currency=kwargs.pop('currency', 'USD'),
+            **kwargs
+        )
+        db.session.add(asset)
+        db.session.flush()
+        return asset
+
+    return make
+
+
+@pytest.fixture
+def make_transaction(db):
+    from app.models.transaction import Transaction
+
+    def make(portfolio, asset, transaction_type, quantity, price, **kwargs):
+        transaction = Transaction(
+            portfolio_id=portfolio.id,
+            asset_id=asset.id,
+            transaction_type=transaction_type,
+            quantity=quantity,
+            price=price,
+            fee=kwargs.pop('fee', 0),
+            transaction_date=kwargs.pop('transaction_date', datetime(2024, 1, 2)),
+            **kwargs
+        )
+        db.session.add(transaction)
+        db.session.flush()
+        return transaction
+
+    return make
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def auth_headers(app, user):
+    from flask_jwt_extended import create_access_token
+
+    return {'Authorization': f'Bearer {create_access_token(identity=str(user.id))}'}
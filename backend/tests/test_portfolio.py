@@ -0,0 +1,674 @@
+"""
+Portfolio valuation tests
+"""
+from datetime import datetime
+
+import pytest
+
+from app.models.asset import AssetPrice, AssetQuote
+from app.models.portfolio import Portfolio
+from app.services.market_calendar import MarketCalendar
+
+
+@pytest.fixture
+def portfolio(db, user):
+    portfolio = Portfolio(user_id=user.id, name='Main')
+    db.session.add(portfolio)
+    db.session.commit()
+    return portfolio
+
+
+def add_today_price(db, asset, close):
+    """
+    Bar of the current session, today's while the market is open and the
+    last close otherwise, and the quote a refresh would have written with it
+    """
+    session = MarketCalendar.local_now().date() if MarketCalendar.is_open() else MarketCalendar.last_closed_session()
+    db.session.add(AssetPrice(asset_id=asset.id, date=session, close=close))
+    db.session.add(AssetQuote(asset_id=asset.id, price=close, session_date=session, quoted_at=datetime.utcnow(),
+                              source='yahoo'))
+
+
+def test_assets_summary_values_positions(db, portfolio, make_asset, make_transaction):
+    aapl = make_asset('AAPL')
+    msft = make_asset('MSFT')
+    make_transaction(portfolio, aapl, 'buy', 10, 100)
+    make_transaction(portfolio, aapl, 'buy', 10, 200)
+    make_transaction(portfolio, aapl, 'sell', 5, 250)
+    make_transaction(portfolio, msft, 'buy', 3, 50)
+    make_transaction(portfolio, msft, 'sell', 3, 60)
+    add_today_price(db, aapl, 300)
+    add_today_price(db, msft, 70)
+    db.session.commit()
+
+    summary = portfolio.get_assets_summary()
+
+    assert len(summary) == 1  # MSFT fully sold
+    aapl_row = summary[0]
+    assert aapl_row['ticker'] == 'AAPL'
+    assert aapl_row['quantity'] == 15
+    assert aapl_row['avg_buy_price'] == 150
+    assert aapl_row['cost_basis'] == 2250
+    assert aapl_row['current_price'] == 300
+    assert aapl_row['total_value'] == 4500
+    assert aapl_row['profit'] == 2250
+    assert aapl_row['profit_percent'] == 100
+
+
+def test_assets_summary_query_count_is_constant(db, portfolio, make_asset, make_transaction, count_queries):
+    for i in range(150):
+        asset = make_asset(f'T{i}')
+        make_transaction(portfolio, asset, 'buy', 1, 10)
+        make_transaction(portfolio, asset, 'buy', 1, 20)
+        add_today_price(db, asset, 30)
+    db.session.commit()
+    db.session.refresh(portfolio)
+
+    with count_queries() as statements:
+        summary = portfolio.get_assets_summary()
+
+    assert len(summary) == 150
+    assert all(row['total_value'] == 60 for row in summary)
+    assert len(statements) <= 2
+
+
+def test_to_dict_values_portfolio_once(db, portfolio, make_asset, make_transaction, count_queries):
+    aapl = make_asset('AAPL')
+    make_transaction(portfolio, aapl, 'buy', 10, 100)
+    make_transaction(portfolio, aapl, 'sell', 4, 150)
+    add_today_price(db, aapl, 200)
+    db.session.commit()
+    db.session.refresh(portfolio)
+
+    with count_queries() as statements:
+        result = portfolio.to_dict(include_assets=True)
+
+    assert result['total_value'] == 1200
+    assert result['total_profit'] == (1200 + 600) - 1000
+    assert result['assets'][0]['total_value'] == 1200
+    assert len(statements) <= 2
+
+
+def test_value_portfolios_shares_price_lookup(db, user, make_asset, make_transaction, count_queries):
+    portfolios = [Portfolio(user_id=user.id, name=f'P{i}') for i in range(5)]
+    db.session.add_all(portfolios)
+    db.session.flush()
+    aapl = make_asset('AAPL')
+    for portfolio in portfolios:
+        make_transaction(portfolio, aapl, 'buy', 1, 100)
+    add_today_price(db, aapl, 110)
+    db.session.commit()
+    for portfolio in portfolios:
+        db.session.refresh(portfolio)
+
+    from app.services.portfolio_service import PortfolioService
+    with count_queries() as statements:
+        valuations = PortfolioService.value_portfolios(portfolios)
+
+    assert [valuations[p.id].total_profit for p in portfolios] == [10] * 5
+    assert len(statements) <= 2
+
+
+def test_snapshots_roll_forward_and_rebuild_after_backdated_trade(db, portfolio, make_asset, make_transaction):
+    from datetime import date
+    from app.models.portfolio import PortfolioSnapshot
+    from app.services.charts import ChartService
+    from app.services.snapshots import SnapshotService
+
+    aapl = make_asset('AAPL')
+    make_transaction(portfolio, aapl, 'buy', 10, 100, transaction_date=datetime(2024, 1, 2, 15))
+    for day, close in [(2, 100), (3, 110), (5, 120)]:  # no bar on the 4th
+        db.session.add(AssetPrice(asset_id=aapl.id, date=date(2024, 1, day), close=close))
+    db.session.commit()
+
+    assert SnapshotService.build(portfolio.id, until=date(2024, 1, 5)) == 4
+    history = [s.to_dict() for s in SnapshotService.get_history(portfolio.id, end=date(2024, 1, 5))]
+    assert [h['value'] for h in history] == [1000, 1100, 1100, 1200]
+    assert [h['cash_flow'] for h in history] == [1000, 0, 0, 0]
+    assert SnapshotService.build(portfolio.id, until=date(2024, 1, 5)) == 0
+
+    # A back-dated sell drops snapshots from its day on
+    make_transaction(portfolio, aapl, 'sell', 5, 110, transaction_date=datetime(2024, 1, 3, 10))
+    db.session.commit()
+    assert PortfolioSnapshot.query.filter_by(portfolio_id=portfolio.id).count() == 1
+
+    assert SnapshotService.build(portfolio.id, until=date(2024, 1, 5)) == 3
+    history = [s.to_dict() for s in SnapshotService.get_history(portfolio.id, end=date(2024, 1, 5))]
+    assert [h['value'] for h in history] == [1000, 550, 550, 600]
+    assert [h['cost_basis'] for h in history] == [1000, 450, 450, 450]
+
+    series = ChartService.portfolio_series(portfolio.id, end=date(2024, 1, 5), points=3)
+    assert series == {'date': ['2024-01-02', '2024-01-03', '2024-01-05'], 'value': [1000, 550, 600]}
+
+
+def test_snapshots_stop_at_last_close_and_rebuild_after_price_sync(db, portfolio, make_asset, make_transaction):
+    from datetime import date
+    import pandas as pd
+    from app.models.portfolio import PortfolioSnapshot
+    from app.services.snapshots import SnapshotService
+    from app.services.yahoo_finance import YahooFinanceService
+
+    class BarsTicker:
+        def history(self, **kwargs):
+            return pd.DataFrame({'Close': [130.0]}, index=pd.DatetimeIndex([date(2024, 1, 3)]))
+
+    aapl = make_asset('AAPL')
+    make_transaction(portfolio, aapl, 'buy', 10, 100, transaction_date=datetime(2024, 1, 2, 15))
+    for day, close in [(2, 100), (3, 110)]:
+        db.session.add(AssetPrice(asset_id=aapl.id, date=date(2024, 1, day), close=close))
+    db.session.commit()
+
+    # Only closed sessions are stored, the days since are valued on the fly
+    history = SnapshotService.get_history(portfolio.id)
+    stored = db.session.query(db.func.max(PortfolioSnapshot.date)).filter_by(portfolio_id=portfolio.id).scalar()
+    assert stored == MarketCalendar.last_closed_session()
+    assert history[-1].date == MarketCalendar.local_now().date()
+    assert history[1].value == 1100
+
+    # A synced bar replacing a stored day drops the snapshots valued with it
+    YahooFinanceService.update_asset_prices(aapl, ticker_data=BarsTicker())
+    db.session.commit()
+    assert PortfolioSnapshot.query.filter_by(portfolio_id=portfolio.id).count() == 1
+    assert [float(s.value) for s in SnapshotService.get_history(portfolio.id, end=date(2024, 1, 3))] == [1000, 1300]
+
+    # Syncing the same bar again, as every quote refresh after the close does, keeps them
+    stored = PortfolioSnapshot.query.filter_by(portfolio_id=portfolio.id).count()
+    YahooFinanceService.update_asset_prices(aapl, ticker_data=BarsTicker())
+    db.session.commit()
+    assert PortfolioSnapshot.query.filter_by(portfolio_id=portfolio.id).count() == stored
+
+
+def test_analytics_metrics_and_persisted_reuse(db, portfolio, make_asset, make_transaction, count_queries):
+    from datetime import date, timedelta
+    import numpy as np
+    from flask import current_app
+    from app.models.portfolio import PortfolioAnalysis
+    from app.services.ai_analysis import PortfolioAnalyticsService
+
+    aapl = make_asset('AAPL')
+    spy = make_asset('SPY', asset_type='etf')
+    make_transaction(portfolio, aapl, 'buy', 2, 100)
+    aapl_closes = [100, 110, 99, 120, 108]
+    spy_closes = [400, 404, 400, 408, 404]
+    for i, (a, s) in enumerate(zip(aapl_closes, spy_closes)):
+        day = date(2024, 1, 1) + timedelta(days=i)
+        db.session.add(AssetPrice(asset_id=aapl.id, date=day, close=a))
+        db.session.add(AssetPrice(asset_id=spy.id, date=day, close=s))
+    db.session.commit()
+    db.session.refresh(portfolio)
+
+    analysis = PortfolioAnalyticsService.analyze(portfolio, 'SPY', period_days=30)
+    results = analysis.results
+
+    returns = np.diff(aapl_closes) / aapl_closes[:-1]
+    spy_returns = np.diff(spy_closes) / spy_closes[:-1]
+    assert results['observations'] == 4
+    assert results['total_return'] == pytest.approx(0.08)
+    assert results['annualized_volatility'] == pytest.approx(returns.std(ddof=1) * np.sqrt(252), rel=1e-5)
+    assert results['max_drawdown'] == pytest.approx(-0.1, rel=1e-5)
+    assert results['beta'] == pytest.approx(
+        np.cov(returns, spy_returns)[0, 1] / spy_returns.var(ddof=1), rel=1e-5)
+    assert results['correlation'] == {'AAPL': {'AAPL': 1.0}}
+
+    with count_queries() as statements:
+        assert PortfolioAnalyticsService.analyze(portfolio, 'SPY', period_days=30).id == analysis.id
+    assert not any(s.lstrip().upper().startswith('INSERT') for s in statements)
+
+    # Every new price is a new analysis, only the latest ones are kept
+    current_app.config['ANALYTICS_HISTORY'] = 2
+    for i in range(3):
+        db.session.add(AssetPrice(asset_id=aapl.id, date=date(2024, 1, 6) + timedelta(days=i), close=110))
+        db.session.commit()
+        latest = PortfolioAnalyticsService.analyze(portfolio, 'SPY', period_days=30)
+    assert PortfolioAnalysis.query.filter_by(portfolio_id=portfolio.id).count() == 2
+    assert db.session.get(PortfolioAnalysis, latest.id) is not None
+
+
+def test_analytics_start_when_every_holding_has_history():
+    import numpy as np
+    import pandas as pd
+    from app.services.ai_analysis import PortfolioAnalyticsService
+
+    days = pd.date_range('2024-01-01', periods=5)
+    closes = pd.DataFrame({
+        1: [100, 110, 99, 120, 108],
+        2: [np.nan, np.nan, 50, 55, np.nan],  # listed on the 3rd, no bar on the 5th
+        3: [np.nan] * 5  # no history at all
+    }, index=days)
+
+    results = PortfolioAnalyticsService.compute_metrics(closes, pd.Series({1: 1.0, 2: 2.0, 3: 10.0}))
+
+    # 199, 230, 218: no jump when the second asset's history starts
+    assert results['observations'] == 2
+    assert results['total_return'] == pytest.approx(218 / 199 - 1, abs=1e-6)
+    assert results['max_drawdown'] == pytest.approx(218 / 230 - 1, abs=1e-6)
+    assert set(results['correlation']) == {1, 2}
+
+
+def test_transactions_keyset_pages_and_ndjson_stream(client, auth_headers, db, portfolio, make_asset,
+                                                      make_transaction, count_queries, monkeypatch):
+    import json
+    from app.api import portfolio as portfolio_api
+
+    aapl = make_asset('AAPL')
+    msft = make_asset('MSFT')
+    for i in range(7):
+        # Two transactions per day exercise the id tie-breaker
+        make_transaction(portfolio, aapl if i % 2 else msft, 'buy', 1, 10 + i,
+                         transaction_date=datetime(2024, 1, 1 + i // 2))
+    db.session.commit()
+
+    seen = []
+    cursor = None
+    while True:
+        url = f'/api/portfolios/{portfolio.id}/transactions?limit=3' + (f'&cursor={cursor}' if cursor else '')
+        with count_queries() as statements:
+            page = client.get(url, headers=auth_headers).get_json()
+        assert not any('FROM assets' in s and 'JOIN' not in s for s in statements)  # asset joined, not lazy
+        seen.extend(t['id'] for t in page['transactions'])
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+
+    assert len(seen) == 7 and len(set(seen)) == 7
+    dates = [t['transaction_date'] for t in client.get(
+        f'/api/portfolios/{portfolio.id}/transactions?limit=10', headers=auth_headers).get_json()['transactions']]
+    assert dates == sorted(dates, reverse=True)
+
+    monkeypatch.setattr(portfolio_api, 'TRANSACTIONS_STREAM_BATCH', 2)
+    response = client.get(f'/api/portfolios/{portfolio.id}/transactions?format=ndjson', headers=auth_headers)
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert response.mimetype == 'application/x-ndjson'
+    assert [row['id'] for row in rows] == seen
+    assert rows[0]['asset']['ticker'] in ('AAPL', 'MSFT')
+
+    assert client.get(f'/api/portfolios/{portfolio.id}/transactions?cursor=bad',
+                      headers=auth_headers).status_code == 400
+
+
+def test_import_transactions_resolves_each_ticker_once(client, auth_headers, db, portfolio, make_asset, monkeypatch):
+    import io
+    from app.models.asset import Asset
+    from app.models.transaction import Transaction
+    from app.services.yahoo_finance import YahooFinanceService
+
+    make_asset('AAPL')
+    db.session.commit()
+    lookups = []
+
+    def fake_info(ticker):
+        lookups.append(ticker)
+        if ticker == 'NOPE':
+            return None
+        return {'ticker': ticker, 'name': f'{ticker} Corp', 'currency': 'USD', 'exchange': 'NMS',
+                'sector': '', 'industry': '', 'asset_type': 'stock'}
+
+    synced = []
+    monkeypatch.setattr(YahooFinanceService, 'get_stock_info', staticmethod(fake_info))
+    monkeypatch.setattr(YahooFinanceService, 'sync_asset', staticmethod(synced.append))
+
+    statement = '\n'.join([
+        'ticker,transaction_type,quantity,price,transaction_date,fee',
+        'AAPL,buy,10,100,2024-01-02,1',
+        'msft,BUY,5,300,2024-01-03T10:00:00,',
+        'MSFT,sell,2,310,2024-01-04,0.5',
+        'NOPE,buy,1,1,2024-01-04,',
+        'AAPL,hold,1,1,2024-01-04,',
+        'AAPL,buy,-1,1,2024-01-04,',
+        'DROP TABLE;,buy,1,1,2024-01-04,',
+    ] + ['MSFT,buy,1,301,2024-02-01,'] * 50)
+
+    response = client.post(
+        f'/api/portfolios/{portfolio.id}/transactions/import', headers=auth_headers,
+        data={'file': (io.BytesIO(statement.encode()), 'statement.csv')}, content_type='multipart/form-data')
+    report = response.get_json()
+
+    assert response.status_code == 201
+    assert report['imported'] == 53
+    assert report['created_assets'] == ['MSFT']
+    assert [error['row'] for error in report['errors']] == [4, 5, 6, 7]
+    assert sorted(lookups) == ['MSFT', 'NOPE']
+    assert Transaction.query.filter_by(portfolio_id=portfolio.id).count() == 53
+    assert Asset.query.filter_by(ticker='MSFT').count() == 1
+
+    # More unknown tickers than a sync batch are rejected before any lookup
+    client.application.config['SYNC_BATCH_MAX'] = 2
+    statement = '\n'.join(['ticker,transaction_type,quantity,price,transaction_date'] +
+                          [f'{ticker},buy,1,1,2024-01-04' for ticker in ('AAPL', 'NEW1', 'NEW2', 'NEW3')])
+    response = client.post(
+        f'/api/portfolios/{portfolio.id}/transactions/import', headers=auth_headers,
+        data={'file': (io.BytesIO(statement.encode()), 'statement.csv')}, content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert response.get_json()['tickers'] == ['NEW1', 'NEW2', 'NEW3']
+    assert sorted(lookups) == ['MSFT', 'NOPE']
+    assert Transaction.query.filter_by(portfolio_id=portfolio.id).count() == 53
+
+    response = client.post(
+        f'/api/portfolios/{portfolio.id}/transactions', headers=auth_headers,
+        json={'ticker': 'AAPL', 'transaction_type': 'sell', 'quantity': 1, 'price': 120,
+              'transaction_date': '2024-03-01'})
+    assert response.status_code == 201
+    assert response.get_json()['transaction']['asset']['ticker'] == 'AAPL'
+
+
+def test_positions_follow_transaction_writes(app, db, portfolio, make_asset, make_transaction):
+    from app.models.portfolio import Position
+
+    aapl = make_asset('AAPL')
+    make_transaction(portfolio, aapl, 'buy', 10, 100, fee=10, transaction_date=datetime(2024, 1, 2))
+    make_transaction(portfolio, aapl, 'sell', 4, 150, fee=2, transaction_date=datetime(2024, 1, 5))
+    db.session.commit()
+
+    def position():
+        db.session.expire_all()
+        return Position.query.filter_by(portfolio_id=portfolio.id, asset_id=aapl.id).one()
+
+    assert float(position().quantity) == 6
+    assert float(position().cost_basis) == pytest.approx(606)  # 6 * 101
+    assert float(position().realized_pnl) == pytest.approx(4 * 150 - 2 - 4 * 101)
+
+    # Back-dated buy rebuilds the position in date order
+    backdated = make_transaction(portfolio, aapl, 'buy', 10, 50, transaction_date=datetime(2024, 1, 3))
+    db.session.commit()
+    assert float(position().quantity) == 16
+    assert float(position().realized_pnl) == pytest.approx(4 * 150 - 2 - 4 * (1010 + 500) / 20)
+
+    db.session.delete(backdated)
+    db.session.commit()
+    assert float(position().quantity) == 6
+
+    # Drift is repaired by the rebuild command
+    Position.query.update({'quantity': 999})
+    db.session.commit()
+    result = app.test_cli_runner().invoke(args=['positions', 'rebuild'])
+    assert 'Rebuilt 1 positions' in result.output
+    assert float(position().quantity) == 6
+
+
+def test_cost_basis_methods_and_incremental_matching(client, auth_headers, db, portfolio, make_asset, make_transaction,
+                                                     count_queries):
+    from app.models.transaction import Transaction
+    from app.services.cost_basis import CostBasisService, LotBook
+
+    aapl = make_asset('AAPL')
+    make_transaction(portfolio, aapl, 'buy', 10, 100, fee=10, transaction_date=datetime(2024, 1, 2))
+    make_transaction(portfolio, aapl, 'buy', 10, 200, transaction_date=datetime(2024, 1, 3))
+    make_transaction(portfolio, aapl, 'sell', 15, 300, fee=5, transaction_date=datetime(2024, 1, 4))
+    db.session.commit()
+
+    fifo = CostBasisService.get_books(portfolio.id, 'fifo')[aapl.id]
+    assert float(fifo.cost_basis) == pytest.approx(5 * 200)
+    assert float(fifo.realized_pnl) == pytest.approx(15 * 300 - 5 - (1010 + 5 * 200))
+
+    lifo = CostBasisService.get_books(portfolio.id, 'lifo')[aapl.id]
+    assert float(lifo.cost_basis) == pytest.approx(505)
+    assert lifo.open_lots() == [{'date': '2024-01-02T00:00:00', 'quantity': 5.0, 'cost': 505.0}]
+
+    average = CostBasisService.get_books(portfolio.id, 'average')[aapl.id]
+    assert float(average.cost_basis) == pytest.approx(5 * 3010 / 20)
+    position = portfolio.positions[0]
+    assert float(average.realized_pnl) == pytest.approx(float(position.realized_pnl))
+
+    # Appending a trade only reads the new rows
+    portfolio_id, asset_id = portfolio.id, aapl.id
+    make_transaction(portfolio, aapl, 'sell', 5, 250, transaction_date=datetime(2024, 1, 5))
+    db.session.commit()
+    with count_queries() as statements:
+        fifo = CostBasisService.get_books(portfolio_id, 'fifo')[asset_id]
+    assert len(statements) == 1 and 'transactions.id > ?' in statements[0]
+    assert float(fifo.quantity) == 0
+
+    # Updates drop the cached books on commit
+    position_trade = portfolio.transactions[0]
+    position_trade.fee = 0
+    db.session.commit()
+    fifo = CostBasisService.get_books(portfolio.id, 'fifo')[aapl.id]
+    assert float(fifo.realized_pnl) == pytest.approx(15 * 300 - 5 - 2000 + 5 * 250 - 1000)
+
+    # A trade committed after the books read a higher id is not skipped
+    late = make_transaction(portfolio, aapl, 'buy', 3, 100, transaction_date=datetime(2024, 1, 6))
+    make_transaction(portfolio, aapl, 'buy', 2, 100, transaction_date=datetime(2024, 1, 6))
+    db.session.commit()
+    late_id = late.id
+    db.session.delete(late)
+    db.session.commit()
+    assert float(CostBasisService.get_books(portfolio_id, 'fifo')[asset_id].quantity) == 2
+    db.session.add(Transaction(id=late_id, portfolio_id=portfolio_id, asset_id=asset_id, transaction_type='buy',
+                               quantity=3, price=100, fee=0, transaction_date=datetime(2024, 1, 6)))
+    db.session.commit()
+    assert float(CostBasisService.get_books(portfolio_id, 'fifo')[asset_id].quantity) == 5
+    make_transaction(portfolio, aapl, 'sell', 5, 100, transaction_date=datetime(2024, 1, 7))
+    db.session.commit()
+
+    # Thousands of partial fills stay consistent after compaction
+    book = LotBook('fifo')
+    for i in range(5000):
+        book.buy(1, i)
+        book.sell(0.5, i)
+    assert float(book.quantity) == 2500
+    assert len(book.cum_quantity) < 5000
+    assert float(book.cost_basis) == sum(range(2500, 5000))  # the newest 2500 lots are open
+
+    response = client.get(f'/api/portfolios/{portfolio_id}/cost-basis?method=lifo&lots=1', headers=auth_headers)
+    assert response.status_code == 200
+    assert response.get_json()['assets'][0]['lots'] == []
+    response = client.get(f'/api/portfolios/{portfolio_id}/cost-basis?method=hifo', headers=auth_headers)
+    assert response.status_code == 400
+
+
+def test_json_provider_serializes_decimals_dates_and_rows(app, db, portfolio, make_asset, make_transaction,
+                                                          monkeypatch):
+    import json
+    from decimal import Decimal
+    import numpy as np
+    from sqlalchemy import select
+    from app.models.transaction import Transaction
+    from app.utils import serialization
+
+    aapl = make_asset('AAPL')
+    make_transaction(portfolio, aapl, 'buy', Decimal('1.5'), Decimal('101.25'), transaction_date=datetime(2024, 1, 2, 9))
+    rows = db.session.execute(select(Transaction.id, Transaction.price, Transaction.transaction_date)).all()
+    payload = {'rows': rows, 'fee': Decimal('0.99'), 'day': datetime(2024, 1, 2).date(), 1: 'int key',
+               'gaps': [float('nan'), float('inf'), Decimal('NaN')], 'series': np.array([1.5, np.nan])}
+    expected = {'rows': [[rows[0].id, 101.25, '2024-01-02T09:00:00']], 'fee': 0.99, 'day': '2024-01-02',
+                '1': 'int key', 'gaps': [None, None, None], 'series': [1.5, None]}
+
+    assert json.loads(app.json.dumps(payload)) == expected
+    with app.test_request_context():
+        assert app.json.response(payload).get_json() == expected
+
+    # The stdlib fallback writes the same valid JSON
+    monkeypatch.setattr(serialization, 'orjson', None)
+    assert 'NaN' not in app.json.dumps(payload)
+    assert json.loads(app.json.dumps(payload)) == expected
+
+
+class FakeFxDownload:
+    """Local stand-in for yfinance.download serving fixed daily exchange rates"""
+
+    def __init__(self, rates):
+        self.rates = rates
+        self.calls = []
+
+    def __call__(self, tickers, **kwargs):
+        import pandas as pd
+
+        tickers = list(tickers)
+        self.calls.append(tickers)
+        index = pd.to_datetime(sorted({day for rates in self.rates.values() for day in rates}))
+        data = pd.DataFrame(index=index, columns=pd.MultiIndex.from_product([tickers, ['Close']]), dtype=float)
+        for ticker in tickers:
+            for day, rate in self.rates.get(ticker, {}).items():
+                data.loc[pd.Timestamp(day), (ticker, 'Close')] = rate
+        return data
+
+
+def test_multi_currency_valuation_and_as_of_snapshots(client, auth_headers, db, portfolio, make_asset,
+                                                      make_transaction, count_queries, monkeypatch):
+    from datetime import date
+    from app.models.asset import FxRate
+    from app.services import yahoo_finance
+    from app.services.portfolio_service import PortfolioService
+    from app.services.snapshots import SnapshotService
+
+    fake = FakeFxDownload({
+        'EURUSD=X': {'2024-01-02': 1.10, '2024-01-04': 1.20},
+        'GBPUSD=X': {'2024-01-02': 1.25, '2024-01-03': 1.25, '2024-01-04': 1.25},
+    })
+    monkeypatch.setattr(yahoo_finance.yf, 'download', fake)
+
+    aapl = make_asset('AAPL')
+    sap = make_asset('SAP.DE', currency='EUR')
+    vod = make_asset('VOD.L', currency='GBp')
+    make_transaction(portfolio, aapl, 'buy', 10, 150)
+    make_transaction(portfolio, sap, 'buy', 10, 100, transaction_date=datetime(2024, 1, 2, 15))
+    make_transaction(portfolio, sap, 'sell', 5, 110, transaction_date=datetime(2024, 1, 3, 15))
+    make_transaction(portfolio, vod, 'buy', 1000, 70)
+    for asset, close in [(aapl, 200), (sap, 100), (vod, 80)]:
+        add_today_price(db, asset, close)
+    db.session.commit()
+
+    valuation = PortfolioService.value_portfolio(portfolio)
+    # 2000 USD + 5 * 100 EUR at 1.20 + 1000 * 80 GBp at 1.25
+    assert valuation.currency == 'USD'
+    assert valuation.total_value == pytest.approx(2000 + 600 + 1000)
+    rows = {row['ticker']: row for row in valuation.assets_summary}
+    assert (rows['SAP.DE']['total_value'], rows['SAP.DE']['base_total_value']) == (500, pytest.approx(600))
+    assert rows['VOD.L']['fx_rate'] == pytest.approx(0.0125)
+    # Every pair in one batched download, stored daily
+    assert fake.calls == [['EURUSD=X', 'GBPUSD=X']]
+    assert FxRate.query.count() == 5
+
+    # The rate matrix is cached, revaluing in another currency reads no rates
+    with count_queries() as statements:
+        response = client.get('/api/portfolios/?currency=eur', headers=auth_headers)
+    assert response.status_code == 200
+    listed = response.get_json()['portfolios'][0]
+    assert listed['currency'] == 'EUR'
+    assert listed['total_value'] == pytest.approx(2000 / 1.2 + 500 + 1000 / 1.2)
+    assert not any('fx_rates' in statement for statement in statements)
+    assert fake.calls == [['EURUSD=X', 'GBPUSD=X']]
+    assert client.get('/api/portfolios/?currency=euro', headers=auth_headers).status_code == 400
+
+    # Snapshots use the rate as of each day, the last one carried over gaps
+    for day, close in [(2, 100), (3, 110)]:
+        db.session.add(AssetPrice(asset_id=sap.id, date=date(2024, 1, day), close=close))
+    db.session.commit()
+    sap_only = Portfolio(user_id=portfolio.user_id, name='Euro')
+    db.session.add(sap_only)
+    db.session.flush()
+    make_transaction(sap_only, sap, 'buy', 10, 100, transaction_date=datetime(2024, 1, 2, 15))
+    db.session.commit()
+
+    assert SnapshotService.build(sap_only.id, until=date(2024, 1, 4)) == 3
+    usd = [s.to_dict() for s in SnapshotService.get_history(sap_only.id, end=date(2024, 1, 4))]
+    assert [h['value'] for h in usd] == pytest.approx([1100, 1210, 1320])
+    assert [h['cost_basis'] for h in usd] == pytest.approx([1100, 1100, 1100])
+
+    assert SnapshotService.build(sap_only.id, until=date(2024, 1, 4), currency='EUR') == 3
+    eur = [s.to_dict() for s in SnapshotService.get_history(sap_only.id, end=date(2024, 1, 4), currency='EUR')]
+    assert [h['value'] for h in eur] == [1000, 1100, 1100]
+    assert {h['currency'] for h in eur} == {'EUR'}
+
+
+def test_missing_fx_rate_is_reported_not_valued_at_zero(client, auth_headers, db, portfolio, make_asset,
+                                                        make_transaction, monkeypatch):
+    from datetime import date
+    from app.models.portfolio import PortfolioSnapshot
+    from app.services import yahoo_finance
+    from app.services.snapshots import SnapshotService
+
+    # EUR rates only exist from the 5th on
+    monkeypatch.setattr(yahoo_finance.yf, 'download', FakeFxDownload({'EURUSD=X': {'2024-01-05': 1.10}}))
+    aapl = make_asset('AAPL')
+    sap = make_asset('SAP.DE', currency='EUR')
+    make_transaction(portfolio, aapl, 'buy', 10, 100, transaction_date=datetime(2024, 1, 2, 15))
+    make_transaction(portfolio, sap, 'buy', 10, 100, transaction_date=datetime(2024, 1, 4, 15))
+    for asset in (aapl, sap):
+        for day in (2, 3, 4, 5):
+            db.session.add(AssetPrice(asset_id=asset.id, date=date(2024, 1, day), close=100))
+    db.session.commit()
+
+    # Snapshots stop before the first day SAP.DE cannot be converted
+    assert SnapshotService.build(portfolio.id, until=date(2024, 1, 5)) == 2
+    stored = PortfolioSnapshot.query.filter_by(portfolio_id=portfolio.id).order_by(PortfolioSnapshot.date).all()
+    assert [(s.date.day, float(s.value)) for s in stored] == [(2, 1000), (3, 1000)]
+
+    # Valued in a currency without any rate, the totals are withheld and the holding reported
+    listed = client.get('/api/portfolios/?currency=CHF', headers=auth_headers).get_json()['portfolios'][0]
+    assert (listed['total_value'], listed['total_profit']) == (None, None)
+    assert listed['missing_fx_rates'] == ['AAPL', 'SAP.DE']
+
+
+def test_dividend_income_cached_until_holdings_change(client, auth_headers, db, portfolio, make_asset,
+                                                      make_transaction, count_queries, monkeypatch):
+    from datetime import date, timedelta
+    from app.models.asset import Dividend
+    from app.services import yahoo_finance
+
+    today = date.today()
+    monkeypatch.setattr(yahoo_finance.yf, 'download', FakeFxDownload(
+        {'EURUSD=X': {(today - timedelta(days=3)).isoformat(): 1.10}}))
+
+    aapl = make_asset('AAPL')
+    sap = make_asset('SAP.DE', currency='EUR')
+    make_transaction(portfolio, aapl, 'buy', 10, 150)
+    make_transaction(portfolio, sap, 'buy', 4, 100)
+    for asset, days_ago, amount in [(aapl, 400, 0.2), (aapl, 300, 0.25), (aapl, 30, 0.25), (aapl, -10, 0.3),
+                                    (sap, 60, 2.0)]:
+        db.session.add(Dividend(asset_id=asset.id, ex_date=today - timedelta(days=days_ago), amount=amount))
+    db.session.commit()
+
+    response = client.get(f'/api/portfolios/{portfolio.id}/dividends', headers=auth_headers)
+    assert response.status_code == 200
+    income = response.get_json()
+    # 10 * (0.25 + 0.25) USD + 4 * 2.00 EUR at 1.10
+    assert income['currency'] == 'USD'
+    assert income['trailing_12m'] == pytest.approx(13.8)
+    assert income['projected_12m'] == pytest.approx(13.8)
+    rows = {row['ticker']: row for row in income['assets']}
+    assert (rows['AAPL']['payments'], rows['SAP.DE']['fx_rate']) == (2, pytest.approx(1.1))
+    # Each payment is expected again a year after its ex-date
+    months = [month['month'] for month in income['schedule']]
+    assert months == sorted(months) and len(months) == 3
+    assert months[0] >= today.strftime('%Y-%m')
+    assert sum(month['amount'] for month in income['schedule']) == pytest.approx(13.8)
+
+    with count_queries() as statements:
+        client.get(f'/api/portfolios/{portfolio.id}/dividends', headers=auth_headers)
+    assert not any('dividends' in statement for statement in statements)
+
+    # A new trade drops the cached income on commit
+    make_transaction(portfolio, aapl, 'buy', 10, 160)
+    db.session.commit()
+    income = client.get(f'/api/portfolios/{portfolio.id}/dividends', headers=auth_headers).get_json()
+    assert income['trailing_12m'] == pytest.approx(18.8)
+
+
+def test_dividend_income_pays_quantity_held_on_ex_date(db, portfolio, make_asset, make_transaction):
+    from datetime import date, timedelta
+    from app.models.asset import Dividend
+    from app.services.dividends import DividendService
+
+    today = date.today()
+
+    def ago(days):
+        return datetime.combine(today - timedelta(days=days), datetime.min.time())
+
+    aapl = make_asset('AAPL')
+    msft = make_asset('MSFT')
+    make_transaction(portfolio, aapl, 'buy', 10, 150, transaction_date=ago(7))  # after every ex-date
+    make_transaction(portfolio, msft, 'buy', 5, 300, transaction_date=ago(300))
+    make_transaction(portfolio, msft, 'buy', 5, 300, transaction_date=ago(100))  # on an ex-date, not paid on it
+    make_transaction(portfolio, msft, 'sell', 10, 350, transaction_date=ago(20))  # closed since
+    for asset, days_ago, amount in [(aapl, 200, 0.25), (aapl, 30, 0.25), (msft, 200, 1.0), (msft, 100, 1.0),
+                                    (msft, 10, 1.0)]:
+        db.session.add(Dividend(asset_id=asset.id, ex_date=today - timedelta(days=days_ago), amount=amount))
+    db.session.commit()
+
+    rows = {row['ticker']: row for row in DividendService.get_income(portfolio.id)['assets']}
+    # A position opened last week earned nothing yet, its projection uses the current quantity
+    assert (rows['AAPL']['trailing_income'], rows['AAPL']['projected_income']) == (0, 5)
+    # A closed position keeps what it earned and projects nothing
+    assert (rows['MSFT']['quantity'], rows['MSFT']['trailing_income'], rows['MSFT']['projected_income']) == (0, 10, 0)
+    assert rows['MSFT']['payments'] == 2
@@ -0,0 +1,197 @@
+"""
+Query plans of the hot queries: each one has to be served by an index
+"""
+import re
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import event, insert, text
+
+from app.models.asset import Asset, AssetPrice, AssetMetric, AssetQuote, Dividend
+from app.models.portfolio import Portfolio, PortfolioSnapshot
+from app.models.transaction import Transaction
+from app.models.user import User
+from app.services.market_calendar import MarketCalendar
+from app.services.positions import PositionService
+
+HOT_TABLES = {
+    'transactions', 'portfolios', 'positions', 'assets', 'asset_prices', 'asset_metrics',
+    'dividends', 'portfolio_snapshots', 'portfolio_analyses', 'asset_quotes'
+}
+FULL_SCAN = re.compile(r'^SCAN (\w+)')
+
+
+@pytest.fixture
+def seeded(db, user, make_asset, make_transaction):
+    """A few portfolios with enough rows for the planner to prefer indexes"""
+    assets = [make_asset(f'T{i:02d}') for i in range(20)]
+    portfolios = [Portfolio(user_id=user.id, name=f'Portfolio {i}') for i in range(5)]
+    db.session.add_all(portfolios)
+    db.session.execute(insert(User), [
+        {'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': '-'} for i in range(50)
+    ])
+    db.session.execute(insert(Portfolio), [
+        {'user_id': other.id, 'name': 'Other'} for other in User.query.filter(User.id != user.id)
+    ])
+    db.session.flush()
+
+    # Only the trades of the first portfolio go through the ORM, positions follow them
+    for i in range(40):
+        make_transaction(portfolios[0], assets[i % 5], 'buy' if i % 4 else 'sell', 1, 100 + i,
+                         transaction_date=datetime(2024, 1, 1) + timedelta(days=i))
+    portfolio_ids = [pid for (pid,) in db.session.query(Portfolio.id).filter(Portfolio.id != portfolios[0].id)]
+    db.session.execute(insert(Transaction), [
+        {'portfolio_id': pid, 'asset_id': assets[i % 20].id, 'transaction_type': 'buy',
+         'quantity': 1, 'price': 100, 'fee': 0, 'transaction_date': datetime(2024, 1, 1) + timedelta(days=i)}
+        for pid in portfolio_ids for i in range(100)
+    ])
+    for pid in portfolio_ids:
+        PositionService.rebuild(pid)
+
+    today = date.today()
+    db.session.execute(insert(AssetPrice), [
+        {'asset_id': asset.id, 'date': today - timedelta(days=d), 'close': 100}
+        for asset in assets for d in range(120)
+    ])
+    # Half of the held assets have a quote of the current session, the others fall back to their latest bar
+    session = MarketCalendar.local_now().date() if MarketCalendar.is_open() else MarketCalendar.last_closed_session()
+    db.session.execute(insert(Asset), [
+        {'ticker': f'Q{i:03d}', 'name': f'Quoted {i}', 'asset_type': 'stock', 'currency': 'USD'}
+        for i in range(200)
+    ])
+    quoted = [asset_id for (asset_id,) in db.session.query(Asset.id).filter(Asset.ticker.like('Q%'))]
+    db.session.execute(insert(AssetQuote), [
+        {'asset_id': asset_id, 'price': 100, 'session_date': session, 'quoted_at': datetime.utcnow(),
+         'source': 'history'} for asset_id in [asset.id for asset in assets[:10]] + quoted
+    ])
+    db.session.execute(insert(AssetMetric), [
+        {'asset_id': asset.id, 'date': today - timedelta(days=d)} for asset in assets for d in range(30)
+    ])
+    db.session.execute(insert(Dividend), [
+        {'asset_id': asset.id, 'ex_date': today - timedelta(days=90 * q), 'amount': 1}
+        for asset in assets for q in range(12)
+    ])
+    db.session.commit()
+    db.session.execute(text('ANALYZE'))
+    return {'user': user, 'portfolio': portfolios[0], 'asset': assets[0]}
+
+
+@pytest.fixture
+def query_plans(db):
+    """Collects the query plan of every SELECT executed inside the block"""
+
+    @contextmanager
+    def collect():
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        plans = []
+        try:
+            yield plans
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        connection = db.session.connection()
+        for statement, parameters in statements:
+            rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters).all()
+            plans.append((statement, [row[-1] for row in rows]))
+
+    return collect
+
+
+def assert_indexed(plans, *indexes):
+    """
+    No full scan of a hot table, and every expected index is used. Walking
+    an index in order under a LIMIT stops early and is not a full scan.
+    """
+    assert plans, 'no query was executed'
+    used = []
+    for statement, details in plans:
+        for detail in details:
+            match = FULL_SCAN.match(detail)
+            bounded = 'USING INDEX' in detail and 'LIMIT' in statement
+            assert not (match and match.group(1) in HOT_TABLES and not bounded), f'{detail} in:\n{statement}'
+            used.append(detail)
+    for index in indexes:
+        assert any(index in detail for detail in used), f'{index} not used:\n' + '\n'.join(used)
+
+
+def test_portfolio_listing_plans(client, auth_headers, seeded, query_plans):
+    with query_plans() as plans:
+        response = client.get('/api/portfolios/', headers=auth_headers)
+    assert response.status_code == 200
+    assert_indexed(plans, 'ix_portfolios_user_id', 'sqlite_autoindex_positions', 'sqlite_autoindex_asset_quotes',
+                   'sqlite_autoindex_asset_prices')
+
+
+def test_transaction_plans(seeded, query_plans):
+    portfolio, asset = seeded['portfolio'], seeded['asset']
+    with query_plans() as plans:
+        page = Transaction.keyset_page(portfolio.id, 10)
+        Transaction.keyset_page(portfolio.id, 10, (page[-1].transaction_date, page[-1].id))
+        PositionService.compute(portfolio.id)
+    assert_indexed(plans, 'ix_transactions_portfolio_date')
+    assert not any('TEMP B-TREE' in detail for _, details in plans for detail in details)
+
+    with query_plans() as plans:
+        Transaction.query.filter_by(portfolio_id=portfolio.id, asset_id=asset.id, transaction_type='buy').all()
+        PositionService.compute(portfolio.id, [asset.id])
+    assert_indexed(plans, 'ix_transactions_portfolio_asset_type')
+
+
+def test_cost_basis_plans(seeded, query_plans):
+    from app.services.cost_basis import CostBasisService
+
+    with query_plans() as plans:
+        CostBasisService.get_books(seeded['portfolio'].id)
+    assert_indexed(plans, 'ix_transactions_portfolio_date')
+
+
+def test_asset_detail_plans(seeded, query_plans):
+    asset = seeded['asset']
+    with query_plans() as plans:
+        asset.get_price_history()
+        asset.get_latest_metrics()
+        asset.get_dividends()
+    assert_indexed(plans, 'sqlite_autoindex_asset_prices', 'sqlite_autoindex_asset_metrics',
+                   'sqlite_autoindex_dividends')
+
+
+def test_snapshot_history_plans(seeded, query_plans):
+    from app.services.snapshots import SnapshotService
+
+    portfolio_id = seeded['portfolio'].id
+    SnapshotService.build(portfolio_id)
+    with query_plans() as plans:
+        SnapshotService.get_history(portfolio_id, date.today() - timedelta(days=30))
+    assert_indexed(plans, 'sqlite_autoindex_portfolio_snapshots')
+    assert PortfolioSnapshot.query.filter_by(portfolio_id=portfolio_id).count() > 0
+
+
+def test_asset_catalogue_plans(client, auth_headers, seeded, query_plans):
+    with query_plans() as plans:
+        response = client.get('/api/assets/assets?limit=5', headers=auth_headers)
+    assert response.status_code == 200
+    assert_indexed(plans, 'sqlite_autoindex_assets', 'sqlite_autoindex_asset_quotes')
+
+
+def test_dividend_income_plans(seeded, query_plans):
+    from app.services.dividends import DividendService
+
+    with query_plans() as plans:
+        DividendService.get_income(seeded['portfolio'].id)
+    assert_indexed(plans, 'sqlite_autoindex_positions', 'sqlite_autoindex_dividends')
+
+
+def test_screener_plans(client, auth_headers, seeded, query_plans):
+    with query_plans() as plans:
+        response = client.get('/api/assets/screener?sort=-market_cap&limit=5', headers=auth_headers)
+    assert response.status_code == 200
+    # The latest row per asset comes from the (asset_id, date) index alone
+    metric_reads = [detail for _, details in plans for detail in details if 'asset_metrics' in detail]
+    assert metric_reads and all('sqlite_autoindex_asset_metrics' in detail for detail in metric_reads)
@@ -0,0 +1,15 @@
+"""
+Market data worker, run as its own process: python worker.py
+Refreshes market data on schedule and runs queued asset sync jobs
+"""
+import threading
+from app import create_app
+from app.extensions import sync_jobs
+from app.services.scheduler import RefreshScheduler
+
+app = create_app()
+
+if __name__ == '__main__':
+    if app.config['SYNC_JOBS_BACKEND'] == 'redis':
+        threading.Thread(target=sync_jobs.work, name='sync-jobs', daemon=True).start()
+    RefreshScheduler(app).run_forever()